@@ -1,115 +1,444 @@
 # ai_services.py (con prompts mejorados)
-from langchain_ollama import OllamaLLM
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.chains import LLMChain
+from llm_backends import crear_backend, LLMNoDisponible
+from message_parser import MessageParser
+import respuestas
+from trazas import span
+from startup import en_hilo
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import Counter
 from config import Config
+import contextvars
 import logging
+import json
+import os
+import queue
 import re
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
-class IAService:
-    def __init__(self):
+CATEGORIAS_VALIDAS = {"facturar", "consultar", "ayuda", "estado", "otro"}
+
+# Prompt mejorado con ejemplos más diversos
+PROMPT_CLASIFICACION = (
+    "Eres un asistente especializado en sistemas de facturación que clasifica mensajes en una de estas categorías:\n"
+    "- facturar: mensajes que solicitan generar una factura o documento fiscal. Ejemplos: 'Facturar 2 licencias', 'Necesito factura de 3 monitores y 1 teclado', 'Generar factura para 5 servicios de consultoría', 'Facturar los siguientes productos: 2 mesas, 4 sillas'.\n"
+    "- consultar: mensajes que solicitan información sobre facturas existentes. Ejemplos: 'Consultar facturas de RFC EKU9003173C9', 'Mostrar mis facturas del mes pasado', 'Ver facturas pendientes', 'Estado de mis facturas'.\n"
+    "- ayuda: mensajes que piden instrucciones o información sobre el servicio. Ejemplos: '¿Cómo funciona?', 'Opciones disponibles', 'Necesito ayuda', 'No sé cómo usar este servicio'.\n"
+    "- estado: mensajes que preguntan específicamente por el estado de una factura o trámite. Ejemplos: '¿En qué estado está mi factura?', 'Estado de trámite 12345', 'Seguimiento de factura'.\n"
+    "- otro: mensajes que no pertenecen a ninguna categoría anterior como saludos, agradecimientos o consultas no relacionadas.\n\n"
+    "Analiza el siguiente mensaje y clasifícalo en una sola categoría. Tu respuesta debe ser únicamente la categoría:\n\n"
+    "Mensaje: {mensaje}\n"
+    "Respuesta:"
+)
+
+# Clasificación de varios mensajes en un solo prompt (micro-batching)
+PROMPT_CLASIFICACION_LOTE = (
+    "Eres un asistente especializado en sistemas de facturación que clasifica mensajes en una de estas categorías:\n"
+    "- facturar: solicitudes para generar una factura o documento fiscal.\n"
+    "- consultar: solicitudes de información sobre facturas existentes.\n"
+    "- ayuda: solicitudes de instrucciones o información sobre el servicio.\n"
+    "- estado: preguntas sobre el estado de una factura o trámite.\n"
+    "- otro: saludos, agradecimientos o mensajes no relacionados.\n\n"
+    "Clasifica cada uno de los siguientes mensajes numerados. Responde con una línea por mensaje "
+    "en el formato 'número. categoría' y nada más:\n\n"
+    "Mensajes:\n"
+    "{mensajes}\n\n"
+    "Respuestas:"
+)
+
+PROMPT_EXTRACCION = (
+    "Extrae la información de facturación del siguiente mensaje. Debes identificar:\n"
+    "1. El RFC del cliente\n"
+    "2. Los productos mencionados y sus cantidades\n\n"
+    "Devuelve tu respuesta en formato JSON con las siguientes propiedades:\n"
+    "- rfc: El RFC mencionado (si existe)\n"
+    "- productos: Lista de objetos, cada uno con 'nombre' y 'cantidad'\n\n"
+    "Mensaje: {mensaje}\n\n"
+    "JSON:"
+)
+
+# Clasificación y extracción en una sola llamada (Config.LLM_MODO_COMBINADO)
+PROMPT_COMBINADO = (
+    "Eres un asistente especializado en sistemas de facturación. Analiza el mensaje y realiza dos tareas:\n"
+    "1. Clasifícalo en una sola categoría:\n"
+    "- facturar: solicitudes para generar una factura. Ejemplo: 'Facturar 2 licencias a RFC EKU9003173C9'.\n"
+    "- consultar: solicitudes de información sobre facturas existentes. Ejemplo: 'Consultar facturas de RFC EKU9003173C9'.\n"
+    "- ayuda: solicitudes de instrucciones sobre el servicio. Ejemplo: '¿Cómo funciona?'.\n"
+    "- estado: preguntas sobre el estado de una factura o trámite. Ejemplo: 'Estado de trámite 12345'.\n"
+    "- otro: saludos, agradecimientos o mensajes no relacionados.\n"
+    "2. Extrae el RFC del cliente (si existe) y los productos mencionados con sus cantidades.\n\n"
+    "Devuelve únicamente un JSON con las propiedades:\n"
+    "- intencion: la categoría elegida\n"
+    "- rfc: el RFC mencionado o null\n"
+    "- productos: lista de objetos con 'nombre' y 'cantidad' (vacía si no hay)\n\n"
+    "Ejemplo: {{\"intencion\": \"facturar\", \"rfc\": \"EKU9003173C9\", \"productos\": [{{\"nombre\": \"licencias\", \"cantidad\": 2}}]}}\n\n"
+    "Mensaje: {mensaje}\n\n"
+    "JSON:"
+)
+
+class ClasificadorPorLotes:
+    """
+    Agrupa las clasificaciones concurrentes que llegan dentro de una ventana corta
+    (Config.LLM_LOTE_ESPERA_MS) y las envía al LLM en un solo prompt de hasta
+    Config.LLM_LOTE_MAX mensajes. Cada llamador recibe su categoría mediante un Future.
+    
+    Solo agrupa cuando el proceso atiende varias solicitudes a la vez
+    (p. ej. gunicorn con --threads).
+    """
+    def __init__(self, backend, clasificar_individual, max_lote=None, espera_ms=None, timeout=None):
+        self.backend = backend
+        self.clasificar_individual = clasificar_individual
+        self.max_lote = max_lote or Config.LLM_LOTE_MAX
+        self.espera = (Config.LLM_LOTE_ESPERA_MS if espera_ms is None else espera_ms) / 1000.0
+        self.timeout = timeout or Config.LLM_TIMEOUT
+        self._lock = threading.Lock()
+        self._pid = None
+        self._metricas = {"lotes": 0, "mensajes": 0, "respaldos_individuales": 0, "tamanos": Counter()}
+    
+    def _asegurar_hilo(self):
+        # El hilo recolector se crea en el primer uso y de nuevo tras un fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._cola = queue.Queue()
+            self._ejecutor = ThreadPoolExecutor(max_workers=Config.LLM_MAX_CONCURRENCIA,
+                                                thread_name_prefix="llm-lote")
+            threading.Thread(target=self._recolectar, name="llm-lote-recolector", daemon=True).start()
+            self._pid = os.getpid()
+    
+    def clasificar(self, mensaje):
+        """Encola el mensaje y espera la categoría asignada en su lote"""
+        self._asegurar_hilo()
+        futuro = Future()
+        # La llamada del lote y el respaldo individual se ejecutan con la traza de la solicitud
+        self._cola.put((mensaje, futuro, contextvars.copy_context()))
+        try:
+            return futuro.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise LLMNoDisponible("Tiempo de espera agotado para el lote de clasificación")
+    
+    def _recolectar(self):
+        while True:
+            lote = [self._cola.get()]
+            limite = time.monotonic() + self.espera
+            while len(lote) < self.max_lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self._cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+            self._ejecutor.submit(self._procesar, lote)
+    
+    def _procesar(self, lote):
+        with self._lock:
+            self._metricas["lotes"] += 1
+            self._metricas["mensajes"] += len(lote)
+            self._metricas["tamanos"][len(lote)] += 1
+        
         try:
-            self.llm = OllamaLLM(model=Config.LLM_MODEL, temperature=Config.LLM_TEMPERATURE)
-            logger.info(f"Modelo LLM inicializado: {Config.LLM_MODEL}")
+            if len(lote) == 1:
+                categorias = [None]
+            else:
+                mensajes = "\n".join(f"{i}. {mensaje}" for i, (mensaje, _, _) in enumerate(lote, 1))
+                # El lote se registra en la traza del primer mensaje
+                respuesta = lote[0][2].run(self._generar_lote, mensajes, len(lote))
+                categorias = self._parsear_respuesta(respuesta, len(lote))
         except Exception as e:
-            logger.error(f"Error inicializando LLM: {e}")
-            # Fallback a un modelo simple si hay error
-            self.llm = None
+            for _, futuro, _ in lote:
+                futuro.set_exception(e)
+            return
+        
+        for (mensaje, futuro, contexto), categoria in zip(lote, categorias):
+            try:
+                if categoria is None:
+                    # Lote de un solo mensaje o línea faltante: clasificar por separado
+                    if len(lote) > 1:
+                        with self._lock:
+                            self._metricas["respaldos_individuales"] += 1
+                    categoria = contexto.run(self.clasificar_individual, mensaje)
+                futuro.set_result(categoria)
+            except Exception as e:
+                futuro.set_exception(e)
+    
+    def _generar_lote(self, mensajes, total):
+        with span("llm.lote", atributos={"llm.lote.tamano": total}):
+            return self.backend.generar(PROMPT_CLASIFICACION_LOTE.format(mensajes=mensajes))
+    
+    @staticmethod
+    def _parsear_respuesta(respuesta, total):
+        """Convierte las líneas 'n. categoría' en una lista; None donde no hay respuesta"""
+        categorias = [None] * total
+        for linea in respuesta.strip().lower().splitlines():
+            match = re.match(r'\s*(\d+)\s*[.):-]\s*(\w+)', linea)
+            if not match:
+                continue
+            idx = int(match.group(1)) - 1
+            if 0 <= idx < total:
+                categoria = match.group(2)
+                categorias[idx] = categoria if categoria in CATEGORIAS_VALIDAS else "otro"
+        return categorias
     
-    def preprocesar_mensaje(self, mensaje):
+    def metricas(self):
+        """Métricas de llenado de los lotes enviados"""
+        with self._lock:
+            lotes = self._metricas["lotes"]
+            mensajes = self._metricas["mensajes"]
+            return {
+                "lotes": lotes,
+                "mensajes": mensajes,
+                "respaldos_individuales": self._metricas["respaldos_individuales"],
+                "tamano_promedio": round(mensajes / lotes, 2) if lotes else 0.0,
+                "llenado_promedio": round(mensajes / (lotes * self.max_lote), 3) if lotes else 0.0,
+                "tamanos": dict(self._metricas["tamanos"])
+            }
+
+class IAService:
+    def __init__(self, backend=None):
+        """
+        Args:
+            backend (LLMBackend, optional): Backend a utilizar; por defecto el de Config.LLM_BACKEND
+        """
+        try:
+            self.backend = backend or crear_backend()
+            logger.info("Backend LLM inicializado: %s", self.backend.nombre)
+        except Exception as e:
+            logger.error("Error inicializando LLM: %s", e)
+            # Sin backend se usa el clasificador determinista
+            self.backend = None
+        
+        # Clasificación previa por embeddings; el LLM solo se usa si no hay confianza suficiente
+        self.embeddings = None
+        if Config.EMBEDDINGS_ACTIVO:
+            try:
+                from embedding_service import obtener_clasificador_intencion
+                self.embeddings = obtener_clasificador_intencion()
+                logger.info("Clasificación por embeddings activa")
+            except Exception as e:
+                logger.error("Error inicializando clasificador por embeddings: %s", e)
+        
+        # Agrupación opcional de clasificaciones concurrentes
+        self.lotes = None
+        if self.backend and Config.LLM_LOTES_ACTIVO:
+            self.lotes = ClasificadorPorLotes(self.backend, self._clasificar_con_llm)
+            logger.info("Micro-batching de clasificación activo (máx. %s mensajes)", self.lotes.max_lote)
+
+    @staticmethod
+    def preprocesar_mensaje(mensaje):
         """
         Normaliza el mensaje eliminando ruido y preparándolo para el modelo.
         """
         mensaje = mensaje.lower().strip()  # Convertir a minúsculas y eliminar espacios
         mensaje = re.sub(r"[^a-zA-Z0-9áéíóúñü\s]", "", mensaje)  # Eliminar caracteres especiales
         return mensaje
-    
+
     def clasificar_mensaje(self, mensaje):
         """
         Clasifica un mensaje en una de estas categorías: facturar, consultar, ayuda, estado, otro.
+        Si el LLM no está disponible se usa el clasificador determinista.
         """
-        if not mensaje or not self.llm:
+        if not mensaje:
             return "otro"
-            
+        intencion = self._clasificar_con_embeddings(mensaje)
+        if intencion:
+            return intencion
+        if not self.backend:
+            return MessageParser.clasificar_intencion(mensaje)
+
         try:
-            # Prompt mejorado con ejemplos más diversos
-            prompt = ChatPromptTemplate.from_template(
-                "Eres un asistente especializado en sistemas de facturación que clasifica mensajes en una de estas categorías:\n"
-                "- facturar: mensajes que solicitan generar una factura o documento fiscal. Ejemplos: 'Facturar 2 licencias', 'Necesito factura de 3 monitores y 1 teclado', 'Generar factura para 5 servicios de consultoría', 'Facturar los siguientes productos: 2 mesas, 4 sillas'.\n"
-                "- consultar: mensajes que solicitan información sobre facturas existentes. Ejemplos: 'Consultar facturas de RFC ABC123456XYZ', 'Mostrar mis facturas del mes pasado', 'Ver facturas pendientes', 'Estado de mis facturas'.\n"
-                "- ayuda: mensajes que piden instrucciones o información sobre el servicio. Ejemplos: '¿Cómo funciona?', 'Opciones disponibles', 'Necesito ayuda', 'No sé cómo usar este servicio'.\n"
-                "- estado: mensajes que preguntan específicamente por el estado de una factura o trámite. Ejemplos: '¿En qué estado está mi factura?', 'Estado de trámite 12345', 'Seguimiento de factura'.\n"
-                "- otro: mensajes que no pertenecen a ninguna categoría anterior como saludos, agradecimientos o consultas no relacionadas.\n\n"
-                "Analiza el siguiente mensaje y clasifícalo en una sola categoría. Tu respuesta debe ser únicamente la categoría:\n\n"
-                "Mensaje: {mensaje}\n"
-                "Respuesta:"
-            )
-            chain = LLMChain(llm=self.llm, prompt=prompt)
-            respuesta = chain.run(mensaje=mensaje).strip().lower()
-
-            # Validar que la respuesta esté en las categorías esperadas
-            categorias_validas = {"facturar", "consultar", "ayuda", "estado", "otro"}
-            if respuesta not in categorias_validas:
-                logger.warning(f"Respuesta inesperada del modelo: {respuesta}")
-                return "otro"
-            
-            return respuesta
+            if self.lotes:
+                return self.lotes.clasificar(mensaje)
+            return self._clasificar_con_llm(mensaje)
+        except LLMNoDisponible as e:
+            logger.warning("LLM no disponible, usando clasificador determinista: %s", e)
+            return MessageParser.clasificar_intencion(mensaje)
         except Exception as e:
-            logger.error(f"Error clasificando mensaje: {e}")
+            logger.error("Error clasificando mensaje: %s", e)
             return "otro"
-    
+
+    def _clasificar_con_embeddings(self, mensaje):
+        """Devuelve la intención si el clasificador por embeddings tiene confianza suficiente, o None"""
+        if not self.embeddings:
+            return None
+        try:
+            intencion, similitud = self.embeddings.clasificar(mensaje)
+            if intencion:
+                logger.info("Intención por embeddings: %s (similitud %.2f)", intencion, similitud)
+            return intencion
+        except Exception as e:
+            logger.error("Error clasificando con embeddings: %s", e)
+            return None
+
+    def _clasificar_con_llm(self, mensaje):
+        """Clasifica un único mensaje con el prompt individual"""
+        return self._interpretar_clasificacion(self.backend.generar(PROMPT_CLASIFICACION.format(mensaje=mensaje)))
+
+    @staticmethod
+    def _interpretar_clasificacion(respuesta):
+        respuesta = respuesta.strip().lower()
+
+        # Validar que la respuesta esté en las categorías esperadas
+        if respuesta not in CATEGORIAS_VALIDAS:
+            logger.warning("Respuesta inesperada del modelo: %s", respuesta)
+            return "otro"
+
+        return respuesta
+
     def extraer_detalles_con_llm(self, mensaje):
         """
         Utiliza el LLM para extraer detalles más complejos de un mensaje de facturación
         cuando los patrones regulares no son suficientes
         """
-        if not self.llm:
+        if not self.backend:
+            return None
+
+        try:
+            return self._interpretar_extraccion(self.backend.generar(PROMPT_EXTRACCION.format(mensaje=mensaje)))
+        except Exception as e:
+            logger.error("Error extrayendo detalles con LLM: %s", e)
+            return None
+
+    @staticmethod
+    def _interpretar_extraccion(respuesta):
+        respuesta = respuesta.strip()
+
+        # Intentar convertir la respuesta a JSON
+        try:
+            datos = json.loads(respuesta)
+            return datos
+        except json.JSONDecodeError:
+            logger.warning("No se pudo decodificar la respuesta como JSON: %s", respuesta)
+            return None
+
+    def clasificar_y_extraer(self, mensaje):
+        """
+        Clasifica el mensaje y extrae los datos de facturación en una sola llamada al LLM.
+        Evita pagar dos veces el procesamiento del prompt cuando la extracción por
+        expresiones regulares falla.
+
+        Returns:
+            dict: {"intencion": str, "rfc": str o None, "productos": list}
+        """
+        resultado = {"intencion": "otro", "rfc": None, "productos": []}
+        if not mensaje:
+            return resultado
+        # Si los embeddings resuelven una intención sin datos que extraer, no se llama al LLM
+        intencion = self._clasificar_con_embeddings(mensaje)
+        if intencion and intencion != "facturar":
+            resultado["intencion"] = intencion
+            return resultado
+        if not self.backend:
+            resultado["intencion"] = MessageParser.clasificar_intencion(mensaje)
+            return resultado
+
+        try:
+            return self._interpretar_combinado(self.backend.generar(PROMPT_COMBINADO.format(mensaje=mensaje)), resultado)
+        except LLMNoDisponible as e:
+            logger.warning("LLM no disponible, usando clasificador determinista: %s", e)
+            resultado["intencion"] = MessageParser.clasificar_intencion(mensaje)
+            return resultado
+        except Exception as e:
+            logger.error("Error en clasificación combinada: %s", e)
+            return resultado
+
+    @staticmethod
+    def _interpretar_combinado(respuesta, resultado):
+        respuesta = respuesta.strip()
+
+        # Algunos modelos agregan texto alrededor del JSON; tomar solo el objeto
+        inicio, fin = respuesta.find("{"), respuesta.rfind("}")
+        try:
+            datos = json.loads(respuesta[inicio:fin + 1]) if inicio != -1 else None
+        except json.JSONDecodeError:
+            datos = None
+        if not isinstance(datos, dict):
+            logger.warning("No se pudo decodificar la respuesta combinada como JSON: %s", respuesta)
+            return resultado
+
+        intencion = str(datos.get("intencion") or "").strip().lower()
+        if intencion not in CATEGORIAS_VALIDAS:
+            logger.warning("Respuesta inesperada del modelo: %s", intencion)
+            intencion = "otro"
+        resultado["intencion"] = intencion
+
+        rfc = datos.get("rfc")
+        resultado["rfc"] = str(rfc).strip().upper() if rfc else None
+
+        for producto in datos.get("productos") or []:
+            try:
+                resultado["productos"].append({
+                    "nombre": str(producto["nombre"]).strip(),
+                    "cantidad": int(producto.get("cantidad", 1))
+                })
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logger.warning("Producto inválido en respuesta del modelo: %s", producto)
+
+        return resultado
+
+    # Versiones asíncronas para el modo ASGI (ver asgi.py): la llamada al LLM se espera
+    # sin ocupar un hilo. Los embeddings y el micro-batching son síncronos y se
+    # resuelven en el pool de hilos acotado.
+
+    async def clasificar_mensaje_async(self, mensaje):
+        if not mensaje:
+            return "otro"
+        if self.embeddings or self.lotes:
+            return await en_hilo(self.clasificar_mensaje, mensaje)
+        if not self.backend:
+            return MessageParser.clasificar_intencion(mensaje)
+
+        try:
+            return self._interpretar_clasificacion(
+                await self.backend.generar_async(PROMPT_CLASIFICACION.format(mensaje=mensaje))
+            )
+        except LLMNoDisponible as e:
+            logger.warning("LLM no disponible, usando clasificador determinista: %s", e)
+            return MessageParser.clasificar_intencion(mensaje)
+        except Exception as e:
+            logger.error("Error clasificando mensaje: %s", e)
+            return "otro"
+
+    async def extraer_detalles_con_llm_async(self, mensaje):
+        if not self.backend:
             return None
-            
+
         try:
-            prompt = ChatPromptTemplate.from_template(
-                "Extrae la información de facturación del siguiente mensaje. Debes identificar:\n"
-                "1. El RFC del cliente\n"
-                "2. Los productos mencionados y sus cantidades\n\n"
-                "Devuelve tu respuesta en formato JSON con las siguientes propiedades:\n"
-                "- rfc: El RFC mencionado (si existe)\n"
-                "- productos: Lista de objetos, cada uno con 'nombre' y 'cantidad'\n\n"
-                "Mensaje: {mensaje}\n\n"
-                "JSON:"
+            return self._interpretar_extraccion(
+                await self.backend.generar_async(PROMPT_EXTRACCION.format(mensaje=mensaje))
             )
-            chain = LLMChain(llm=self.llm, prompt=prompt)
-            respuesta = chain.run(mensaje=mensaje).strip()
-            
-            # Intentar convertir la respuesta a JSON
-            import json
-            try:
-                datos = json.loads(respuesta)
-                return datos
-            except json.JSONDecodeError:
-                logger.warning(f"No se pudo decodificar la respuesta como JSON: {respuesta}")
-                return None
-                
         except Exception as e:
-            logger.error(f"Error extrayendo detalles con LLM: {e}")
+            logger.error("Error extrayendo detalles con LLM: %s", e)
             return None
-            
+
+    async def clasificar_y_extraer_async(self, mensaje):
+        resultado = {"intencion": "otro", "rfc": None, "productos": []}
+        if not mensaje:
+            return resultado
+        if self.embeddings:
+            return await en_hilo(self.clasificar_y_extraer, mensaje)
+        if not self.backend:
+            resultado["intencion"] = MessageParser.clasificar_intencion(mensaje)
+            return resultado
+
+        try:
+            return self._interpretar_combinado(
+                await self.backend.generar_async(PROMPT_COMBINADO.format(mensaje=mensaje)), resultado
+            )
+        except LLMNoDisponible as e:
+            logger.warning("LLM no disponible, usando clasificador determinista: %s", e)
+            resultado["intencion"] = MessageParser.clasificar_intencion(mensaje)
+            return resultado
+        except Exception as e:
+            logger.error("Error en clasificación combinada: %s", e)
+            return resultado
+
     def generar_respuesta_ayuda(self):
         """
-        Genera un mensaje de ayuda para el usuario
+        Genera un mensaje de ayuda para el usuario (texto fijo, ver respuestas.py)
         """
-        return (
-            "🔍 *Asistente de Facturación* 🔍\n\n"
-            "Puedes realizar las siguientes acciones:\n\n"
-            "📝 *Generar una factura*\n"
-            "Ejemplo: \"Facturar 2 licencias a RFC ABC123456XYZ\"\n"
-            "También puedes facturar varios productos: \"Facturar 2 licencias y 3 servicios a RFC ABC123456XYZ\"\n\n"
-            "📊 *Consultar facturas*\n"
-            "Ejemplo: \"Consultar facturas de RFC ABC123456XYZ\"\n\n"
-            "❓ *Ayuda*\n"
-            "Escribe \"ayuda\" para ver este mensaje\n\n"
-            "📱 *Estado de facturas*\n"
-            "Ejemplo: \"Estado de mi factura para RFC ABC123456XYZ\""
-        )
\ No newline at end of file
+        return respuestas.AYUDA
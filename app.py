@@ -1,40 +1,346 @@
 # app.py
-from flask import Flask, request, send_from_directory
+from flask import Flask, Response, request, send_from_directory, abort
+import cProfile
+import html
+import io
 import logging
+import pstats
 import os
-from twilio_service import TwilioService
-from ai_services import IAService
+import time
 from message_parser import MessageParser
-from document_generator import DocumentGenerator
-from models import get_db_session, Cliente, Factura, Producto, DetalleFactura
+from startup import servicios, estado as estado_arranque, iniciar
+from metricas import etapa, iniciar_solicitud, etapas_actuales
+from captura import obtener_grabador
+from perfilador import obtener_perfilador
+from totales import calcular_totales, formatear_moneda
+from trazas import configurar_logging, correlacion_actual, span, SERVIDOR
+from empresas import empresa_por_numero, usar_empresa
+import respuestas
+import entrega_pdf
 from config import Config
 
-# Configuración de logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configuración de logging (nivel y formato en Config.LOG_NIVEL / Config.LOG_FORMATO)
+configurar_logging()
 logger = logging.getLogger(__name__)
 
-# Inicialización de servicios
-twilio_service = TwilioService()
-ia_service = IAService()
-doc_generator = DocumentGenerator()
+# Los servicios (Twilio, IA, documentos) se crean en el primer uso; ver startup.py
 parser = MessageParser()
 
 # Inicialización de Flask
 app = Flask(__name__)
 
+def detectar_intencion(user_msg):
+    """
+    Clasifica el mensaje con el LLM.
+    En modo combinado (Config.LLM_MODO_COMBINADO) la misma llamada extrae también
+    el RFC y los productos; en el modo de dos llamadas los datos se devuelven como None
+    y se extraen después solo si el análisis con expresiones regulares falla.
+    """
+    if Config.LLM_MODO_COMBINADO:
+        resultado = servicios.ia.clasificar_y_extraer(user_msg)
+        datos_llm = {"rfc": resultado["rfc"], "productos": resultado["productos"]}
+        return resultado["intencion"], datos_llm
+    return servicios.ia.clasificar_mensaje(user_msg), None
+
+def procesar_mensaje(user_msg, sender, respuesta):
+    """
+    Ejecuta el pipeline completo para un mensaje entrante: preprocesamiento,
+    clasificación, extracción, facturación o consulta, y agrega las respuestas a `respuesta`.
+    
+    Args:
+        user_msg (str): Texto del mensaje (en minúsculas)
+        sender (str): Remitente con prefijo "whatsapp:"
+        respuesta (MessagingResponse): Respuesta TwiML a completar
+        
+    Returns:
+        tuple: (mensaje preprocesado, intención detectada)
+    """
+    # Preprocesar el mensaje
+    with etapa("preprocesar"):
+        user_msg = servicios.ia.preprocesar_mensaje(user_msg)
+    logger.debug("Mensaje preprocesado: %s", user_msg)
+
+    # Clasificar intención del mensaje ("ver más" continúa una consulta sin pasar por el LLM)
+    with etapa("clasificar"):
+        continuacion = parser.extraer_continuacion(user_msg)
+        if continuacion:
+            intencion, datos_llm = "consultar", None
+        else:
+            intencion, datos_llm = detectar_intencion(user_msg)
+    logger.info("Intención detectada: %s", intencion)
+    
+    # Procesar según la intención
+    
+    if "facturar" in intencion:
+        # Extraer datos del mensaje
+        with etapa("extraer"):
+            datos = parser.extraer_datos_factura(user_msg)
+            logger.debug("Datos extraídos: %s", datos)
+    
+            # Si la extracción regular falló, intentar con el LLM
+            if not datos['productos'] and not datos['rfc']:
+                if datos_llm is None:
+                    datos_llm = servicios.ia.extraer_detalles_con_llm(user_msg)
+                if datos_llm:
+                    datos = datos_llm
+                    logger.debug("Datos extraídos con LLM: %s", datos)
+    
+        # Validar datos
+        error = validar_datos_factura(datos)
+        if error:
+            respuesta.message(error)
+        else:
+            factura = emitir_factura(datos)
+            if not factura:
+                respuesta.message(MENSAJE_ERROR_PDF)
+            else:
+                # Enviar factura
+                logger.info("Enviando PDF: %s", factura["pdf_path"])
+                with etapa("envio"):
+                    enviado = servicios.twilio.enviar_factura(factura["pdf_path"], sender)
+                respuesta.message(mensaje_envio(datos, factura, enviado))
+
+    elif "consultar" in intencion:
+        # Extraer RFC para consulta
+        datos = continuacion or parser.extraer_datos_consulta(user_msg)
+        logger.debug("Datos de consulta: %s", datos)
+        
+        error = validar_datos_consulta(datos)
+        if error:
+            respuesta.message(error)
+        else:
+            # Consultar facturas en la base de datos
+            with etapa("consulta"):
+                consultar_facturas(datos["rfc"], respuesta, datos.get("despues_de", 0), datos.get("numero", 0))
+
+    else:
+        respuesta.message(respuesta_simple(intencion))
+    
+    return user_msg, intencion
+
+MENSAJE_ERROR_PDF = "❌ Ocurrió un error al generar la factura. Intenta nuevamente más tarde."
+
+def validar_datos_factura(datos):
+    """Mensaje de error para el usuario si faltan datos o el RFC no es válido; None si se puede facturar"""
+    if not datos['rfc']:
+        return "⚠️ No pude identificar el RFC en tu solicitud. Por favor, incluye el RFC en tu mensaje."
+    if not datos['productos'] or len(datos['productos']) == 0:
+        return "⚠️ No pude identificar productos en tu solicitud. Por favor, especifica los productos y cantidades."
+    if not parser.validar_rfc(datos['rfc']):
+        return "⚠️ El RFC proporcionado no tiene un formato válido. Un RFC debe tener 12 caracteres para personas morales o 13 para personas físicas, y terminar en su dígito verificador."
+    return None
+
+def validar_datos_consulta(datos):
+    """Mensaje de error para el usuario si falta el RFC o no es válido; None si se puede consultar"""
+    if not datos['rfc']:
+        return ("⚠️ Por favor, especifica el RFC para consultar facturas.\n"
+                "Ejemplo: \"Consultar facturas de RFC EKU9003173C9\"")
+    if not parser.validar_rfc(datos['rfc']):
+        return "⚠️ El RFC proporcionado no tiene un formato válido. Verifica e intenta nuevamente."
+    return None
+
+def emitir_factura(datos):
+    """
+    Calcula los importes, genera el PDF, guarda la factura y, si está activo, emite el CFDI.
+    Todo es CPU o base de datos: el modo ASGI lo ejecuta en su pool de hilos.
+    
+    Returns:
+        dict: {"totales", "pdf_path", "factura_id", "cfdi"} o None si no se pudo generar el PDF
+    """
+    # Obtener precios y calcular los importes una sola vez (PDF, base de datos y respuesta)
+    from producto_service import ProductoService
+    with etapa("precios"):
+        encontrados = ProductoService.obtener_productos(datos['productos'])
+        precios = ProductoService.obtener_precios_productos(datos['productos'], encontrados)
+        totales = calcular_totales(datos['productos'], precios)
+    
+    # Generar factura con múltiples productos
+    with etapa("pdf"):
+        pdf_path = servicios.documentos.generar_factura(datos["rfc"], totales)
+    if not pdf_path:
+        return None
+    
+    # Guardar información en la base de datos
+    with etapa("db"):
+        factura_id = guardar_factura(datos["rfc"], totales, pdf_path, encontrados)
+    
+    # Generar y timbrar el CFDI de la factura guardada
+    cfdi = None
+    if Config.CFDI_ACTIVO and factura_id:
+        from cfdi import emitir_cfdi, emitir_cfdi_en_segundo_plano
+        if Config.CFDI_TIMBRADO_DIFERIDO:
+            emitir_cfdi_en_segundo_plano(factura_id)
+        else:
+            with etapa("cfdi"):
+                cfdi = emitir_cfdi(factura_id)
+    return {"totales": totales, "pdf_path": pdf_path, "factura_id": factura_id, "cfdi": cfdi}
+
+def mensaje_envio(datos, factura, enviado):
+    """Respuesta al usuario después de intentar enviar el PDF"""
+    if not enviado:
+        return "⚠️ La factura se generó pero no se pudo enviar el PDF. Intenta nuevamente más tarde."
+    cfdi = factura["cfdi"]
+    return formatear_resumen_factura(datos["rfc"], factura["totales"], cfdi and cfdi["uuid"])
+
+def respuesta_simple(intencion):
+    """Respuesta de las intenciones que no consultan servicios (ayuda, estado, otro)"""
+    if "ayuda" in intencion:
+        # Enviar mensaje de ayuda
+        return servicios.ia.generar_respuesta_ayuda()
+    if "estado" in intencion:
+        # Por ahora, dar una respuesta genérica para estado
+        return respuestas.ESTADO_EN_DESARROLLO
+    # Respuesta para mensajes no reconocidos
+    return respuestas.NO_ENTENDIDO
+
+def formatear_resumen_factura(rfc, totales, folio_fiscal=None):
+    """Mensaje de confirmación con el detalle de productos e importes de la factura"""
+    detalle_productos = "\n".join(
+        f"• {linea.cantidad} x {linea.nombre}: {formatear_moneda(linea.importe)}" for linea in totales.lineas
+    )
+    return (f"✅ Factura generada para RFC {rfc}\n\n"
+            f"{detalle_productos}\n\n"
+            f"Subtotal: {formatear_moneda(totales.subtotal)}\n"
+            f"IVA ({totales.porcentaje_iva}%): {formatear_moneda(totales.iva)}\n"
+            f"*Total: {formatear_moneda(totales.total)}*"
+            + (f"\nFolio fiscal: {folio_fiscal}" if folio_fiscal else ""))
+
+def guardar_factura(rfc, totales, pdf_path, encontrados=None):
+    """
+    Guarda el cliente (si es nuevo), la cabecera de la factura y sus detalles.
+    Los errores se registran y la transacción se revierte sin interrumpir el envío.
+    El catálogo no se modifica: un concepto sin producto del catálogo se guarda en su
+    detalle (descripción y precio) sin producto_id.
+    
+    Args:
+        encontrados (dict, optional): {nombre en minúsculas: Producto o None}, de
+            ProductoService.obtener_productos
+    
+    Returns:
+        int: Id de la factura guardada, o None si hubo un error
+    """
+    from models import get_db_session, Cliente, Factura, DetalleFactura
+    from cliente_service import ClienteService
+    
+    db_session = get_db_session()
+    try:
+        # Buscar o crear cliente (un RFC "sin cliente" en caché se vuelve a consultar)
+        cliente_id = ClienteService.obtener_id(db_session, rfc, negativos=False)
+        cliente_nuevo = cliente_id is None
+        if cliente_nuevo:
+            cliente = Cliente(rfc=rfc, nombre="Cliente " + rfc)
+            db_session.add(cliente)
+            db_session.flush()
+            cliente_id = cliente.id
+        
+        # Crear registro de factura (cabecera)
+        factura = Factura(
+            cliente_id=cliente_id,
+            producto=", ".join([f"{l.cantidad} {l.nombre}" for l in totales.lineas]),
+            cantidad=totales.cantidad_total,
+            precio_unitario=0,  # Ya no relevante para múltiples productos
+            subtotal=totales.subtotal,
+            iva=totales.iva,
+            total=totales.total,
+            ruta_pdf=pdf_path
+        )
+        db_session.add(factura)
+        db_session.flush()
+        
+        # Crear registros de detalle para cada producto
+        encontrados = encontrados or {}
+        for linea in totales.lineas:
+            producto = encontrados.get(linea.nombre.lower())
+            detalle = DetalleFactura(
+                factura_id=factura.id,
+                producto_id=producto.id if producto else None,
+                descripcion=linea.nombre[:100],
+                cantidad=linea.cantidad,
+                precio_unitario=linea.precio_unitario,
+                subtotal=linea.importe,
+                iva=linea.iva
+            )
+            db_session.add(detalle)
+        
+        db_session.commit()
+        if cliente_nuevo:
+            ClienteService.registrar(rfc, cliente_id)
+        return factura.id
+    except Exception as e:
+        logger.error("Error guardando en DB: %s", e)
+        db_session.rollback()
+        return None
+    finally:
+        db_session.close()
+
+def consultar_facturas(rfc, respuesta, despues_de=0, numero=0):
+    """
+    Agrega a `respuesta` el listado de facturas emitidas al RFC, en uno o varios mensajes.
+    Cada respuesta lee solo las facturas que caben en ella (ver respuestas.py); el
+    token "ver más" vuelve a llamar con `despues_de` (id de la última mostrada) y
+    `numero` (cuántas se han mostrado).
+    """
+    from models import get_db_session, Factura
+    from cliente_service import ClienteService
+    
+    # Las consultas se atienden desde la réplica de lectura
+    db_session = get_db_session(lectura=True)
+    try:
+        cliente_id = ClienteService.obtener_id(db_session, rfc)
+        
+        if cliente_id is None:
+            respuesta.message(f"📝 No se encontraron registros para el RFC {rfc}")
+        else:
+            filas = db_session.query(
+                Factura.id, Factura.producto, Factura.cantidad, Factura.total, Factura.fecha_emision
+            ).filter(
+                Factura.cliente_id == cliente_id, Factura.id > despues_de
+            ).order_by(Factura.id).limit(respuestas.filas_por_pagina())
+            
+            mensajes = respuestas.listado_facturas(rfc, filas, numero)
+            if not mensajes:
+                respuesta.message(respuestas.sin_mas_facturas(rfc) if numero else
+                                  f"📝 El cliente con RFC {rfc} está registrado pero no tiene facturas emitidas.")
+            for mensaje in mensajes:
+                respuesta.message(mensaje)
+    except Exception as e:
+        logger.error("Error consultando facturas: %s", e)
+        respuesta.message("❌ Ocurrió un error al consultar las facturas. Intenta nuevamente más tarde.")
+    finally:
+        db_session.close()
+
 # Ruta para servir archivos estáticos
 @app.route('/static/<path:filename>')
 def serve_static(filename):
     return send_from_directory(Config.UPLOAD_FOLDER, filename)
 
+# Ruta de los enlaces firmados de PDF (Config.PDF_ENTREGA_MEMORIA)
+@app.route("/pdf/<token>")
+def entregar_pdf(token):
+    ruta = entrega_pdf.verificar(token)
+    if ruta is None:
+        abort(404)
+    entrega = entrega_pdf.obtener_entrega_pdf()
+    contenido = entrega.obtener(ruta) if entrega else None
+    if contenido is None:
+        # Lo generó otro worker o ya salió de memoria: se sirve desde disco
+        return send_from_directory(Config.UPLOAD_FOLDER, ruta, mimetype="application/pdf")
+    return Response(contenido, mimetype="application/pdf")
+
 # Ruta para recibir mensajes de WhatsApp
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    inicio = time.time()
+    # El MessageSid de Twilio es el id de correlación de todos los logs y spans de la solicitud
+    iniciar_solicitud(request.form.get("MessageSid"))
+    # La empresa (base, catálogo, plantilla, límite) es la del número que recibió el mensaje
+    empresa = empresa_por_numero(request.form.get("To", ""))
+    if empresa is None:
+        capturar_solicitud(inicio, 403)
+        return "Número receptor no registrado", 403
+    usar_empresa(empresa)
     logger.info("=== NUEVA SOLICITUD ===")
-    logger.debug(f"Datos recibidos: {request.form}")
+    logger.debug("Datos recibidos: %s", request.form)
     
     # Obtener mensaje y remitente
     user_msg = request.form.get("Body", "").lower()
@@ -42,187 +348,104 @@ def webhook():
     
     # Validar que sea un mensaje de WhatsApp
     if not sender.startswith('whatsapp:'):
-        logger.warning(f"Remitente no válido: {sender}")
+        logger.warning("Remitente no válido: %s", sender)
+        capturar_solicitud(inicio, 400)
         return "Remitente no válido", 400
 
     # Crear respuesta de Twilio
-    respuesta = twilio_service.crear_respuesta()
-    
-    try:
-        # Preprocesar el mensaje
-        user_msg = ia_service.preprocesar_mensaje(user_msg)
-        logger.info(f"Mensaje preprocesado: {user_msg}")
-
-        # Clasificar intención del mensaje
-        intencion = ia_service.clasificar_mensaje(user_msg)
-        logger.info(f"Intención detectada: {intencion}")
-        
-        # Procesar según la intención
-        
-        if "facturar" in intencion:
-            # Extraer datos del mensaje
-            datos = parser.extraer_datos_factura(user_msg)
-            logger.info(f"Datos extraídos: {datos}")
-        
-            # Si la extracción regular falló, intentar con el LLM
-            if not datos['productos'] and not datos['rfc']:
-                datos_llm = ia_service.extraer_detalles_con_llm(user_msg)
-                if datos_llm:
-                    datos = datos_llm
-                    logger.info(f"Datos extraídos con LLM: {datos}")
-        
-            # Validar datos
-            if not datos['rfc']:
-                respuesta.message("⚠️ No pude identificar el RFC en tu solicitud. Por favor, incluye el RFC en tu mensaje.")
-            elif not datos['productos'] or len(datos['productos']) == 0:
-                respuesta.message("⚠️ No pude identificar productos en tu solicitud. Por favor, especifica los productos y cantidades.")
-            elif not parser.validar_rfc(datos['rfc']):
-                respuesta.message("⚠️ El RFC proporcionado no tiene un formato válido. Un RFC debe tener 12 caracteres para personas morales o 13 para personas físicas.")
-            else:
-                # Obtener precios de los productos
-                from producto_service import ProductoService
-                precios = ProductoService.obtener_precios_productos(datos['productos'])
-                
-                # Generar factura con múltiples productos
-                pdf_path = doc_generator.generar_factura(
-                    datos["rfc"], 
-                    datos["productos"],
-                    precios
-                )
-                
-                if pdf_path:
-                    # Guardar información en la base de datos
-                    try:
-                        db_session = get_db_session()
-                        
-                        # Buscar o crear cliente
-                        cliente = db_session.query(Cliente).filter_by(rfc=datos["rfc"]).first()
-                        if not cliente:
-                            cliente = Cliente(rfc=datos["rfc"], nombre="Cliente " + datos["rfc"])
-                            db_session.add(cliente)
-                            db_session.flush()
-                        
-                        # Crear registro de factura (cabecera)
-                        total_factura = sum(item['cantidad'] * precios.get(item['nombre'].lower(), 100.0) for item in datos['productos'])
-                        
-                        factura = Factura(
-                            cliente_id=cliente.id,
-                            producto=", ".join([f"{p['cantidad']} {p['nombre']}" for p in datos['productos']]),
-                            cantidad=sum(p['cantidad'] for p in datos['productos']),
-                            precio_unitario=0.0,  # Ya no relevante para múltiples productos
-                            total=total_factura,
-                            ruta_pdf=pdf_path
-                        )
-                        db_session.add(factura)
-                        db_session.flush()
-                        
-                        # Crear registros de detalle para cada producto
-                        for item in datos['productos']:
-                            nombre_producto = item['nombre']
-                            cantidad = item['cantidad']
-                            precio = precios.get(nombre_producto.lower(), 100.0)
-                            
-                            # Buscar producto en la BD o crear uno nuevo
-                            producto = db_session.query(Producto).filter(Producto.nombre.ilike(f"%{nombre_producto}%")).first()
-                            if not producto:
-                                producto = Producto(
-                                    codigo=nombre_producto[:10].upper(),
-                                    nombre=nombre_producto,
-                                    precio=precio
-                                )
-                                db_session.add(producto)
-                                db_session.flush()
-                            
-                            # Crear detalle de factura
-                            detalle = DetalleFactura(
-                                factura_id=factura.id,
-                                producto_id=producto.id,
-                                cantidad=cantidad,
-                                precio_unitario=precio,
-                                subtotal=cantidad * precio
-                            )
-                            db_session.add(detalle)
-                        
-                        db_session.commit()
-                    except Exception as e:
-                        logger.error(f"Error guardando en DB: {e}")
-                        db_session.rollback()
-                    
-                    # Enviar factura
-                    logger.info(f"Enviando PDF: {pdf_path}")
-                    if twilio_service.enviar_factura(pdf_path, sender):
-                        # Formar detalle de productos para el mensaje
-                        detalle_productos = ""
-                        for p in datos['productos']:
-                            precio = precios.get(p['nombre'].lower(), 100.0)
-                            subtotal = precio * p['cantidad']
-
-        
-        elif "consultar" in intencion:
-            # Extraer RFC para consulta
-            datos = parser.extraer_datos_consulta(user_msg)
-            logger.info(f"Datos de consulta: {datos}")
-            
-            if not datos['rfc']:
-                respuesta.message("⚠️ Por favor, especifica el RFC para consultar facturas.\n"
-                                 "Ejemplo: \"Consultar facturas de RFC ABC123456XYZ\"")
-            elif not parser.validar_rfc(datos['rfc']):
-                respuesta.message("⚠️ El RFC proporcionado no tiene un formato válido. Verifica e intenta nuevamente.")
-            else:
-                # Consultar facturas en la base de datos
-                try:
-                    db_session = get_db_session()
-                    cliente = db_session.query(Cliente).filter_by(rfc=datos["rfc"]).first()
-                    
-                    if not cliente:
-                        respuesta.message(f"📝 No se encontraron registros para el RFC {datos['rfc']}")
-                    else:
-                        facturas = db_session.query(Factura).filter_by(cliente_id=cliente.id).all()
-                        
-                        if not facturas:
-                            respuesta.message(f"📝 El cliente con RFC {datos['rfc']} está registrado pero no tiene facturas emitidas.")
-                        else:
-                            # Formatear la respuesta
-                            mensaje = f"📊 *Facturas encontradas para RFC {datos['rfc']}*\n\n"
-                            
-                            for i, factura in enumerate(facturas, 1):
-                                fecha = factura.fecha_emision.strftime("%d/%m/%Y")
-                                mensaje += f"*{i}.* {factura.producto} ({factura.cantidad}) - ${factura.total:.2f} - {fecha}\n"
-                            
-                            respuesta.message(mensaje)
-                except Exception as e:
-                    logger.error(f"Error consultando facturas: {e}")
-                    respuesta.message("❌ Ocurrió un error al consultar las facturas. Intenta nuevamente más tarde.")
-        
-
-        elif "ayuda" in intencion:
-            # Enviar mensaje de ayuda
-            respuesta.message(ia_service.generar_respuesta_ayuda())
-
-
-        elif "estado" in intencion:
-            # Por ahora, dar una respuesta genérica para estado
-            respuesta.message("🔍 El sistema de consulta de estado de facturas está en desarrollo. Próximamente podrás consultar el estado de tus trámites.")
+    respuesta = servicios.twilio.crear_respuesta()
+    if not empresa.permite_mensaje():
+        # El límite es por empresa: una empresa con mucho tráfico no frena a las demás
+        logger.warning("Límite de mensajes por minuto alcanzado para la empresa %s", empresa.id)
+        respuesta.message("⏳ Estamos recibiendo muchos mensajes. Por favor, intenta nuevamente en un minuto.")
+        capturar_solicitud(inicio, 200)
+        return str(respuesta)
+    perfilador = obtener_perfilador()
+    intencion = None
+    if perfilador:
+        perfilador.iniciar()
 
+    try:
+        with span("webhook", SERVIDOR, {"messaging.system": "twilio", "correlacion": correlacion_actual(),
+                                         "facturacion.empresa": empresa.id}) as raiz:
+            _, intencion = procesar_mensaje(user_msg, sender, respuesta)
+            raiz.atributo("facturacion.intencion", intencion)
 
-        else:
-            # Respuesta para mensajes no reconocidos
-            respuesta.message("🤖 No he entendido tu mensaje. Puedes escribir *ayuda* para ver las opciones disponibles.")
-            
     except Exception as e:
-        logger.error(f"Error crítico: {str(e)}")
+        logger.error("Error crítico: %s", e)
         respuesta.message("⚠️ Ha ocurrido un error inesperado. Por favor, intenta nuevamente más tarde o contacta a soporte técnico.")
-    
+
+    finally:
+        if perfilador:
+            # No se guarda el texto del mensaje, solo la intención y los tiempos por etapa
+            perfilador.finalizar(
+                (time.time() - inicio) * 1000,
+                intencion=intencion,
+                correlacion=correlacion_actual(),
+                etapas={k: round(v, 1) for k, v in (etapas_actuales() or {}).items()}
+            )
+
+    capturar_solicitud(inicio, 200)
     return str(respuesta)
 
+def capturar_solicitud(inicio, status, formulario=None):
+    """Registra la solicitud actual (o `formulario`, en modo ASGI) en la captura de tráfico, si está activa"""
+    grabador = obtener_grabador()
+    if grabador:
+        formulario = request.form if formulario is None else formulario
+        grabador.registrar(
+            inicio,
+            formulario.get("Body", ""),
+            formulario.get("From", ""),
+            (time.time() - inicio) * 1000,
+            status,
+            formulario.get("To", "")
+        )
+
 
 
 # Ruta para verificar estado del servicio
 @app.route("/health", methods=["GET"])
 def health_check():
-    return {"status": "ok", "version": "1.0.0"}
+    # Si el worker no pasó por el hook post_fork, el calentamiento empieza aquí
+    iniciar()
+    estado = {"status": "ok" if estado_arranque.listo else "starting", "version": "1.0.0"}
+    estado.update(estado_arranque.como_dict())
+    if not estado_arranque.listo:
+        return estado, 503
+    if servicios.ia.lotes:
+        estado["lotes_llm"] = servicios.ia.lotes.metricas()
+    entrega = entrega_pdf.obtener_entrega_pdf()
+    if entrega:
+        estado["entrega_pdf"] = entrega.metricas()
+    return estado
+
+
+def validar_admin():
+    """Los endpoints /admin requieren Config.ADMIN_TOKEN en la cabecera X-Admin-Token"""
+    if not Config.ADMIN_TOKEN or request.headers.get("X-Admin-Token") != Config.ADMIN_TOKEN:
+        abort(404)
 
 
+# Solicitudes lentas registradas por el perfilador
+@app.route("/admin/perfil", methods=["GET"])
+def admin_perfil():
+    validar_admin()
+    perfilador = obtener_perfilador()
+    if not perfilador:
+        return {"activo": False, "solicitudes": []}
+    return {"activo": True, "umbral_ms": perfilador.umbral_ms, "solicitudes": perfilador.resumen()}
+
+
+# Pilas plegadas para flamegraph.pl / speedscope (?id=N para una sola solicitud)
+@app.route("/admin/perfil/flamegraph", methods=["GET"])
+def admin_flamegraph():
+    validar_admin()
+    perfilador = obtener_perfilador()
+    if not perfilador:
+        abort(404)
+    return perfilador.plegado(request.args.get("id", type=int)), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
 
 # Ruta para simular un mensaje de WhatsApp (para pruebas)
 @app.route("/test/webhook", methods=["GET", "POST"])
@@ -262,10 +485,17 @@ def test_webhook():
                     <label for="Body">Mensaje:</label>
                     <textarea name="Body" id="messageInput" rows="3" required placeholder="Ej: Facturar 2 remeras a RFC ASDD121212ASD"></textarea>
                 </div>
+                <div class="form-group">
+                    <label><input type="checkbox" name="perfil" value="1" style="width: auto;"> Perfilar con cProfile</label>
+                </div>
                 <div class="form-group">
                     <label for="From">Número de WhatsApp (con whatsapp: prefijo):</label>
                     <input type="text" name="From" required value="whatsapp:+5491112345678">
                 </div>
+                <div class="form-group">
+                    <label for="To">Número receptor (vacío: empresa principal):</label>
+                    <input type="text" name="To" placeholder="whatsapp:+14155238886">
+                </div>
                 <button type="submit">Enviar</button>
             </form>
             
@@ -295,6 +525,11 @@ def test_webhook():
         """
     
     # Si es POST, procesar como si fuera una solicitud de Twilio
+    iniciar_solicitud(request.form.get("MessageSid"))
+    empresa = empresa_por_numero(request.form.get("To", ""))
+    if empresa is None:
+        return "Número receptor no registrado", 403
+    usar_empresa(empresa)
     logger.info("=== NUEVA SOLICITUD DE PRUEBA ===")
     
     # Obtener datos del formulario
@@ -303,170 +538,32 @@ def test_webhook():
     
     # Validar que sea un mensaje de WhatsApp
     if not sender.startswith('whatsapp:'):
-        logger.warning(f"Remitente no válido: {sender}")
+        logger.warning("Remitente no válido: %s", sender)
         return "Remitente no válido", 400
 
     # Crear respuesta de Twilio
-    respuesta = twilio_service.crear_respuesta()
+    respuesta = servicios.twilio.crear_respuesta()
     
     try:
-        # Preprocesar el mensaje
-        user_msg = ia_service.preprocesar_mensaje(user_msg)
-        logger.info(f"Mensaje preprocesado: {user_msg}")
-
-        # Clasificar intención del mensaje
-        intencion = ia_service.clasificar_mensaje(user_msg)
-        logger.info(f"Intención detectada: {intencion}")
-        
-        # Procesar según la intención
-        
-        if "facturar" in intencion:
-            # Extraer datos del mensaje
-            datos = parser.extraer_datos_factura(user_msg)
-            logger.info(f"Datos extraídos: {datos}")
-        
-            # Si la extracción regular falló, intentar con el LLM
-            if not datos['productos'] and not datos['rfc']:
-                datos_llm = ia_service.extraer_detalles_con_llm(user_msg)
-                if datos_llm:
-                    datos = datos_llm
-                    logger.info(f"Datos extraídos con LLM: {datos}")
-        
-            # Validar datos
-            if not datos['rfc']:
-                respuesta.message("⚠️ No pude identificar el RFC en tu solicitud. Por favor, incluye el RFC en tu mensaje.")
-            elif not datos['productos'] or len(datos['productos']) == 0:
-                respuesta.message("⚠️ No pude identificar productos en tu solicitud. Por favor, especifica los productos y cantidades.")
-            elif not parser.validar_rfc(datos['rfc']):
-                respuesta.message("⚠️ El RFC proporcionado no tiene un formato válido. Un RFC debe tener 12 caracteres para personas morales o 13 para personas físicas.")
-            else:
-                # Obtener precios de los productos
-                from producto_service import ProductoService
-                precios = ProductoService.obtener_precios_productos(datos['productos'])
-                
-                # Generar factura con múltiples productos
-                pdf_path = doc_generator.generar_factura(
-                    datos["rfc"], 
-                    datos["productos"],
-                    precios
-                )
-                
-                if pdf_path:
-                    # Guardar información en la base de datos
-                    try:
-                        db_session = get_db_session()
-                        
-                        # Buscar o crear cliente
-                        cliente = db_session.query(Cliente).filter_by(rfc=datos["rfc"]).first()
-                        if not cliente:
-                            cliente = Cliente(rfc=datos["rfc"], nombre="Cliente " + datos["rfc"])
-                            db_session.add(cliente)
-                            db_session.flush()
-                        
-                        # Crear registro de factura (cabecera)
-                        total_factura = sum(item['cantidad'] * precios.get(item['nombre'].lower(), 100.0) for item in datos['productos'])
-                        
-                        factura = Factura(
-                            cliente_id=cliente.id,
-                            producto=", ".join([f"{p['cantidad']} {p['nombre']}" for p in datos['productos']]),
-                            cantidad=sum(p['cantidad'] for p in datos['productos']),
-                            precio_unitario=0.0,  # Ya no relevante para múltiples productos
-                            total=total_factura,
-                            ruta_pdf=pdf_path
-                        )
-                        db_session.add(factura)
-                        db_session.flush()
-                        
-                        # Crear registros de detalle para cada producto
-                        for item in datos['productos']:
-                            nombre_producto = item['nombre']
-                            cantidad = item['cantidad']
-                            precio = precios.get(nombre_producto.lower(), 100.0)
-                            
-                            # Buscar producto en la BD o crear uno nuevo
-                            producto = db_session.query(Producto).filter(Producto.nombre.ilike(f"%{nombre_producto}%")).first()
-                            if not producto:
-                                producto = Producto(
-                                    codigo=nombre_producto[:10].upper(),
-                                    nombre=nombre_producto,
-                                    precio=precio
-                                )
-                                db_session.add(producto)
-                                db_session.flush()
-                            
-                            # Crear detalle de factura
-                            detalle = DetalleFactura(
-                                factura_id=factura.id,
-                                producto_id=producto.id,
-                                cantidad=cantidad,
-                                precio_unitario=precio,
-                                subtotal=cantidad * precio
-                            )
-                            db_session.add(detalle)
-                        
-                        db_session.commit()
-                    except Exception as e:
-                        logger.error(f"Error guardando en DB: {e}")
-                        db_session.rollback()
-                    
-                    # Enviar factura
-                    logger.info(f"Enviando PDF: {pdf_path}")
-                    if twilio_service.enviar_factura(pdf_path, sender):
-                        # Formar detalle de productos para el mensaje
-                        detalle_productos = ""
-                        for p in datos['productos']:
-                            precio = precios.get(p['nombre'].lower(), 100.0)
-                            subtotal = precio * p['cantidad']
-
-        
-        elif "consultar" in intencion:
-            # Extraer RFC para consulta
-            datos = parser.extraer_datos_consulta(user_msg)
-            logger.info(f"Datos de consulta: {datos}")
-            
-            if not datos['rfc']:
-                respuesta.message("⚠️ Por favor, especifica el RFC para consultar facturas.\n"
-                                 "Ejemplo: \"Consultar facturas de RFC ABC123456XYZ\"")
-            elif not parser.validar_rfc(datos['rfc']):
-                respuesta.message("⚠️ El RFC proporcionado no tiene un formato válido. Verifica e intenta nuevamente.")
-            else:
-                # Consultar facturas en la base de datos
-                try:
-                    db_session = get_db_session()
-                    cliente = db_session.query(Cliente).filter_by(rfc=datos["rfc"]).first()
-                    
-                    if not cliente:
-                        respuesta.message(f"📝 No se encontraron registros para el RFC {datos['rfc']}")
-                    else:
-                        facturas = db_session.query(Factura).filter_by(cliente_id=cliente.id).all()
-                        
-                        if not facturas:
-                            respuesta.message(f"📝 El cliente con RFC {datos['rfc']} está registrado pero no tiene facturas emitidas.")
-                        else:
-                            # Formatear la respuesta
-                            mensaje = f"📊 *Facturas encontradas para RFC {datos['rfc']}*\n\n"
-                            
-                            for i, factura in enumerate(facturas, 1):
-                                fecha = factura.fecha_emision.strftime("%d/%m/%Y")
-                                mensaje += f"*{i}.* {factura.producto} ({factura.cantidad}) - ${factura.total:.2f} - {fecha}\n"
-                            
-                            respuesta.message(mensaje)
-                except Exception as e:
-                    logger.error(f"Error consultando facturas: {e}")
-                    respuesta.message("❌ Ocurrió un error al consultar las facturas. Intenta nuevamente más tarde.")
-        
-
-        elif "ayuda" in intencion:
-            # Enviar mensaje de ayuda
-            respuesta.message(ia_service.generar_respuesta_ayuda())
-
-
-        elif "estado" in intencion:
-            # Por ahora, dar una respuesta genérica para estado
-            respuesta.message("🔍 El sistema de consulta de estado de facturas está en desarrollo. Próximamente podrás consultar el estado de tus trámites.")
-    
-
-
+        # cProfile solo en modo prueba: su sobrecarga no es aceptable en producción
+        perfil = cProfile.Profile() if Config.TEST_MODE and request.form.get("perfil") == "1" else None
+        if perfil:
+            perfil.enable()
+        try:
+            with span("test.webhook", SERVIDOR, {"correlacion": correlacion_actual(), "facturacion.empresa": empresa.id}):
+                user_msg, intencion = procesar_mensaje(user_msg, sender, respuesta)
+        finally:
+            if perfil:
+                perfil.disable()
+        perfil_html = ""
+        if perfil:
+            salida = io.StringIO()
+            pstats.Stats(perfil, stream=salida).sort_stats("cumulative").print_stats(30)
+            perfil_html = f"""
+            <div class="twiml">
+                <h3>cProfile (30 funciones con mayor tiempo acumulado):</h3>
+                {html.escape(salida.getvalue())}
+            </div>"""
 
         # Convertir la respuesta TwiML a HTML para mostrarla en el navegador
         twiml_response = str(respuesta)
@@ -509,6 +606,7 @@ def test_webhook():
                 <h3>TwiML Generado:</h3>
                 {twiml_response}
             </div>
+            {perfil_html}
             
             <div class="pdf-link">
                 <p>Si se generó una factura, puedes verla en la carpeta <strong>{Config.UPLOAD_FOLDER}</strong>.</p>
@@ -519,7 +617,7 @@ def test_webhook():
         return html_response
         
     except Exception as e:
-        logger.error(f"Error en prueba: {str(e)}")
+        logger.error("Error en prueba: %s", e)
         return f"Error: {str(e)}", 500
 
 # Ruta para ver archivos generados
@@ -529,4 +627,5 @@ def ver_archivo(filename):
     return send_from_directory(Config.UPLOAD_FOLDER, filename)
 
 if __name__ == "__main__":
+    iniciar()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
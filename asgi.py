@@ -0,0 +1,274 @@
+# asgi.py
+"""
+Modo ASGI: el webhook se atiende con un pipeline asíncrono en el que las esperas
+al LLM (ollama.AsyncClient) y a Twilio (AsyncTwilioHttpClient) no ocupan hilos, y la
+base de datos, el PDF y el CFDI se ejecutan en un pool de hilos acotado
+(Config.ASYNC_HILOS). Un proceso puede tener cientos de mensajes en curso.
+
+Los PDFs en memoria (/pdf, ver entrega_pdf.py) se sirven directamente desde el event loop.
+Las demás rutas (/health, /static, /test/webhook, /admin) se delegan a la aplicación
+Flask en el mismo pool, así que responden exactamente igual que con gunicorn.
+El perfilador por muestreo (perfilador.py) muestrea hilos y no se usa en este modo.
+
+Uso:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+"""
+import io
+import logging
+import sys
+import time
+from urllib.parse import parse_qsl
+from app import (app as aplicacion_wsgi, parser, servicios, capturar_solicitud, validar_datos_factura,
+                 validar_datos_consulta, emitir_factura, mensaje_envio, respuesta_simple,
+                 consultar_facturas, MENSAJE_ERROR_PDF)
+from captura import obtener_grabador
+import entrega_pdf
+from config import Config
+from empresas import empresa_por_numero, usar_empresa
+from metricas import etapa, iniciar_solicitud
+from startup import en_hilo, iniciar
+from trazas import correlacion_actual, span, SERVIDOR
+
+logger = logging.getLogger(__name__)
+
+
+async def detectar_intencion_async(user_msg):
+    """Versión asíncrona de app.detectar_intencion"""
+    if Config.LLM_MODO_COMBINADO:
+        resultado = await servicios.ia.clasificar_y_extraer_async(user_msg)
+        datos_llm = {"rfc": resultado["rfc"], "productos": resultado["productos"]}
+        return resultado["intencion"], datos_llm
+    return await servicios.ia.clasificar_mensaje_async(user_msg), None
+
+
+async def procesar_mensaje_async(user_msg, sender, respuesta):
+    """
+    Mismo pipeline que app.procesar_mensaje (mismas etapas, validaciones y respuestas),
+    esperando al LLM y a Twilio de forma asíncrona.
+
+    Returns:
+        tuple: (mensaje preprocesado, intención detectada)
+    """
+    with etapa("preprocesar"):
+        user_msg = servicios.ia.preprocesar_mensaje(user_msg)
+    logger.debug("Mensaje preprocesado: %s", user_msg)
+
+    with etapa("clasificar"):
+        continuacion = parser.extraer_continuacion(user_msg)
+        if continuacion:
+            intencion, datos_llm = "consultar", None
+        else:
+            intencion, datos_llm = await detectar_intencion_async(user_msg)
+    logger.info("Intención detectada: %s", intencion)
+
+    if "facturar" in intencion:
+        with etapa("extraer"):
+            datos = parser.extraer_datos_factura(user_msg)
+            logger.debug("Datos extraídos: %s", datos)
+            if not datos['productos'] and not datos['rfc']:
+                if datos_llm is None:
+                    datos_llm = await servicios.ia.extraer_detalles_con_llm_async(user_msg)
+                if datos_llm:
+                    datos = datos_llm
+                    logger.debug("Datos extraídos con LLM: %s", datos)
+
+        error = validar_datos_factura(datos)
+        if error:
+            respuesta.message(error)
+        else:
+            factura = await en_hilo(emitir_factura, datos)
+            if not factura:
+                respuesta.message(MENSAJE_ERROR_PDF)
+            else:
+                logger.info("Enviando PDF: %s", factura["pdf_path"])
+                with etapa("envio"):
+                    enviado = await servicios.twilio.enviar_factura_async(factura["pdf_path"], sender)
+                respuesta.message(mensaje_envio(datos, factura, enviado))
+
+    elif "consultar" in intencion:
+        datos = continuacion or parser.extraer_datos_consulta(user_msg)
+        logger.debug("Datos de consulta: %s", datos)
+        error = validar_datos_consulta(datos)
+        if error:
+            respuesta.message(error)
+        else:
+            with etapa("consulta"):
+                await en_hilo(consultar_facturas, datos["rfc"], respuesta,
+                              datos.get("despues_de", 0), datos.get("numero", 0))
+
+    else:
+        respuesta.message(respuesta_simple(intencion))
+
+    return user_msg, intencion
+
+
+async def webhook_async(formulario):
+    """
+    Equivalente asíncrono de app.webhook.
+
+    Args:
+        formulario (dict): Campos del POST de Twilio
+
+    Returns:
+        tuple: (código HTTP, cuerpo)
+    """
+    inicio = time.time()
+    iniciar_solicitud(formulario.get("MessageSid"))
+    empresa = empresa_por_numero(formulario.get("To", ""))
+    if empresa is None:
+        await _capturar(inicio, 403, formulario)
+        return 403, "Número receptor no registrado"
+    usar_empresa(empresa)
+    logger.info("=== NUEVA SOLICITUD ===")
+    logger.debug("Datos recibidos: %s", formulario)
+
+    user_msg = formulario.get("Body", "").lower()
+    sender = formulario.get("From", "")
+
+    if not sender.startswith('whatsapp:'):
+        logger.warning("Remitente no válido: %s", sender)
+        await _capturar(inicio, 400, formulario)
+        return 400, "Remitente no válido"
+
+    respuesta = servicios.twilio.crear_respuesta()
+    if not empresa.permite_mensaje():
+        logger.warning("Límite de mensajes por minuto alcanzado para la empresa %s", empresa.id)
+        respuesta.message("⏳ Estamos recibiendo muchos mensajes. Por favor, intenta nuevamente en un minuto.")
+        await _capturar(inicio, 200, formulario)
+        return 200, str(respuesta)
+
+    try:
+        with span("webhook", SERVIDOR, {"messaging.system": "twilio", "correlacion": correlacion_actual(),
+                                         "facturacion.empresa": empresa.id}) as raiz:
+            _, intencion = await procesar_mensaje_async(user_msg, sender, respuesta)
+            raiz.atributo("facturacion.intencion", intencion)
+    except Exception as e:
+        logger.error("Error crítico: %s", e)
+        respuesta.message("⚠️ Ha ocurrido un error inesperado. Por favor, intenta nuevamente más tarde o contacta a soporte técnico.")
+
+    await _capturar(inicio, 200, formulario)
+    return 200, str(respuesta)
+
+
+async def _capturar(inicio, status, formulario):
+    # La escritura de la captura es de disco: solo se pasa al pool si está activa
+    if obtener_grabador():
+        await en_hilo(capturar_solicitud, inicio, status, formulario)
+
+
+def _entorno_wsgi(scope, cuerpo):
+    """Entorno WSGI (PEP 3333) equivalente a la solicitud ASGI"""
+    servidor = scope.get("server") or ("localhost", 80)
+    entorno = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": servidor[0],
+        "SERVER_PORT": str(servidor[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(cuerpo)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(cuerpo),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        entorno["REMOTE_ADDR"] = scope["client"][0]
+    for nombre, valor in scope.get("headers", []):
+        nombre = nombre.decode("latin-1").upper().replace("-", "_")
+        valor = valor.decode("latin-1")
+        if nombre == "CONTENT_TYPE":
+            entorno["CONTENT_TYPE"] = valor
+        elif nombre != "CONTENT_LENGTH":
+            clave = f"HTTP_{nombre}"
+            entorno[clave] = f"{entorno[clave]},{valor}" if clave in entorno else valor
+    return entorno
+
+
+def _llamar_wsgi(entorno):
+    estado = {}
+
+    def start_response(status, cabeceras, exc_info=None):
+        estado["codigo"] = int(status.split(" ", 1)[0])
+        estado["cabeceras"] = cabeceras
+
+    resultado = aplicacion_wsgi(entorno, start_response)
+    try:
+        cuerpo = b"".join(resultado)
+    finally:
+        if hasattr(resultado, "close"):
+            resultado.close()
+    return estado["codigo"], estado["cabeceras"], cuerpo
+
+
+def _pdf_en_memoria(token):
+    # Un PDF en memoria se sirve sin pasar por el pool; si no está, Flask lo busca en disco
+    entrega = entrega_pdf.obtener_entrega_pdf()
+    ruta = entrega_pdf.verificar(token) if entrega else None
+    return entrega.obtener(ruta, contar_fallo=False) if ruta else None
+
+
+class AplicacionASGI:
+    """Aplicación ASGI 3: /webhook asíncrono y el resto de las rutas a través de Flask"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._ciclo_de_vida(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        cuerpo = await self._leer_cuerpo(receive)
+        if scope["path"].startswith("/pdf/") and scope["method"] == "GET":
+            contenido = _pdf_en_memoria(scope["path"][len("/pdf/"):])
+            if contenido is not None:
+                await self._responder(send, 200, [("Content-Type", "application/pdf")], contenido)
+                return
+        if scope["path"] == "/webhook" and scope["method"] == "POST":
+            tipo = dict(scope.get("headers", [])).get(b"content-type", b"")
+            formulario = {}
+            if tipo.startswith(b"application/x-www-form-urlencoded"):
+                # Como request.form.get: ante un campo repetido gana el primero
+                for clave, valor in parse_qsl(cuerpo.decode("utf-8", "replace"), keep_blank_values=True):
+                    formulario.setdefault(clave, valor)
+            codigo, contenido = await webhook_async(formulario)
+            await self._responder(send, codigo, [("Content-Type", "text/html; charset=utf-8")], contenido.encode("utf-8"))
+        else:
+            codigo, cabeceras, contenido = await en_hilo(_llamar_wsgi, _entorno_wsgi(scope, cuerpo))
+            await self._responder(send, codigo, cabeceras, contenido)
+
+    @staticmethod
+    async def _leer_cuerpo(receive):
+        partes = []
+        while True:
+            mensaje = await receive()
+            partes.append(mensaje.get("body", b""))
+            if not mensaje.get("more_body"):
+                return b"".join(partes)
+
+    @staticmethod
+    async def _responder(send, codigo, cabeceras, contenido):
+        cabeceras = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in cabeceras
+                     if k.lower() != "content-length"]
+        cabeceras.append((b"content-length", str(len(contenido)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": codigo, "headers": cabeceras})
+        await send({"type": "http.response.body", "body": contenido})
+
+    @staticmethod
+    async def _ciclo_de_vida(receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje["type"] == "lifespan.startup":
+                # Calentamiento del worker (ver startup.iniciar)
+                iniciar()
+                await send({"type": "lifespan.startup.complete"})
+            elif mensaje["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = AplicacionASGI()
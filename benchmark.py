@@ -0,0 +1,451 @@
+# benchmark.py
+"""
+Benchmarks del pipeline de facturación con servicios externos simulados.
+
+Uso:
+    python benchmark.py pipeline --mensajes 500 --concurrencia 4 --latencia-llm 0.05
+    python benchmark.py http --mensajes 200
+    python benchmark.py asgi --mensajes 500 --concurrencia 200 --latencia-llm 0.2
+    python benchmark.py parser
+    python benchmark.py productos --tamanos 10,100,1000,10000
+    python benchmark.py pdf --lineas 1,10,50,200
+    python benchmark.py totales --facturas 1000,10000
+    python benchmark.py catalogo --skus 100000
+
+Cada ejecución se agrega al historial (JSONL) junto con el commit actual y se
+compara con la ejecución anterior del mismo escenario; si el p95 empeora más
+que el umbral, el proceso termina con código 1.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+
+PRODUCTOS = [
+    "licencias", "monitores", "teclados", "servicios de consultoría", "sillas",
+    "mesas", "horas de soporte", "impresoras", "cables de red", "computadoras portátiles",
+]
+
+PLANTILLAS = {
+    "facturar": [
+        "Facturar {n} {p} a RFC {rfc}",
+        "Necesito una factura por {n} {p} para RFC {rfc}",
+        "Quiero facturar {n} {p} al RFC {rfc}",
+        "Facturar {n} {p} y {m} {q} a RFC {rfc}",
+        "Generar factura de {n} {p} para el RFC {rfc}",
+    ],
+    "consultar": [
+        "Consultar facturas de RFC {rfc}",
+        "Ver facturas del RFC {rfc}",
+        "Mostrar facturas para RFC {rfc}",
+    ],
+    "ayuda": ["ayuda", "¿Cómo funciona?", "Opciones disponibles"],
+    "otro": ["hola", "muchas gracias", "buenos días"],
+}
+
+MEZCLA = {"facturar": 0.6, "consultar": 0.25, "ayuda": 0.1, "otro": 0.05}
+
+
+def generar_rfc(rng):
+    from message_parser import digito_verificador_rfc
+    letras = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    base = (
+        "".join(rng.choice(letras) for _ in range(4))
+        + f"{rng.randint(50, 99):02d}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}"
+        + "".join(rng.choice(letras + "0123456789") for _ in range(2))
+    )
+    return base + digito_verificador_rfc(base)
+
+
+def generar_corpus(cantidad, semilla=42, clientes=50):
+    """Genera mensajes sintéticos en español como (intención esperada, texto)"""
+    rng = random.Random(semilla)
+    rfcs = [generar_rfc(rng) for _ in range(clientes)]
+    intenciones = list(MEZCLA)
+    pesos = [MEZCLA[i] for i in intenciones]
+    corpus = []
+    for _ in range(cantidad):
+        intencion = rng.choices(intenciones, pesos)[0]
+        p, q = rng.sample(PRODUCTOS, 2)
+        texto = rng.choice(PLANTILLAS[intencion]).format(
+            n=rng.randint(1, 20), m=rng.randint(1, 20), p=p, q=q, rfc=rng.choice(rfcs)
+        )
+        corpus.append((intencion, texto))
+    return corpus
+
+
+def percentiles(valores):
+    if not valores:
+        return {"n": 0}
+    ordenados = sorted(valores)
+    if len(ordenados) > 1:
+        cortes = statistics.quantiles(ordenados, n=100, method="inclusive")
+        p50, p95, p99 = cortes[49], cortes[94], cortes[98]
+    else:
+        p50 = p95 = p99 = ordenados[0]
+    media = statistics.fmean(ordenados)
+    return {
+        "n": len(ordenados),
+        "media_ms": round(media, 3),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        # Capacidad de la etapa en un solo hilo
+        "msgs_por_seg": round(1000.0 / media, 1) if media else None,
+    }
+
+
+def preparar_entorno(args):
+    """Aísla la base de datos y los PDFs en un directorio temporal y usa los backends stub"""
+    directorio = tempfile.mkdtemp(prefix="bench_")
+    os.environ["DATABASE_URI"] = f"sqlite:///{directorio}/bench.db"
+    os.environ["UPLOAD_FOLDER"] = os.path.join(directorio, "static")
+    os.environ["EMBEDDINGS_DIR"] = os.path.join(directorio, "indices")
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ["LLM_STUB_LATENCIA"] = str(getattr(args, "latencia_llm", 0.0))
+    return directorio
+
+
+class TwilioStub:
+    """Sustituto de TwilioService con latencia de envío configurable"""
+    def __init__(self, latencia):
+        from twilio.twiml.messaging_response import MessagingResponse
+        self._respuesta = MessagingResponse
+        self.latencia = latencia
+
+    def enviar_factura(self, pdf_path, to):
+        if self.latencia:
+            time.sleep(self.latencia)
+        return "SM-BENCHMARK"
+
+    async def enviar_factura_async(self, pdf_path, to):
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        return "SM-BENCHMARK"
+
+    def crear_respuesta(self):
+        return self._respuesta()
+
+
+def _silenciar_logs(args):
+    if not args.logs:
+        logging.disable(logging.WARNING)
+
+
+def bench_pipeline(args, http=False):
+    preparar_entorno(args)
+    import app as aplicacion
+    from startup import servicios
+    from metricas import iniciar_solicitud
+    _silenciar_logs(args)
+    servicios.registrar("twilio", TwilioStub(args.latencia_twilio))
+
+    corpus = generar_corpus(args.mensajes, args.semilla)
+    cliente_http = aplicacion.app.test_client() if http else None
+
+    def procesar(item):
+        _, texto = item
+        inicio = time.perf_counter()
+        if http:
+            r = cliente_http.post("/webhook", data={"Body": texto, "From": "whatsapp:+5215500000000"})
+            etapas, error = {}, r.status_code != 200
+        else:
+            etapas = iniciar_solicitud()
+            error = False
+            try:
+                aplicacion.procesar_mensaje(texto.lower(), "whatsapp:+5215500000000",
+                                            servicios.twilio.crear_respuesta())
+            except Exception:
+                error = True
+        return (time.perf_counter() - inicio) * 1000, dict(etapas), error
+
+    # Calentar (primer PDF, creación de tablas) fuera de la medición
+    procesar(corpus[0])
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as ejecutor:
+        resultados = list(ejecutor.map(procesar, corpus))
+    duracion = time.perf_counter() - inicio
+
+    por_etapa = {}
+    for _, etapas, _ in resultados:
+        for nombre, ms in etapas.items():
+            por_etapa.setdefault(nombre, []).append(ms)
+
+    return {
+        "total": percentiles([r[0] for r in resultados]),
+        "etapas": {nombre: percentiles(v) for nombre, v in sorted(por_etapa.items())},
+        "msgs_por_seg": round(len(resultados) / duracion, 1),
+        "errores": sum(1 for r in resultados if r[2]),
+    }
+
+
+def bench_asgi(args):
+    """Webhook por la aplicación ASGI (asgi.py), con --concurrencia solicitudes en curso"""
+    preparar_entorno(args)
+    import asgi
+    from startup import servicios
+    _silenciar_logs(args)
+    servicios.registrar("twilio", TwilioStub(args.latencia_twilio))
+
+    corpus = generar_corpus(args.mensajes, args.semilla)
+    cuerpos = [urlencode({"Body": texto, "From": "whatsapp:+5215500000000"}).encode() for _, texto in corpus]
+
+    async def solicitud(cuerpo):
+        scope = {"type": "http", "method": "POST", "path": "/webhook", "query_string": b"",
+                 "headers": [(b"content-type", b"application/x-www-form-urlencoded")]}
+        recibido = iter([{"type": "http.request", "body": cuerpo}])
+        estado = {}
+
+        async def receive():
+            return next(recibido)
+
+        async def send(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["status"] = mensaje["status"]
+
+        inicio = time.perf_counter()
+        try:
+            await asgi.app(scope, receive, send)
+            error = estado.get("status") != 200
+        except Exception:
+            error = True
+        return (time.perf_counter() - inicio) * 1000, error
+
+    async def ejecutar():
+        # Calentar (primer PDF, creación de tablas) fuera de la medición
+        await solicitud(cuerpos[0])
+        limite = asyncio.Semaphore(args.concurrencia)
+
+        async def acotada(cuerpo):
+            async with limite:
+                return await solicitud(cuerpo)
+
+        inicio = time.perf_counter()
+        resultados = await asyncio.gather(*(acotada(c) for c in cuerpos))
+        return resultados, time.perf_counter() - inicio
+
+    resultados, duracion = asyncio.run(ejecutar())
+    return {
+        "total": percentiles([r[0] for r in resultados]),
+        "msgs_por_seg": round(len(resultados) / duracion, 1),
+        "errores": sum(1 for r in resultados if r[1]),
+    }
+
+
+def _medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return percentiles(tiempos)
+
+
+def bench_parser(args):
+    from message_parser import MessageParser
+    _silenciar_logs(args)
+    corpus = [texto.lower() for _, texto in generar_corpus(args.mensajes, args.semilla)]
+    resultados = {}
+    for nombre, funcion in [
+        ("clasificar_intencion", MessageParser.clasificar_intencion),
+        ("extraer_datos_factura", MessageParser.extraer_datos_factura),
+        ("extraer_datos_consulta", MessageParser.extraer_datos_consulta),
+    ]:
+        resultados[nombre] = _medir(lambda: [funcion(m) for m in corpus], args.repeticiones)
+        resultados[nombre]["por_mensaje_us"] = round(resultados[nombre]["media_ms"] * 1000 / len(corpus), 2)
+    return resultados
+
+
+def bench_productos(args):
+    preparar_entorno(args)
+    from models import get_db_session, Producto
+    from catalogo import publicar_version
+    from producto_service import ProductoService
+    _silenciar_logs(args)
+
+    rng = random.Random(args.semilla)
+    consultas = ["licencias", "monitor", "sillas ergonomicas", "producto inexistente xyz", "teclado"]
+    resultados = {}
+    existentes = 0
+    for tamano in sorted(int(t) for t in args.tamanos.split(",")):
+        db_session = get_db_session()
+        db_session.add_all([
+            Producto(codigo=f"SKU{i:07d}", nombre=f"{rng.choice(PRODUCTOS)} modelo {i}", precio=round(rng.uniform(10, 1000), 2))
+            for i in range(existentes, tamano)
+        ])
+        publicar_version(db_session)
+        db_session.commit()
+        db_session.close()
+        ProductoService.invalidar_catalogo()
+        existentes = tamano
+        resultados[str(tamano)] = _medir(
+            lambda: [ProductoService.buscar_producto(c) for c in consultas], args.repeticiones
+        )
+        resultados[str(tamano)]["por_busqueda_ms"] = round(resultados[str(tamano)]["media_ms"] / len(consultas), 3)
+    return resultados
+
+
+def bench_pdf(args):
+    preparar_entorno(args)
+    from document_generator import DocumentGenerator
+    from totales import calcular_totales
+    _silenciar_logs(args)
+
+    generador = DocumentGenerator()
+    resultados = {}
+    for lineas in sorted(int(n) for n in args.lineas.split(",")):
+        productos = [{"nombre": f"{PRODUCTOS[i % len(PRODUCTOS)]} {i}", "cantidad": i + 1} for i in range(lineas)]
+        totales = calcular_totales(productos, {p["nombre"]: "99.50" for p in productos})
+        resultados[str(lineas)] = _medir(
+            lambda: generador.generar_factura("XAXX010101000", totales), args.repeticiones
+        )
+    return resultados
+
+
+def bench_totales(args):
+    from totales import calcular_totales, calcular_totales_lote
+
+    rng = random.Random(args.semilla)
+    precios = {p: round(rng.uniform(10, 1000), 2) for p in PRODUCTOS}
+    resultados = {}
+    for n in sorted(int(t) for t in args.facturas.split(",")):
+        facturas = [
+            [{"nombre": rng.choice(PRODUCTOS), "cantidad": rng.randint(1, 20)} for _ in range(rng.randint(1, 8))]
+            for _ in range(n)
+        ]
+        resultados[str(n)] = {
+            "por_factura": _medir(lambda: [calcular_totales(f, precios) for f in facturas], args.repeticiones),
+            "lote": _medir(lambda: calcular_totales_lote(facturas, precios), args.repeticiones),
+        }
+    return resultados
+
+
+def bench_catalogo(args):
+    directorio = preparar_entorno(args)
+    import catalogo
+    _silenciar_logs(args)
+
+    ruta = os.path.join(directorio, "catalogo.csv")
+
+    def escribir(cambiados):
+        with open(ruta, "w", encoding="utf-8") as f:
+            f.write("codigo,nombre,precio\n")
+            for i in range(args.skus):
+                precio = 10 + i % 990 + (0.5 if i < cambiados else 0)
+                f.write(f"SKU{i:07d},{PRODUCTOS[i % len(PRODUCTOS)]} modelo {i},{precio:.2f}\n")
+
+    resultados = {}
+    # Carga inicial, reimportación sin cambios (solo checksums) y con 10% de precios modificados
+    for nombre, cambiados in [("inicial", 0), ("sin_cambios", 0), ("cambios_10", args.skus // 10)]:
+        escribir(cambiados)
+        resumen = catalogo.importar(ruta)
+        resultados[nombre] = {k: resumen[k] for k in ("nuevos", "actualizados", "sin_cambios", "duracion_s")}
+    return resultados
+
+
+def commit_actual():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def _p95s(resultado, prefijo=""):
+    """Aplana todas las métricas p95_ms de un resultado: {"etapas.pdf": 12.3, ...}"""
+    valores = {}
+    for clave, valor in resultado.items():
+        if isinstance(valor, dict):
+            if "p95_ms" in valor:
+                valores[f"{prefijo}{clave}"] = valor["p95_ms"]
+            valores.update(_p95s(valor, f"{prefijo}{clave}."))
+    return valores
+
+
+def comparar(anterior, actual, umbral):
+    """Lista de regresiones de p95 por encima del umbral relativo"""
+    regresiones = []
+    previos = _p95s(anterior)
+    for clave, valor in _p95s(actual).items():
+        base = previos.get(clave)
+        if base and valor > base * (1 + umbral):
+            regresiones.append(f"{clave}: p95 {base:.3f} ms -> {valor:.3f} ms (+{(valor / base - 1) * 100:.1f}%)")
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks del agente de facturación")
+    parser.add_argument("suite", choices=["pipeline", "http", "asgi", "parser", "productos", "pdf", "totales", "catalogo"])
+    parser.add_argument("--mensajes", type=int, default=300)
+    parser.add_argument("--concurrencia", type=int, default=1)
+    parser.add_argument("--latencia-llm", type=float, default=0.0, help="segundos por llamada al LLM stub")
+    parser.add_argument("--latencia-twilio", type=float, default=0.0, help="segundos por envío al Twilio stub")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--tamanos", default="10,100,1000,10000", help="tamaños de catálogo")
+    parser.add_argument("--lineas", default="1,10,50,200", help="líneas por factura")
+    parser.add_argument("--facturas", default="1000,10000", help="facturas por medición (suite totales)")
+    parser.add_argument("--skus", type=int, default=100000, help="productos a importar (suite catalogo)")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--historial", default="benchmarks/historial.jsonl")
+    parser.add_argument("--umbral", type=float, default=0.10, help="regresión tolerada en p95 (0.10 = 10%%)")
+    parser.add_argument("--logs", action="store_true", help="no silenciar el logging de la aplicación")
+    args = parser.parse_args(argv)
+
+    suites = {
+        "pipeline": lambda: bench_pipeline(args),
+        "http": lambda: bench_pipeline(args, http=True),
+        "asgi": lambda: bench_asgi(args),
+        "parser": lambda: bench_parser(args),
+        "productos": lambda: bench_productos(args),
+        "pdf": lambda: bench_pdf(args),
+        "totales": lambda: bench_totales(args),
+        "catalogo": lambda: bench_catalogo(args),
+    }
+    resultado = suites[args.suite]()
+
+    # El escenario identifica ejecuciones comparables entre commits
+    escenario = {k: v for k, v in vars(args).items() if k not in ("historial", "umbral", "logs")}
+    registro = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit_actual(),
+        "escenario": escenario,
+        "resultado": resultado,
+    }
+    print(json.dumps(registro, indent=2, ensure_ascii=False))
+
+    anterior = None
+    if os.path.exists(args.historial):
+        with open(args.historial, encoding="utf-8") as f:
+            for linea in f:
+                previo = json.loads(linea)
+                if previo.get("escenario") == escenario:
+                    anterior = previo
+    os.makedirs(os.path.dirname(args.historial) or ".", exist_ok=True)
+    with open(args.historial, "a", encoding="utf-8") as f:
+        f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+
+    if anterior:
+        regresiones = comparar(anterior["resultado"], resultado, args.umbral)
+        if regresiones:
+            print(f"\nREGRESIONES respecto a {anterior.get('commit')}:", file=sys.stderr)
+            for r in regresiones:
+                print(f"  - {r}", file=sys.stderr)
+            return 1
+        print(f"\nSin regresiones respecto a {anterior.get('commit')} (umbral {args.umbral:.0%})", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# captura.py
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from config import Config
+from message_parser import digito_verificador_rfc
+
+logger = logging.getLogger(__name__)
+
+PATRON_RFC = re.compile(r'\b[A-ZÑ&]{3,4}\d{6}[A-Z\d]{3}\b', re.IGNORECASE)
+
+
+def _hash(valor):
+    if not Config.CAPTURA_SAL:
+        raise ValueError("CAPTURA_SAL no está configurada")
+    return hashlib.sha256(f"{Config.CAPTURA_SAL}:{valor}".encode()).hexdigest()
+
+
+def anonimizar_remitente(remitente):
+    """
+    Sustituye el número por un hash estable. Conserva el prefijo whatsapp: solo si
+    el original lo tenía, para que la reproducción obtenga la misma validación.
+    """
+    prefijo = "whatsapp:" if remitente.startswith("whatsapp:") else ""
+    return f"{prefijo}anon-{_hash(remitente)[:16]}"
+
+
+def anonimizar_rfc(match):
+    """RFC seudónimo válido (con dígito verificador), estable para el mismo RFC original"""
+    rfc = match.group(0).upper()
+    h = _hash(rfc)
+    n = int(h, 16)
+    letras = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    prefijo = ""
+    for _ in range(len(rfc) - 9):
+        n, i = divmod(n, len(letras))
+        prefijo += letras[i]
+    fecha = f"{n % 100:02d}{n // 100 % 12 + 1:02d}{n // 1200 % 28 + 1:02d}"
+    base = f"{prefijo}{fecha}{h[:2].upper()}"
+    return base + digito_verificador_rfc(base)
+
+
+def anonimizar_mensaje(texto):
+    return PATRON_RFC.sub(anonimizar_rfc, texto)
+
+
+class GrabadorTrafico:
+    """
+    Registra las solicitudes de /webhook en un archivo JSONL (una línea por mensaje)
+    para reproducirlas después con replay.py. El remitente siempre se guarda como hash
+    y los RFC del texto se sustituyen por seudónimos.
+    """
+    def __init__(self, ruta=None):
+        if not Config.CAPTURA_SAL:
+            # Sin sal propia los números de teléfono se recuperan probando todos los posibles
+            raise ValueError("CAPTURA_ACTIVA requiere CAPTURA_SAL")
+        self.ruta = ruta or Config.CAPTURA_RUTA
+        self._lock = threading.Lock()
+        self._archivo = None
+        self._pid = None
+
+    def _abrir(self):
+        # Un descriptor por proceso; se reabre después de un fork
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+            self._archivo = open(self.ruta, "a", encoding="utf-8", buffering=1)
+            self._pid = os.getpid()
+        return self._archivo
+
+    def registrar(self, inicio, body, remitente, duracion_ms, status, receptor=""):
+        """
+        Args:
+            inicio (float): Marca de tiempo (epoch) de llegada de la solicitud
+            body (str): Texto original del mensaje
+            remitente (str): Valor original de From
+            duracion_ms (float): Tiempo de procesamiento
+            status (int): Código HTTP devuelto
+            receptor (str): Valor de To (el número de la empresa; no se anonimiza)
+        """
+        registro = {
+            "t": round(inicio, 3),
+            "body": anonimizar_mensaje(body) if Config.CAPTURA_ANONIMIZAR_RFC else body,
+            "from": anonimizar_remitente(remitente),
+            "to": receptor,
+            "duracion_ms": round(duracion_ms, 1),
+            "status": status,
+        }
+        linea = json.dumps(registro, ensure_ascii=False) + "\n"
+        try:
+            with self._lock:
+                self._abrir().write(linea)
+        except OSError as e:
+            logger.error("Error escribiendo captura de tráfico: %s", e)
+
+
+_grabador = None
+
+def obtener_grabador():
+    """Grabador compartido del proceso, o None si la captura está desactivada"""
+    global _grabador
+    if not Config.CAPTURA_ACTIVA:
+        return None
+    if _grabador is None:
+        _grabador = GrabadorTrafico()
+    return _grabador
@@ -0,0 +1,265 @@
+# catalogo.py
+"""
+Importación y exportación del catálogo de productos (CSV o JSONL).
+
+La importación lee el archivo en streaming y actualiza Producto por `codigo` en
+lotes de Config.CATALOGO_LOTE filas, cada uno en su propia transacción corta, de
+modo que el webhook sigue escribiendo entre lote y lote. Solo se escriben las filas
+nuevas o modificadas: cada producto guarda el checksum de sus datos y, si el archivo
+trae la columna `actualizado`, no se sobrescriben productos más recientes.
+Al terminar se publica una nueva versión del catálogo y cada proceso recarga su
+copia en memoria (ver ProductoService.obtener_catalogo).
+
+Columnas: codigo (obligatoria), nombre, descripcion, precio, clave_prod_serv,
+clave_unidad, actualizado (ISO 8601, opcional; con zona horaria se convierte a UTC,
+sin ella se toma como UTC).
+
+Uso:
+    python catalogo.py importar productos.csv
+    python catalogo.py importar cambios.jsonl --empresa acme
+    python catalogo.py exportar productos.jsonl
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from config import Config
+from empresas import empresa_por_id, usar_empresa
+from totales import redondear
+from trazas import configurar_logging
+
+logger = logging.getLogger(__name__)
+
+COLUMNAS = ["codigo", "nombre", "descripcion", "precio", "clave_prod_serv", "clave_unidad", "actualizado"]
+
+
+def version_catalogo(db_session):
+    """Versión publicada del catálogo (0 si nunca se publicó)"""
+    from models import VersionCatalogo
+    fila = db_session.get(VersionCatalogo, 1)
+    return fila.version if fila else 0
+
+
+def publicar_version(db_session):
+    """
+    Incrementa la versión del catálogo dentro de la transacción de `db_session`. Solo
+    la llama la importación: cada versión nueva hace que todos los procesos recarguen
+    el catálogo (y su índice de embeddings). La fila la crea models.init_db.
+    """
+    from models import VersionCatalogo
+    db_session.query(VersionCatalogo).filter_by(id=1).update(
+        {VersionCatalogo.version: VersionCatalogo.version + 1, VersionCatalogo.actualizado: datetime.now()},
+        synchronize_session=False
+    )
+
+
+def _formato(ruta, formato=None):
+    return formato or ("jsonl" if ruta.endswith((".jsonl", ".ndjson")) else "csv")
+
+
+def leer_filas(ruta, formato=None):
+    """Genera (número de línea, fila) sin cargar el archivo en memoria; fila es None si no se pudo leer"""
+    with open(ruta, encoding="utf-8", newline="") as f:
+        if _formato(ruta, formato) == "jsonl":
+            for numero, linea in enumerate(f, 1):
+                if not linea.strip():
+                    continue
+                try:
+                    yield numero, json.loads(linea)
+                except ValueError:
+                    yield numero, None
+        else:
+            # La línea 1 es el encabezado
+            for numero, fila in enumerate(csv.DictReader(f), 2):
+                yield numero, fila
+
+
+def _texto(valor, longitud):
+    valor = (str(valor).strip() if valor is not None else "")[:longitud]
+    return valor or None
+
+
+def _utc(valor):
+    """Fecha ISO 8601 como datetime UTC sin zona (así se guarda Producto.actualizado)"""
+    try:
+        fecha = datetime.fromisoformat(str(valor).strip())
+    except ValueError:
+        raise ValueError(f"fecha inválida: {valor!r}")
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+
+def _ahora_utc():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def normalizar(fila):
+    """
+    Convierte una fila del archivo en los valores de Producto más su checksum.
+
+    Raises:
+        ValueError: Si falta el código, el precio no es un número o la fecha no es ISO 8601
+    """
+    if not isinstance(fila, dict):
+        raise ValueError("fila ilegible")
+    codigo = _texto(fila.get("codigo"), 50)
+    if not codigo:
+        raise ValueError("falta el código")
+    precio = fila.get("precio")
+    try:
+        precio = redondear(str(precio).strip() if precio not in (None, "") else "0")
+    except ArithmeticError:
+        raise ValueError(f"precio inválido: {fila.get('precio')!r}")
+    producto = {
+        "codigo": codigo,
+        "nombre": _texto(fila.get("nombre"), 100) or codigo,
+        "descripcion": _texto(fila.get("descripcion"), 200),
+        "precio": precio,
+        "clave_prod_serv": _texto(fila.get("clave_prod_serv"), 8),
+        "clave_unidad": _texto(fila.get("clave_unidad"), 3),
+    }
+    producto["checksum"] = hashlib.sha1("\x1f".join(
+        "" if producto[c] is None else str(producto[c]) for c in COLUMNAS[:-1]
+    ).encode("utf-8")).hexdigest()
+    actualizado = fila.get("actualizado")
+    producto["actualizado"] = _utc(actualizado) if actualizado else None
+    return producto
+
+
+def _aplicar_lote(lote, resumen):
+    """Inserta o actualiza un lote {codigo: producto} en una sola transacción"""
+    from models import get_db_session, Producto
+
+    db_session = get_db_session()
+    try:
+        existentes = {
+            fila.codigo: fila for fila in db_session.query(
+                Producto.id, Producto.codigo, Producto.checksum, Producto.actualizado
+            ).filter(Producto.codigo.in_(list(lote)))
+        }
+        ahora = _ahora_utc()
+        nuevos, cambios = [], []
+        for codigo, producto in lote.items():
+            actual = existentes.get(codigo)
+            if actual is None:
+                producto["actualizado"] = producto["actualizado"] or ahora
+                nuevos.append(producto)
+            elif actual.checksum == producto["checksum"] or (
+                    producto["actualizado"] and actual.actualizado and producto["actualizado"] <= actual.actualizado):
+                resumen["sin_cambios"] += 1
+            else:
+                producto["id"] = actual.id
+                producto["actualizado"] = producto["actualizado"] or ahora
+                cambios.append(producto)
+        if nuevos:
+            db_session.bulk_insert_mappings(Producto, nuevos)
+        if cambios:
+            db_session.bulk_update_mappings(Producto, cambios)
+        db_session.commit()
+        resumen["nuevos"] += len(nuevos)
+        resumen["actualizados"] += len(cambios)
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+
+
+def importar(ruta, formato=None, tamano_lote=None):
+    """
+    Sincroniza el catálogo de la empresa actual con el archivo `ruta`.
+
+    Returns:
+        dict: Resumen con filas, nuevos, actualizados, sin cambios, inválidos, versión y duración
+    """
+    from models import get_db_session
+
+    inicio = time.perf_counter()
+    tamano_lote = tamano_lote or Config.CATALOGO_LOTE
+    resumen = {"filas": 0, "nuevos": 0, "actualizados": 0, "sin_cambios": 0, "invalidos": 0, "errores": []}
+    lote = {}
+    for numero, fila in leer_filas(ruta, formato):
+        resumen["filas"] += 1
+        try:
+            producto = normalizar(fila)
+        except (ValueError, TypeError) as e:
+            # Una fila mala no detiene la importación: se cuenta y se sigue
+            resumen["invalidos"] += 1
+            if len(resumen["errores"]) < 20:
+                resumen["errores"].append({"linea": numero, "error": str(e)})
+            continue
+        # Si un código se repite en el archivo gana la última fila
+        lote[producto["codigo"]] = producto
+        if len(lote) >= tamano_lote:
+            _aplicar_lote(lote, resumen)
+            lote = {}
+    if lote:
+        _aplicar_lote(lote, resumen)
+
+    db_session = get_db_session()
+    try:
+        if resumen["nuevos"] or resumen["actualizados"]:
+            publicar_version(db_session)
+            db_session.commit()
+        resumen["version"] = version_catalogo(db_session)
+    finally:
+        db_session.close()
+    resumen["duracion_s"] = round(time.perf_counter() - inicio, 2)
+    logger.info("Catálogo importado desde %s: %s nuevos, %s actualizados, versión %s",
+                ruta, resumen["nuevos"], resumen["actualizados"], resumen["version"])
+    return resumen
+
+
+def exportar(ruta, formato=None, tamano_lote=None):
+    """Escribe el catálogo de la empresa actual en `ruta` leyendo por bloques desde la réplica"""
+    from models import get_db_session, Producto
+
+    formato = _formato(ruta, formato)
+    filas = 0
+    db_session = get_db_session(lectura=True)
+    try:
+        with open(ruta, "w", encoding="utf-8", newline="") as f:
+            escritor = csv.DictWriter(f, fieldnames=COLUMNAS) if formato == "csv" else None
+            if escritor:
+                escritor.writeheader()
+            consulta = db_session.query(Producto).order_by(Producto.id).yield_per(tamano_lote or Config.CATALOGO_LOTE)
+            for producto in consulta:
+                fila = {c: getattr(producto, c) for c in COLUMNAS}
+                fila["precio"] = str(fila["precio"]) if fila["precio"] is not None else None
+                fila["actualizado"] = fila["actualizado"].isoformat(timespec="seconds") if fila["actualizado"] else None
+                if escritor:
+                    escritor.writerow(fila)
+                else:
+                    f.write(json.dumps(fila, ensure_ascii=False) + "\n")
+                filas += 1
+    finally:
+        db_session.close()
+    return filas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importa o exporta el catálogo de productos")
+    parser.add_argument("accion", choices=["importar", "exportar"])
+    parser.add_argument("ruta", help="archivo .csv o .jsonl")
+    parser.add_argument("--formato", choices=["csv", "jsonl"], help="por defecto según la extensión")
+    parser.add_argument("--lote", type=int, default=None, help=f"filas por transacción ({Config.CATALOGO_LOTE})")
+    parser.add_argument("--empresa", default="principal", help="id de la empresa (ver empresas.py)")
+    args = parser.parse_args(argv)
+    usar_empresa(empresa_por_id(args.empresa))
+
+    if args.accion == "exportar":
+        print(json.dumps({"productos": exportar(args.ruta, args.formato, args.lote)}))
+        return 0
+    resumen = importar(args.ruta, args.formato, args.lote)
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+    return 1 if resumen["invalidos"] else 0
+
+
+if __name__ == "__main__":
+    configurar_logging()
+    sys.exit(main())
@@ -0,0 +1,529 @@
+# cfdi.py
+"""
+Generación de CFDI 4.0 a partir de las facturas guardadas (Factura, Cliente,
+DetalleFactura), validación contra el XSD del SAT y timbrado con un PAC intercambiable.
+
+El XML se escribe en streaming (sin construir el árbol en memoria) con los atributos
+fijos de cada nodo precalculados al importar el módulo (y los del emisor, una vez por
+empresa). El XSD se compila una sola vez por proceso.
+
+Uso (cierre de mes):
+    python cfdi.py --desde 2026-10-01 --hasta 2026-10-31 --procesos 4
+    python cfdi.py --ids 10,11,12 --timbrar
+    python cfdi.py --empresa acme --desde 2026-10-01 --hasta 2026-10-31
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from xml.sax.saxutils import XMLGenerator
+from config import Config
+from empresas import empresa_actual, empresa_por_id, usar_empresa
+from totales import TASA_IVA, calcular_totales_lote, redondear
+from trazas import configurar_logging, propagar, span, CLIENTE
+
+logger = logging.getLogger(__name__)
+
+NS_CFDI = "http://www.sat.gob.mx/cfd/4"
+NS_XSI = "http://www.w3.org/2001/XMLSchema-instance"
+NS_TFD = "http://www.sat.gob.mx/TimbreFiscalDigital"
+FORMATO_FECHA = "%Y-%m-%dT%H:%M:%S"
+
+# Plantillas: atributos fijos de cada nodo, calculados una sola vez
+_COMPROBANTE = {
+    "xmlns:cfdi": NS_CFDI,
+    "xmlns:xsi": NS_XSI,
+    "xsi:schemaLocation": f"{NS_CFDI} http://www.sat.gob.mx/sitio_internet/cfd/4/cfdv40.xsd",
+    "Version": "4.0",
+}
+_COMPROBANTE_FIJOS = {
+    "Sello": "",
+    "NoCertificado": Config.CFDI_NO_CERTIFICADO,
+    "Certificado": "",
+    "FormaPago": Config.CFDI_FORMA_PAGO,
+    "Moneda": "MXN",
+    "TipoDeComprobante": "I",
+    "Exportacion": "01",
+    "MetodoPago": Config.CFDI_METODO_PAGO,
+}
+_TRASLADO_IVA = {"Impuesto": "002", "TipoFactor": "Tasa", "TasaOCuota": f"{TASA_IVA:.6f}"}
+
+
+# Atributos de Serie, LugarExpedicion y del nodo Emisor por empresa
+_EMISORES = {}
+
+
+def _importe(valor):
+    return f"{valor:.2f}"
+
+
+def _plantilla_emisor(empresa):
+    plantilla = _EMISORES.get(empresa.id)
+    if plantilla is None:
+        plantilla = _EMISORES[empresa.id] = {
+            "empresa": empresa.id,
+            "comprobante": {"Serie": empresa.serie, "LugarExpedicion": empresa.lugar_expedicion},
+            "emisor": {"Rfc": empresa.rfc, "Nombre": empresa.nombre, "RegimenFiscal": empresa.regimen_fiscal},
+        }
+    return plantilla
+
+
+def _coincide(factura, totales):
+    """Los importes recalculados son los guardados (las facturas sin IVA guardado se aceptan)"""
+    if factura.subtotal is not None and redondear(factura.subtotal) != totales.subtotal:
+        return False
+    return factura.iva is None or redondear(factura.iva) == totales.iva
+
+
+def cargar_datos(db_session, factura_ids, tamano_bloque=500, empresa=None):
+    """
+    Lee las facturas con su cliente y sus conceptos en pocas consultas
+    (una por bloque de ids y tabla) y las convierte en diccionarios serializables.
+    Los importes de cada bloque se calculan juntos con calcular_totales_lote (mismas
+    reglas que al emitir); si no coinciden con los guardados en la factura, se usan
+    los guardados. Los datos del emisor son los de `empresa` (por defecto la actual),
+    así que se pueden renderizar en otro proceso.
+
+    Returns:
+        list: Un diccionario por factura encontrada, en el orden de `factura_ids`
+    """
+    from models import Cliente, Factura, Producto, DetalleFactura
+
+    empresa = empresa or empresa_actual()
+    emisor = _plantilla_emisor(empresa)
+    datos = {}
+    ids = list(factura_ids)
+    for i in range(0, len(ids), tamano_bloque):
+        bloque = ids[i:i + tamano_bloque]
+        facturas = db_session.query(Factura).filter(Factura.id.in_(bloque)).all()
+        clientes = {
+            c.id: c for c in db_session.query(Cliente).filter(
+                Cliente.id.in_({f.cliente_id for f in facturas})
+            )
+        }
+        conceptos, detalles = {}, {}
+        filas = (db_session.query(DetalleFactura, Producto)
+                 .outerjoin(Producto, Producto.id == DetalleFactura.producto_id)
+                 .filter(DetalleFactura.factura_id.in_(bloque))
+                 .order_by(DetalleFactura.id))
+        for detalle, producto in filas:
+            # Los conceptos sin producto del catálogo llevan la descripción del mensaje
+            nombre = producto.nombre if producto else (detalle.descripcion or "Producto")
+            conceptos.setdefault(detalle.factura_id, []).append({
+                "clave_prod_serv": (producto and producto.clave_prod_serv) or Config.CFDI_CLAVE_PROD_SERV,
+                "clave_unidad": (producto and producto.clave_unidad) or Config.CFDI_CLAVE_UNIDAD,
+                "descripcion": nombre,
+                "cantidad": detalle.cantidad,
+            })
+            detalles.setdefault(detalle.factura_id, []).append(detalle)
+
+        calculados = calcular_totales_lote([
+            [{"nombre": c["descripcion"], "cantidad": d.cantidad, "precio_unitario": d.precio_unitario or 0}
+             for c, d in zip(conceptos.get(f.id, []), detalles.get(f.id, []))]
+            for f in facturas
+        ], {})
+        for factura, totales in zip(facturas, calculados):
+            cliente = clientes.get(factura.cliente_id)
+            lineas = conceptos.get(factura.id, [])
+            if _coincide(factura, totales):
+                for concepto, linea in zip(lineas, totales.lineas):
+                    concepto.update(valor_unitario=linea.precio_unitario, importe=linea.importe, iva=linea.iva)
+            else:
+                logger.warning("Los importes de la factura %s no coinciden con los recalculados; se usan los guardados",
+                               factura.id)
+                for concepto, detalle in zip(lineas, detalles.get(factura.id, [])):
+                    importe = redondear(detalle.subtotal or 0)
+                    # Las facturas anteriores a las columnas de IVA lo calculan con la tasa vigente
+                    iva = detalle.iva if detalle.iva is not None else redondear(importe * TASA_IVA)
+                    concepto.update(valor_unitario=redondear(detalle.precio_unitario or 0), importe=importe, iva=iva)
+            subtotal = sum((c["importe"] for c in lineas), redondear(0))
+            iva = sum((c["iva"] for c in lineas), redondear(0))
+            datos[factura.id] = {
+                "factura_id": factura.id,
+                "emisor": emisor,
+                "folio": str(factura.id),
+                "fecha": (factura.fecha_emision or datetime.now()).strftime(FORMATO_FECHA),
+                "receptor": {
+                    "Rfc": cliente.rfc if cliente else "XAXX010101000",
+                    "Nombre": cliente.nombre if cliente else "PUBLICO EN GENERAL",
+                    "DomicilioFiscalReceptor": (cliente and cliente.codigo_postal) or empresa.lugar_expedicion,
+                    "RegimenFiscalReceptor": (cliente and cliente.regimen_fiscal) or Config.CFDI_RECEPTOR_REGIMEN,
+                    "UsoCFDI": (cliente and cliente.uso_cfdi) or Config.CFDI_USO_CFDI,
+                },
+                "conceptos": lineas,
+                "subtotal": subtotal,
+                "iva": iva,
+                "total": subtotal + iva,
+            }
+    return [datos[i] for i in ids if i in datos]
+
+
+def escribir_cfdi(datos, destino):
+    """Escribe el CFDI (sin sello ni timbre) de `datos` en el flujo binario `destino`"""
+    xml = XMLGenerator(destino, encoding="UTF-8", short_empty_elements=True)
+    xml.startDocument()
+
+    comprobante = dict(_COMPROBANTE)
+    comprobante.update(datos["emisor"]["comprobante"])
+    comprobante["Folio"] = datos["folio"]
+    comprobante["Fecha"] = datos["fecha"]
+    comprobante.update(_COMPROBANTE_FIJOS)
+    comprobante["SubTotal"] = _importe(datos["subtotal"])
+    comprobante["Total"] = _importe(datos["total"])
+    xml.startElement("cfdi:Comprobante", comprobante)
+
+    xml.startElement("cfdi:Emisor", datos["emisor"]["emisor"])
+    xml.endElement("cfdi:Emisor")
+    xml.startElement("cfdi:Receptor", datos["receptor"])
+    xml.endElement("cfdi:Receptor")
+
+    xml.startElement("cfdi:Conceptos", {})
+    for concepto in datos["conceptos"]:
+        xml.startElement("cfdi:Concepto", {
+            "ClaveProdServ": concepto["clave_prod_serv"],
+            "Cantidad": str(concepto["cantidad"]),
+            "ClaveUnidad": concepto["clave_unidad"],
+            "Descripcion": concepto["descripcion"],
+            "ValorUnitario": _importe(concepto["valor_unitario"]),
+            "Importe": _importe(concepto["importe"]),
+            "ObjetoImp": "02",
+        })
+        xml.startElement("cfdi:Impuestos", {})
+        xml.startElement("cfdi:Traslados", {})
+        traslado = {"Base": _importe(concepto["importe"])}
+        traslado.update(_TRASLADO_IVA)
+        traslado["Importe"] = _importe(concepto["iva"])
+        xml.startElement("cfdi:Traslado", traslado)
+        xml.endElement("cfdi:Traslado")
+        xml.endElement("cfdi:Traslados")
+        xml.endElement("cfdi:Impuestos")
+        xml.endElement("cfdi:Concepto")
+    xml.endElement("cfdi:Conceptos")
+
+    xml.startElement("cfdi:Impuestos", {"TotalImpuestosTrasladados": _importe(datos["iva"])})
+    xml.startElement("cfdi:Traslados", {})
+    traslado = {"Base": _importe(datos["subtotal"])}
+    traslado.update(_TRASLADO_IVA)
+    traslado["Importe"] = _importe(datos["iva"])
+    xml.startElement("cfdi:Traslado", traslado)
+    xml.endElement("cfdi:Traslado")
+    xml.endElement("cfdi:Traslados")
+    xml.endElement("cfdi:Impuestos")
+
+    xml.endElement("cfdi:Comprobante")
+    xml.endDocument()
+
+
+def renderizar(datos):
+    """CFDI de `datos` como bytes UTF-8"""
+    destino = io.BytesIO()
+    escribir_cfdi(datos, destino)
+    return destino.getvalue()
+
+
+# El XSD se lee una vez por proceso; cada hilo compila su propio XMLSchema, porque el
+# registro de errores de un validador no se puede compartir entre validaciones simultáneas
+_documento_xsd = None
+_esquema_cargado = False
+_lock_esquema = threading.Lock()
+_esquemas = threading.local()
+
+def obtener_esquema():
+    """
+    XSD del CFDI compilado para el hilo actual (Config.CFDI_XSD_RUTA, con sus
+    catálogos en el mismo directorio). None si no está disponible o falta lxml.
+    """
+    global _documento_xsd, _esquema_cargado
+    if not _esquema_cargado:
+        with _lock_esquema:
+            if not _esquema_cargado:
+                ruta = Config.CFDI_XSD_RUTA
+                if not ruta or not os.path.exists(ruta):
+                    logger.warning("XSD de CFDI no encontrado (%s); los CFDI no se validarán", ruta)
+                else:
+                    try:
+                        from lxml import etree
+                        documento = etree.parse(ruta)
+                        _esquemas.esquema = etree.XMLSchema(documento)
+                        _documento_xsd = documento
+                        logger.info("XSD de CFDI cargado: %s", ruta)
+                    except ImportError:
+                        logger.warning("lxml no está instalado; los CFDI no se validarán")
+                    except Exception as e:
+                        logger.error("Error cargando el XSD de CFDI %s: %s", ruta, e)
+                _esquema_cargado = True
+    if _documento_xsd is None:
+        return None
+    esquema = getattr(_esquemas, "esquema", None)
+    if esquema is None:
+        from lxml import etree
+        # Solo la compilación (que lee el árbol compartido) va con el lock
+        with _lock_esquema:
+            esquema = _esquemas.esquema = etree.XMLSchema(_documento_xsd)
+    return esquema
+
+
+def validar(xml):
+    """
+    Valida el CFDI contra el XSD.
+
+    Returns:
+        list: Errores encontrados (vacía si es válido), o None si no hay esquema disponible
+    """
+    esquema = obtener_esquema()
+    if esquema is None:
+        return None
+    from lxml import etree
+    documento = etree.fromstring(xml)
+    # El esquema es del hilo actual: las validaciones de distintos hilos corren en paralelo
+    if esquema.validate(documento):
+        return []
+    return [f"línea {e.line}: {e.message}" for e in esquema.error_log]
+
+
+class PAC:
+    """
+    Proveedor autorizado de certificación. Cada implementación recibe el CFDI
+    (ya sellado por el emisor) y devuelve el UUID y el XML timbrado.
+    """
+    nombre = "base"
+
+    def timbrar(self, xml):
+        """
+        Returns:
+            dict: {"uuid": str, "fecha_timbrado": str, "xml": bytes}
+        """
+        raise NotImplementedError
+
+
+class PACFalso(PAC):
+    """
+    PAC local para desarrollo y pruebas de carga: agrega un TimbreFiscalDigital con
+    un UUID aleatorio. Los CFDI que produce no tienen validez fiscal.
+    """
+    nombre = "falso"
+
+    def __init__(self, latencia=None):
+        self.latencia = Config.CFDI_PAC_LATENCIA if latencia is None else latencia
+
+    def timbrar(self, xml):
+        if self.latencia:
+            time.sleep(self.latencia)
+        folio_fiscal = str(uuid.uuid4()).upper()
+        fecha = datetime.now().strftime(FORMATO_FECHA)
+        timbre = (
+            f'<cfdi:Complemento><tfd:TimbreFiscalDigital xmlns:tfd="{NS_TFD}" '
+            f'xsi:schemaLocation="{NS_TFD} http://www.sat.gob.mx/sitio_internet/cfd/TimbreFiscalDigital/TimbreFiscalDigitalv11.xsd" '
+            f'Version="1.1" UUID="{folio_fiscal}" FechaTimbrado="{fecha}" RfcProvCertif="SPR190613I52" '
+            f'SelloCFD="" NoCertificadoSAT="00000000000000000000" SelloSAT=""/></cfdi:Complemento>'
+        )
+        cierre = b"</cfdi:Comprobante>"
+        return {
+            "uuid": folio_fiscal,
+            "fecha_timbrado": fecha,
+            "xml": xml.replace(cierre, timbre.encode("utf-8") + cierre),
+        }
+
+
+PACS = {"falso": PACFalso}
+
+def crear_pac():
+    """PAC configurado en Config.CFDI_PAC"""
+    if Config.CFDI_PAC not in PACS:
+        raise ValueError(f"PAC desconocido: {Config.CFDI_PAC}")
+    return PACS[Config.CFDI_PAC]()
+
+
+def _timbrar(pac, xml):
+    with span("pac.timbrar", CLIENTE, {"cfdi.pac": pac.nombre}):
+        return pac.timbrar(xml)
+
+
+def _guardar_xml(datos, xml, folio_fiscal=None):
+    emisor = datos["emisor"]
+    # Los folios se repiten entre empresas: cada una guarda sus XML en su carpeta
+    carpeta = Config.CFDI_DIR if emisor["empresa"] == "principal" else os.path.join(Config.CFDI_DIR, emisor["empresa"])
+    os.makedirs(carpeta, exist_ok=True)
+    nombre = f"{emisor['comprobante']['Serie']}{datos['folio']}"
+    if folio_fiscal:
+        nombre += f"_{folio_fiscal}"
+    ruta = os.path.join(carpeta, f"{nombre}.xml")
+    with open(ruta, "wb") as f:
+        f.write(xml)
+    return ruta
+
+
+def emitir_cfdi(factura_id, pac=None):
+    """
+    Genera, valida y timbra el CFDI de una factura guardada y registra el UUID y la
+    ruta del XML en la factura.
+
+    Returns:
+        dict: {"uuid", "ruta_xml"} o None si la factura no existe, no es válida o falló el timbrado
+    """
+    from models import get_db_session, Factura
+
+    db_session = get_db_session()
+    try:
+        datos = cargar_datos(db_session, [factura_id])
+        if not datos:
+            logger.warning("Factura %s no encontrada para generar CFDI", factura_id)
+            return None
+        xml = renderizar(datos[0])
+        errores = validar(xml)
+        if errores:
+            logger.error("CFDI de la factura %s no es válido: %s", factura_id, "; ".join(errores[:5]))
+            return None
+        timbre = _timbrar(pac or crear_pac(), xml)
+        ruta = _guardar_xml(datos[0], timbre["xml"], timbre["uuid"])
+        factura = db_session.get(Factura, factura_id)
+        factura.uuid = timbre["uuid"]
+        factura.ruta_xml = ruta
+        db_session.commit()
+        return {"uuid": timbre["uuid"], "ruta_xml": ruta}
+    except Exception as e:
+        logger.error("Error emitiendo CFDI de la factura %s: %s", factura_id, e)
+        db_session.rollback()
+        return None
+    finally:
+        db_session.close()
+
+
+_ejecutor_timbrado = None
+_ejecutor_timbrado_pid = None
+_ejecutor_timbrado_lock = threading.Lock()
+
+def emitir_cfdi_en_segundo_plano(factura_id):
+    """
+    Programa emitir_cfdi fuera de la solicitud, en un pool del proceso de
+    Config.CFDI_PAC_CONCURRENCIA hilos, con la empresa y la traza actuales.
+    """
+    global _ejecutor_timbrado, _ejecutor_timbrado_pid
+    if _ejecutor_timbrado_pid != os.getpid():
+        with _ejecutor_timbrado_lock:
+            if _ejecutor_timbrado_pid != os.getpid():
+                _ejecutor_timbrado = ThreadPoolExecutor(max_workers=Config.CFDI_PAC_CONCURRENCIA,
+                                                        thread_name_prefix="timbrado")
+                _ejecutor_timbrado_pid = os.getpid()
+    return _ejecutor_timbrado.submit(propagar(emitir_cfdi), factura_id)
+
+
+def _generar_y_validar(datos):
+    # Se ejecuta en los procesos del lote: el XSD se compila una vez por proceso
+    xml = renderizar(datos)
+    return datos["factura_id"], xml, validar(xml)
+
+
+def generar_lote(factura_ids, procesos=None, timbrar=False, pac=None):
+    """
+    Genera y valida muchos CFDI en paralelo (la validación XSD usa CPU, por eso se
+    reparte entre procesos) y, opcionalmente, los timbra con varios hilos.
+
+    Returns:
+        dict: Resumen con generados, inválidos, timbrados, errores y duración
+    """
+    from models import get_db_session, Factura
+
+    inicio = time.perf_counter()
+    procesos = procesos or os.cpu_count() or 1
+    db_session = get_db_session(lectura=True)
+    try:
+        lote = cargar_datos(db_session, factura_ids)
+    finally:
+        db_session.close()
+
+    if procesos > 1 and len(lote) > 1:
+        with ProcessPoolExecutor(max_workers=procesos, initializer=obtener_esquema) as ejecutor:
+            resultados = list(ejecutor.map(_generar_y_validar, lote, chunksize=max(1, len(lote) // (procesos * 4))))
+    else:
+        resultados = [_generar_y_validar(datos) for datos in lote]
+
+    por_id = {datos["factura_id"]: datos for datos in lote}
+    validos, errores = [], []
+    for factura_id, xml, errores_xsd in resultados:
+        if errores_xsd:
+            errores.append({"factura_id": factura_id, "errores": errores_xsd[:5]})
+        else:
+            validos.append((factura_id, xml))
+
+    actualizaciones = []
+    if timbrar:
+        pac = pac or crear_pac()
+
+        def timbrar_y_guardar(factura_id, xml):
+            try:
+                timbre = _timbrar(pac, xml)
+                ruta = _guardar_xml(por_id[factura_id], timbre["xml"], timbre["uuid"])
+                return {"id": factura_id, "uuid": timbre["uuid"], "ruta_xml": ruta}
+            except Exception as e:
+                logger.error("Error timbrando la factura %s: %s", factura_id, e)
+                return None
+
+        with ThreadPoolExecutor(max_workers=Config.CFDI_PAC_CONCURRENCIA, thread_name_prefix="pac") as ejecutor:
+            futuros = [ejecutor.submit(propagar(timbrar_y_guardar), factura_id, xml) for factura_id, xml in validos]
+            actualizaciones = [r for r in (f.result() for f in futuros) if r]
+
+        if actualizaciones:
+            db_session = get_db_session()
+            try:
+                db_session.bulk_update_mappings(Factura, actualizaciones)
+                db_session.commit()
+            finally:
+                db_session.close()
+    else:
+        for factura_id, xml in validos:
+            _guardar_xml(por_id[factura_id], xml)
+
+    return {
+        "facturas": len(lote),
+        "validos": len(validos),
+        "invalidos": len(errores),
+        "validados_xsd": obtener_esquema() is not None,
+        "timbrados": len(actualizaciones),
+        "errores": errores[:20],
+        "duracion_s": round(time.perf_counter() - inicio, 2),
+    }
+
+
+def main(argv=None):
+    from models import get_db_session, Factura
+
+    parser = argparse.ArgumentParser(description="Genera y timbra CFDI 4.0 de las facturas guardadas")
+    parser.add_argument("--desde", help="fecha inicial (AAAA-MM-DD)")
+    parser.add_argument("--hasta", help="fecha final inclusive (AAAA-MM-DD)")
+    parser.add_argument("--ids", help="ids de factura separados por coma")
+    parser.add_argument("--procesos", type=int, default=None, help="procesos para generar y validar")
+    parser.add_argument("--timbrar", action="store_true", help=f"timbrar con el PAC configurado ({Config.CFDI_PAC})")
+    parser.add_argument("--empresa", default="principal", help="id de la empresa emisora (ver empresas.py)")
+    args = parser.parse_args(argv)
+    usar_empresa(empresa_por_id(args.empresa))
+
+    if args.ids:
+        factura_ids = [int(i) for i in args.ids.split(",") if i.strip()]
+    else:
+        db_session = get_db_session(lectura=True)
+        try:
+            consulta = db_session.query(Factura.id)
+            if args.desde:
+                consulta = consulta.filter(Factura.fecha_emision >= datetime.fromisoformat(args.desde))
+            if args.hasta:
+                consulta = consulta.filter(Factura.fecha_emision < datetime.fromisoformat(args.hasta) + timedelta(days=1))
+            factura_ids = [fila.id for fila in consulta.order_by(Factura.id)]
+        finally:
+            db_session.close()
+
+    resumen = generar_lote(factura_ids, args.procesos, args.timbrar)
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+    return 1 if resumen["invalidos"] else 0
+
+
+if __name__ == "__main__":
+    configurar_logging()
+    sys.exit(main())
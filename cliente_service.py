@@ -0,0 +1,65 @@
+# cliente_service.py
+import threading
+import time
+from collections import OrderedDict
+from models import Cliente
+from config import Config
+from empresas import empresa_actual
+
+# Por empresa, RFC -> (id del cliente o None, vencimiento de la entrada negativa), en orden
+# LRU. Cada empresa tiene su propio LRU de `clientes_cache_max` entradas: el tráfico de
+# una nunca desaloja los clientes de otra. Los clientes no se borran, así que un id
+# encontrado no vence; un RFC sin cliente sí, porque otro worker pudo registrarlo y solo
+# este proceso invalida su entrada.
+_ids = {}
+_lock_ids = threading.Lock()
+
+
+class ClienteService:
+    @staticmethod
+    def obtener_id(db_session, rfc, negativos=True):
+        """
+        Id del cliente con ese RFC en la empresa actual, compartido por las solicitudes
+        del proceso
+
+        Args:
+            db_session: Sesión para consultar si el RFC no está en caché
+            rfc (str): RFC ya validado
+            negativos (bool): Aceptar una entrada "sin cliente" del caché; al registrar
+                clientes se pasa False para no duplicar uno que otro worker ya creó
+
+        Returns:
+            int: Id del cliente, o None si el RFC no está registrado
+        """
+        empresa = empresa_actual()
+        with _lock_ids:
+            ids = _ids.get(empresa.id)
+            entrada = ids.get(rfc) if ids else None
+            if entrada is not None:
+                cliente_id, vence = entrada
+                if cliente_id is not None or (negativos and vence > time.monotonic()):
+                    ids.move_to_end(rfc)
+                    return cliente_id
+
+        cliente_id = db_session.query(Cliente.id).filter_by(rfc=rfc).scalar()
+        ClienteService._guardar(empresa, rfc, cliente_id)
+        return cliente_id
+
+    @staticmethod
+    def registrar(rfc, cliente_id):
+        """Reemplaza la entrada del RFC tras confirmar la inserción de su cliente"""
+        ClienteService._guardar(empresa_actual(), rfc, cliente_id)
+
+    @staticmethod
+    def _guardar(empresa, rfc, cliente_id):
+        if empresa.clientes_cache_max <= 0:
+            return
+        vence = None if cliente_id is not None else time.monotonic() + Config.CLIENTES_CACHE_NEGATIVO_S
+        with _lock_ids:
+            ids = _ids.get(empresa.id)
+            if ids is None:
+                ids = _ids[empresa.id] = OrderedDict()
+            ids[rfc] = (cliente_id, vence)
+            ids.move_to_end(rfc)
+            while len(ids) > empresa.clientes_cache_max:
+                ids.popitem(last=False)
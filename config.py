@@ -17,12 +17,154 @@ class Config:
     
     # Base de datos
     DATABASE_URI = os.getenv("DATABASE_URI", "sqlite:///facturas.db")
+    # Réplica de lectura para consultas y catálogo (vacío: se usa DATABASE_URI)
+    DATABASE_REPLICA_URI = os.getenv("DATABASE_REPLICA_URI", "")
+    # SQLite: WAL permite leer mientras otro worker escribe
+    SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").upper()
+    SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    # Pool de conexiones para PostgreSQL (postgresql+psycopg://...)
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    
+    # Empresas emisoras, una por número de WhatsApp receptor (ver empresas.py)
+    EMPRESAS_RUTA = os.getenv("EMPRESAS_RUTA", "empresas.json")
+    # Base de las empresas sin database_uri ni esquema propios ({empresa} = id)
+    EMPRESA_DATABASE_URI = os.getenv("EMPRESA_DATABASE_URI", "sqlite:///facturas_{empresa}.db")
+    # Atender con la empresa principal los mensajes a números no registrados en EMPRESAS_RUTA
+    # (por omisión se rechazan: sus datos acabarían en la base de la principal)
+    EMPRESA_DESCONOCIDA_PRINCIPAL = os.getenv("EMPRESA_DESCONOCIDA_PRINCIPAL", "False").lower() == "true"
+    # Mensajes por minuto de cada empresa sin límite propio (0: sin límite)
+    EMPRESA_LIMITE_POR_MINUTO = int(os.getenv("EMPRESA_LIMITE_POR_MINUTO", "0"))
     
     # LLM
     LLM_MODEL = os.getenv("LLM_MODEL", "llama2:7b")
     LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.0"))
+    # Clasificar y extraer datos en una sola llamada al LLM (en lugar de dos)
+    LLM_MODO_COMBINADO = os.getenv("LLM_MODO_COMBINADO", "False").lower() == "true"
+    # Backend: "ollama" (uno o varios hosts separados por coma) o "stub" (local determinista)
+    LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama").lower()
+    OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", "http://localhost:11434").split(",") if h.strip()]
+    LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+    LLM_MAX_CONCURRENCIA = int(os.getenv("LLM_MAX_CONCURRENCIA", "4"))
+    LLM_CIRCUITO_FALLOS = int(os.getenv("LLM_CIRCUITO_FALLOS", "5"))
+    LLM_CIRCUITO_REPOSO = float(os.getenv("LLM_CIRCUITO_REPOSO", "30"))
+    LLM_STUB_LATENCIA = float(os.getenv("LLM_STUB_LATENCIA", "0.0"))
+    # Micro-batching de clasificaciones concurrentes
+    LLM_LOTES_ACTIVO = os.getenv("LLM_LOTES_ACTIVO", "False").lower() == "true"
+    LLM_LOTE_MAX = int(os.getenv("LLM_LOTE_MAX", "8"))
+    LLM_LOTE_ESPERA_MS = float(os.getenv("LLM_LOTE_ESPERA_MS", "30"))
+    
+    # Embeddings (clasificación de intención y búsqueda de productos por similitud)
+    EMBEDDINGS_ACTIVO = os.getenv("EMBEDDINGS_ACTIVO", "False").lower() == "true"
+    # Backend: "ollama" (modelo de embeddings) o "hash" (local, sin red)
+    EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "ollama").lower()
+    EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+    EMBEDDING_UMBRAL_INTENCION = float(os.getenv("EMBEDDING_UMBRAL_INTENCION", "0.75"))
+    EMBEDDING_UMBRAL_PRODUCTO = float(os.getenv("EMBEDDING_UMBRAL_PRODUCTO", "0.80"))
+    EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", "indices")
+    
+    # Facturación: tasa de IVA trasladado y precio de productos fuera del catálogo
+    IVA_TASA = os.getenv("IVA_TASA", "0.16")
+    PRECIO_POR_DEFECTO = os.getenv("PRECIO_POR_DEFECTO", "100.00")
+    
+    # Catálogo: filas por transacción al importar y cada cuántos segundos cada proceso
+    # revisa si cambió la versión del catálogo para recargar su copia en memoria
+    CATALOGO_LOTE = int(os.getenv("CATALOGO_LOTE", "1000"))
+    CATALOGO_VERIFICAR_S = float(os.getenv("CATALOGO_VERIFICAR_S", "5"))
+    
+    # RFC por empresa en el caché por proceso de RFC -> id de cliente (ver cliente_service.py;
+    # 0: sin caché; cada empresa puede fijar el suyo con `clientes_cache_max`) y
+    # segundos que se recuerda un RFC sin cliente (otro worker pudo registrarlo después)
+    CLIENTES_CACHE_MAX = int(os.getenv("CLIENTES_CACHE_MAX", "10000"))
+    CLIENTES_CACHE_NEGATIVO_S = float(os.getenv("CLIENTES_CACHE_NEGATIVO_S", "30"))
+    
+    # Respuestas de WhatsApp: caracteres por mensaje (Twilio admite hasta 1600) y
+    # mensajes por respuesta antes de pedir "ver más" (ver respuestas.py)
+    RESPUESTA_MAX_CARACTERES = int(os.getenv("RESPUESTA_MAX_CARACTERES", "1500"))
+    RESPUESTA_MAX_MENSAJES = int(os.getenv("RESPUESTA_MAX_MENSAJES", "3"))
+    
+    # CFDI 4.0 (ver cfdi.py)
+    CFDI_ACTIVO = os.getenv("CFDI_ACTIVO", "False").lower() == "true"
+    CFDI_DIR = os.getenv("CFDI_DIR", "cfdi")
+    # cfdv40.xsd del SAT, con sus catálogos (catCFDI.xsd, tdCFDI.xsd) descargados junto a él
+    CFDI_XSD_RUTA = os.getenv("CFDI_XSD_RUTA", "xsd/cfdv40.xsd")
+    # PAC de timbrado: "falso" (local, sin validez fiscal) o uno registrado en cfdi.PACS
+    CFDI_PAC = os.getenv("CFDI_PAC", "falso").lower()
+    CFDI_PAC_CONCURRENCIA = int(os.getenv("CFDI_PAC_CONCURRENCIA", "8"))
+    # Timbrar en segundo plano: la respuesta no espera al PAC (ni incluye el folio fiscal)
+    CFDI_TIMBRADO_DIFERIDO = os.getenv("CFDI_TIMBRADO_DIFERIDO", "False").lower() == "true"
+    CFDI_PAC_LATENCIA = float(os.getenv("CFDI_PAC_LATENCIA", "0.0"))
+    CFDI_SERIE = os.getenv("CFDI_SERIE", "A")
+    CFDI_NO_CERTIFICADO = os.getenv("CFDI_NO_CERTIFICADO", "00000000000000000000")
+    CFDI_EMISOR_RFC = os.getenv("CFDI_EMISOR_RFC", "EKU9003173C9")
+    CFDI_EMISOR_NOMBRE = os.getenv("CFDI_EMISOR_NOMBRE", "ESCUELA KEMPER URGATE")
+    CFDI_EMISOR_REGIMEN = os.getenv("CFDI_EMISOR_REGIMEN", "601")
+    CFDI_LUGAR_EXPEDICION = os.getenv("CFDI_LUGAR_EXPEDICION", "42501")
+    CFDI_FORMA_PAGO = os.getenv("CFDI_FORMA_PAGO", "99")
+    CFDI_METODO_PAGO = os.getenv("CFDI_METODO_PAGO", "PPD")
+    # Valores para clientes y productos sin datos fiscales registrados
+    CFDI_RECEPTOR_REGIMEN = os.getenv("CFDI_RECEPTOR_REGIMEN", "616")
+    CFDI_USO_CFDI = os.getenv("CFDI_USO_CFDI", "S01")
+    CFDI_CLAVE_PROD_SERV = os.getenv("CFDI_CLAVE_PROD_SERV", "01010101")
+    CFDI_CLAVE_UNIDAD = os.getenv("CFDI_CLAVE_UNIDAD", "H87")
     
     # Aplicación
+    # Modo ASGI (asgi.py): hilos para base de datos, PDF y rutas WSGI
+    ASYNC_HILOS = int(os.getenv("ASYNC_HILOS", "32"))
+    # Calentar LLM, catálogo y PDF antes de que el worker se reporte listo en /health
+    WARMUP_ACTIVO = os.getenv("WARMUP_ACTIVO", "False").lower() == "true"
+    
+    # Entrega de PDFs desde memoria (ver entrega_pdf.py): Twilio los descarga de un
+    # enlace firmado y se escriben en disco fuera de la solicitud
+    PDF_ENTREGA_MEMORIA = os.getenv("PDF_ENTREGA_MEMORIA", "False").lower() == "true"
+    # Memoria por worker para PDFs; si se llena, se escriben en disco en la solicitud
+    PDF_MEMORIA_MAX_MB = float(os.getenv("PDF_MEMORIA_MAX_MB", "64"))
+    # Segundos que un PDF ya escrito y no descargado se conserva en memoria
+    PDF_MEMORIA_VIGENCIA_S = float(os.getenv("PDF_MEMORIA_VIGENCIA_S", "300"))
+    # Vigencia de los enlaces firmados
+    PDF_ENLACE_VIGENCIA_S = float(os.getenv("PDF_ENLACE_VIGENCIA_S", "86400"))
+    # Clave para firmar los enlaces, obligatoria con la entrega desde memoria
+    # (distinta en cada despliegue e igual en todos sus workers)
+    PDF_TOKEN_SECRETO = os.getenv("PDF_TOKEN_SECRETO", "")
+    
+    # Mantenimiento en segundo plano (ver mantenimiento.py): catálogo, PDFs antiguos,
+    # estadísticas de la base y resúmenes por cliente
+    MANTENIMIENTO_ACTIVO = os.getenv("MANTENIMIENTO_ACTIVO", "False").lower() == "true"
+    # Cada cuántos segundos un worker intenta tomar las tareas que ejecuta uno solo
+    MANTENIMIENTO_REVISION_S = float(os.getenv("MANTENIMIENTO_REVISION_S", "30"))
+    # Si el worker que tomó una tarea muere, otro puede tomarla pasado este tiempo
+    MANTENIMIENTO_BLOQUEO_S = float(os.getenv("MANTENIMIENTO_BLOQUEO_S", "900"))
+    # Días que se conservan los PDF generados (0: no se borran)
+    MANTENIMIENTO_PDF_DIAS = int(os.getenv("MANTENIMIENTO_PDF_DIAS", "30"))
+    
+    # Captura de tráfico de /webhook para reproducirlo con replay.py
+    CAPTURA_ACTIVA = os.getenv("CAPTURA_ACTIVA", "False").lower() == "true"
+    CAPTURA_RUTA = os.getenv("CAPTURA_RUTA", "captura/webhook.jsonl")
+    CAPTURA_ANONIMIZAR_RFC = os.getenv("CAPTURA_ANONIMIZAR_RFC", "True").lower() == "true"
+    # Sal para los hashes de remitentes y RFC, obligatoria con la captura activa
+    # (distinta en cada despliegue: con una sal conocida los hashes se pueden revertir)
+    CAPTURA_SAL = os.getenv("CAPTURA_SAL", "")
+    
+    # Perfilado por muestreo de solicitudes lentas (ver perfilador.py)
+    PERFILADO_ACTIVO = os.getenv("PERFILADO_ACTIVO", "False").lower() == "true"
+    PERFILADO_UMBRAL_MS = float(os.getenv("PERFILADO_UMBRAL_MS", "2000"))
+    PERFILADO_INTERVALO_MS = float(os.getenv("PERFILADO_INTERVALO_MS", "10"))
+    PERFILADO_MAX_REGISTROS = int(os.getenv("PERFILADO_MAX_REGISTROS", "100"))
+    # Token para los endpoints /admin (sin token los endpoints no existen)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+    
+    # Trazas compatibles con OpenTelemetry (ver trazas.py)
+    TRAZAS_ACTIVAS = os.getenv("TRAZAS_ACTIVAS", "False").lower() == "true"
+    # Exportador: "archivo" (OTLP/JSON, una línea por lote) u "otlp" (collector por HTTP)
+    TRAZAS_EXPORTADOR = os.getenv("TRAZAS_EXPORTADOR", "archivo").lower()
+    TRAZAS_RUTA = os.getenv("TRAZAS_RUTA", "trazas/spans.jsonl")
+    TRAZAS_OTLP_URL = os.getenv("TRAZAS_OTLP_URL", "http://localhost:4318/v1/traces")
+    SERVICIO_NOMBRE = os.getenv("SERVICIO_NOMBRE", "agente-facturacion")
+    # Logging: nivel y formato ("texto" o "json")
+    LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+    LOG_FORMATO = os.getenv("LOG_FORMATO", "texto").lower()
+    
     BASE_URL = os.getenv("BASE_URL", "https://your-app.ngrok-free.app")
     UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "static")
     
\ No newline at end of file
@@ -3,6 +3,9 @@ from fpdf import FPDF
 import os
 import logging
 from config import Config
+from totales import formatear_moneda
+from empresas import empresa_actual
+from entrega_pdf import obtener_entrega_pdf
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -12,30 +15,29 @@ class DocumentGenerator:
         # Asegúrate de que exista el directorio para los PDFs
         os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
     
-    def generar_factura(self, rfc, productos, precios=None):
+    def generar_factura(self, rfc, totales):
         """
         Genera un PDF con la factura para múltiples productos
         
         Args:
             rfc (str): RFC del cliente
-            productos (list): Lista de diccionarios con los productos y cantidades
-                             [{"nombre": "licencia", "cantidad": 2}, ...]
-            precios (dict, optional): Diccionario con los precios de los productos
-                                     {"licencia": 100.0, ...}
+            totales (TotalesFactura): Líneas e importes ya calculados (ver totales.calcular_totales)
         """
+        # Título, color y emisor según la empresa que recibió el mensaje
+        empresa = empresa_actual()
         try:
-            if precios is None:
-                # Si no se proporciona un diccionario de precios, usar precio por defecto
-                precios = {}
-            
             # Generar PDF
             pdf = FPDF()
             pdf.add_page()
             
             # Encabezado
             pdf.set_font("Arial", "B", size=16)
-            pdf.cell(200, 10, txt="FACTURA", ln=1, align="C")
-            pdf.line(10, 25, 200, 25)
+            pdf.set_text_color(*empresa.pdf["color"])
+            pdf.cell(200, 10, txt=empresa.pdf["titulo"], ln=1, align="C")
+            pdf.set_text_color(0, 0, 0)
+            pdf.set_font("Arial", size=10)
+            pdf.cell(200, 6, txt=f"{empresa.nombre} - RFC: {empresa.rfc}", ln=1, align="C")
+            pdf.line(10, 31, 200, 31)
             
             # Información del cliente
             pdf.set_font("Arial", size=12)
@@ -48,41 +50,40 @@ class DocumentGenerator:
             pdf.cell(100, 10, txt="Producto", border=1)
             pdf.cell(30, 10, txt="Cantidad", border=1)
             pdf.cell(30, 10, txt="Precio", border=1)
-            pdf.cell(30, 10, txt="Total", border=1, ln=1)
+            pdf.cell(30, 10, txt="Importe", border=1, ln=1)
             
             pdf.set_font("Arial", size=12)
             
-            # Total general
-            total_general = 0
-            
             # Iterar sobre cada producto
-            for producto in productos:
-                nombre = producto.get("nombre", "Producto")
-                cantidad = producto.get("cantidad", 1)
-                
-                # Obtener precio del producto, o usar precio por defecto
-                precio_unitario = precios.get(nombre.lower(), 100.0)
-                subtotal = float(cantidad) * precio_unitario
-                total_general += subtotal
-                
-                # Agregar línea de producto
-                pdf.cell(100, 10, txt=nombre, border=1)
-                pdf.cell(30, 10, txt=str(cantidad), border=1)
-                pdf.cell(30, 10, txt=f"${precio_unitario:.2f}", border=1)
-                pdf.cell(30, 10, txt=f"${subtotal:.2f}", border=1, ln=1)
+            for linea in totales.lineas:
+                pdf.cell(100, 10, txt=linea.nombre, border=1)
+                pdf.cell(30, 10, txt=str(linea.cantidad), border=1)
+                pdf.cell(30, 10, txt=formatear_moneda(linea.precio_unitario), border=1)
+                pdf.cell(30, 10, txt=formatear_moneda(linea.importe), border=1, ln=1)
             
-            # Total
+            # Subtotal, impuestos y total
+            pdf.cell(160, 10, txt="Subtotal", border=1)
+            pdf.cell(30, 10, txt=formatear_moneda(totales.subtotal), border=1, ln=1)
+            pdf.cell(160, 10, txt=f"IVA ({totales.porcentaje_iva}%)", border=1)
+            pdf.cell(30, 10, txt=formatear_moneda(totales.iva), border=1, ln=1)
             pdf.set_font("Arial", "B", size=12)
             pdf.cell(160, 10, txt="Total", border=1)
-            pdf.cell(30, 10, txt=f"${total_general:.2f}", border=1, ln=1)
+            pdf.cell(30, 10, txt=formatear_moneda(totales.total), border=1, ln=1)
             
             # Guardar archivo
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            filename = f"{Config.UPLOAD_FOLDER}/factura_{rfc}_{timestamp}.pdf"
-            pdf.output(filename)
-            logger.info(f"Factura generada: {filename}")
+            carpeta = Config.UPLOAD_FOLDER if empresa.id == "principal" else f"{Config.UPLOAD_FOLDER}/{empresa.id}"
+            os.makedirs(carpeta, exist_ok=True)
+            filename = f"{carpeta}/factura_{rfc}_{timestamp}.pdf"
+            entrega = obtener_entrega_pdf()
+            if entrega:
+                # Se sirve desde memoria; la escritura en disco queda fuera de la solicitud
+                entrega.guardar(filename, pdf.output(dest="S").encode("latin-1"))
+            else:
+                pdf.output(filename)
+            logger.info("Factura generada: %s", filename)
             
             return filename
         except Exception as e:
-            logger.error(f"Error generando factura: {e}")
+            logger.error("Error generando factura: %s", e)
             return None
\ No newline at end of file
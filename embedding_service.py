@@ -0,0 +1,273 @@
+# embedding_service.py
+import hashlib
+import logging
+import os
+import re
+import threading
+import zlib
+from collections import defaultdict
+import numpy as np
+import ollama
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Ejemplos etiquetados para la clasificación por vecinos más cercanos
+EJEMPLOS_INTENCION = [
+    ("facturar 2 licencias a rfc eku9003173c9", "facturar"),
+    ("necesito factura de 3 monitores y 1 teclado", "facturar"),
+    ("generar factura para 5 servicios de consultoría", "facturar"),
+    ("facturar los siguientes productos 2 mesas 4 sillas", "facturar"),
+    ("quiero facturar 10 horas de soporte al rfc eku9003173c9", "facturar"),
+    ("emitir factura 2 equipos rfc eku9003173c9", "facturar"),
+    ("consultar facturas de rfc eku9003173c9", "consultar"),
+    ("mostrar mis facturas del mes pasado", "consultar"),
+    ("ver facturas pendientes", "consultar"),
+    ("ver facturas del rfc eku9003173c9", "consultar"),
+    ("listar facturas emitidas a rfc eku9003173c9", "consultar"),
+    ("cómo funciona", "ayuda"),
+    ("opciones disponibles", "ayuda"),
+    ("necesito ayuda", "ayuda"),
+    ("no sé cómo usar este servicio", "ayuda"),
+    ("qué puedo hacer aquí", "ayuda"),
+    ("en qué estado está mi factura", "estado"),
+    ("estado de trámite 12345", "estado"),
+    ("seguimiento de factura", "estado"),
+    ("ya quedó mi factura", "estado"),
+    ("hola buenos días", "otro"),
+    ("muchas gracias", "otro"),
+    ("quién ganó el partido", "otro"),
+    ("ok perfecto", "otro"),
+]
+
+
+class HashEmbedder:
+    """
+    Embeddings locales por hashing de n-gramas de caracteres y palabras.
+    Deterministas y sin red; capturan similitud léxica pero no sinónimos.
+    """
+    nombre = "hash"
+
+    def __init__(self, dimension=512):
+        self.dimension = dimension
+
+    def embed(self, textos):
+        matriz = np.zeros((len(textos), self.dimension), dtype=np.float32)
+        for fila, texto in enumerate(textos):
+            for palabra in re.findall(r'\w+', texto.lower()):
+                matriz[fila, zlib.crc32(palabra.encode()) % self.dimension] += 1.0
+                marcada = f" {palabra} "
+                for i in range(len(marcada) - 2):
+                    matriz[fila, zlib.crc32(marcada[i:i + 3].encode()) % self.dimension] += 0.5
+        return matriz
+
+
+class OllamaEmbedder:
+    """Embeddings con un modelo de Ollama (p. ej. nomic-embed-text), en una sola llamada por lote"""
+    nombre = "ollama"
+
+    def __init__(self, host=None, model=None):
+        self.model = model or Config.EMBEDDING_MODEL
+        self.client = ollama.Client(host=host or Config.OLLAMA_HOSTS[0], timeout=Config.LLM_TIMEOUT)
+
+    def embed(self, textos):
+        respuesta = self.client.embed(model=self.model, input=list(textos))
+        return np.asarray(respuesta["embeddings"], dtype=np.float32)
+
+
+def crear_embedder():
+    if Config.EMBEDDING_BACKEND == "hash":
+        return HashEmbedder()
+    return OllamaEmbedder()
+
+
+class IndiceVectorial:
+    """
+    Índice en memoria con búsqueda exacta por similitud coseno sobre una matriz NumPy.
+    Las filas se guardan normalizadas, de modo que la búsqueda es un producto matriz-vector.
+    """
+    def __init__(self, vectores=None, etiquetas=None):
+        if vectores is None:
+            vectores = np.zeros((0, 0), dtype=np.float32)
+        self.matriz = self._normalizar(np.asarray(vectores, dtype=np.float32))
+        self.etiquetas = list(etiquetas or [])
+
+    @staticmethod
+    def _normalizar(matriz):
+        if matriz.size == 0:
+            return matriz
+        normas = np.linalg.norm(matriz, axis=-1, keepdims=True)
+        normas[normas == 0] = 1.0
+        return matriz / normas
+
+    def __len__(self):
+        return len(self.etiquetas)
+
+    def buscar(self, vector, k=1):
+        """Devuelve hasta k pares (etiqueta, similitud) ordenados de mayor a menor"""
+        if not len(self):
+            return []
+        similitudes = self.matriz @ self._normalizar(np.asarray(vector, dtype=np.float32))
+        k = min(k, len(self))
+        mejores = np.argpartition(-similitudes, k - 1)[:k]
+        mejores = mejores[np.argsort(-similitudes[mejores])]
+        return [(self.etiquetas[i], float(similitudes[i])) for i in mejores]
+
+    def guardar(self, ruta, huella=""):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        temporal = f"{ruta}.tmp.npz"
+        # Etiquetas como arreglo de texto (intenciones) o de enteros (ids de producto):
+        # el archivo se carga sin pickle, así que no puede ejecutar código al leerse
+        etiquetas = np.asarray(self.etiquetas)
+        if etiquetas.size and etiquetas.dtype.kind not in "iuU":
+            raise ValueError(f"Etiquetas no serializables sin pickle: {etiquetas.dtype}")
+        np.savez(temporal, matriz=self.matriz, etiquetas=etiquetas, huella=np.asarray(huella))
+        os.replace(temporal, ruta)
+
+    @classmethod
+    def cargar(cls, ruta):
+        """Devuelve (indice, huella) o (None, None) si no existe o no se puede leer"""
+        try:
+            with np.load(ruta, allow_pickle=False) as datos:
+                indice = cls()
+                indice.matriz = datos["matriz"]
+                indice.etiquetas = datos["etiquetas"].tolist()
+                return indice, str(datos["huella"])
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            logger.warning("No se pudo cargar el índice %s: %s", ruta, e)
+            return None, None
+
+
+def _huella(embedder, textos):
+    h = hashlib.sha1(f"{embedder.nombre}:{getattr(embedder, 'model', '')}".encode())
+    for texto in textos:
+        h.update(texto.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _indice_persistido(embedder, nombre_archivo, textos, etiquetas):
+    """Carga el índice desde disco si su huella coincide; si no, lo construye y lo guarda"""
+    ruta = os.path.join(Config.EMBEDDINGS_DIR, nombre_archivo)
+    huella = _huella(embedder, textos)
+    indice, huella_guardada = IndiceVectorial.cargar(ruta)
+    if indice is not None and huella_guardada == huella:
+        return indice
+
+    indice = IndiceVectorial(embedder.embed(textos) if textos else None, etiquetas)
+    try:
+        indice.guardar(ruta, huella)
+    except OSError as e:
+        logger.warning("No se pudo guardar el índice %s: %s", ruta, e)
+    logger.info("Índice %s construido con %s vectores", nombre_archivo, len(indice))
+    return indice
+
+
+class ClasificadorIntencionEmbeddings:
+    """
+    Clasificación de intención por vecinos más cercanos sobre ejemplos etiquetados.
+    Si la similitud no supera el umbral se devuelve None para delegar en el LLM.
+    """
+    def __init__(self, embedder, ejemplos=None, umbral=None, k=3):
+        ejemplos = ejemplos or EJEMPLOS_INTENCION
+        self.embedder = embedder
+        self.umbral = Config.EMBEDDING_UMBRAL_INTENCION if umbral is None else umbral
+        self.k = k
+        self.indice = _indice_persistido(
+            embedder, "intenciones.npz",
+            [texto for texto, _ in ejemplos], [intencion for _, intencion in ejemplos]
+        )
+
+    def clasificar(self, mensaje):
+        """Devuelve (intencion, similitud); intencion es None si no hay suficiente confianza"""
+        vecinos = self.indice.buscar(self.embedder.embed([mensaje])[0], k=self.k)
+        if not vecinos:
+            return None, 0.0
+
+        # Voto ponderado por similitud entre los k vecinos
+        votos = defaultdict(float)
+        for intencion, similitud in vecinos:
+            votos[intencion] += similitud
+        intencion = max(votos, key=votos.get)
+        similitud = max(s for i, s in vecinos if i == intencion)
+        if similitud < self.umbral:
+            return None, similitud
+        return intencion, similitud
+
+
+class IndiceProductos:
+    """
+    Índice de nombres y descripciones de Producto para encontrar sinónimos
+    ("laptop" frente a "computadora portátil"). Se reconstruye solo cuando cambia el catálogo.
+    """
+    def __init__(self, embedder, umbral=None, nombre_archivo="productos.npz"):
+        self.embedder = embedder
+        self.umbral = Config.EMBEDDING_UMBRAL_PRODUCTO if umbral is None else umbral
+        self.nombre_archivo = nombre_archivo
+        self.indice = IndiceVectorial()
+        self._huella = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _texto(producto):
+        return f"{producto.nombre} {producto.descripcion or ''}".strip().lower()
+
+    def sincronizar(self, productos, version=None):
+        """
+        Args:
+            productos (list): Productos del catálogo
+            version (int, optional): Versión del catálogo; si no cambió no se recalcula la huella
+        """
+        if version is not None and version == self._version:
+            return
+        textos = [self._texto(p) for p in productos]
+        huella = _huella(self.embedder, textos)
+        if huella == self._huella:
+            self._version = version
+            return
+        with self._lock:
+            if huella != self._huella:
+                self.indice = _indice_persistido(self.embedder, self.nombre_archivo, textos, [p.id for p in productos])
+                self._huella = huella
+            self._version = version
+
+    def buscar(self, nombre):
+        """Devuelve (producto_id, similitud); producto_id es None si no supera el umbral"""
+        vecinos = self.indice.buscar(self.embedder.embed([nombre.lower()])[0], k=1)
+        if not vecinos or vecinos[0][1] < self.umbral:
+            return None, (vecinos[0][1] if vecinos else 0.0)
+        return vecinos[0]
+
+
+_servicio = {}
+_servicio_lock = threading.Lock()
+
+def obtener_clasificador_intencion():
+    """Clasificador por embeddings compartido en el proceso (se crea en el primer uso)"""
+    with _servicio_lock:
+        if "clasificador" not in _servicio:
+            _servicio["clasificador"] = ClasificadorIntencionEmbeddings(_obtener_embedder())
+        return _servicio["clasificador"]
+
+def obtener_indice_productos(empresa=None):
+    """
+    Índice del catálogo de `empresa` (por defecto la de la solicitud actual), compartido
+    en el proceso. Cada empresa tiene su propio índice y archivo, así que sincronizar
+    un catálogo nunca invalida el de otra empresa.
+    """
+    from empresas import empresa_actual
+    empresa = empresa or empresa_actual()
+    clave = f"productos:{empresa.id}"
+    with _servicio_lock:
+        if clave not in _servicio:
+            nombre_archivo = "productos.npz" if empresa.id == "principal" else f"productos_{empresa.id}.npz"
+            _servicio[clave] = IndiceProductos(_obtener_embedder(), nombre_archivo=nombre_archivo)
+        return _servicio[clave]
+
+def _obtener_embedder():
+    if "embedder" not in _servicio:
+        _servicio["embedder"] = crear_embedder()
+    return _servicio["embedder"]
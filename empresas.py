@@ -0,0 +1,171 @@
+# empresas.py
+"""
+Empresas emisoras (multi-tenant). Cada empresa se identifica por el número de
+WhatsApp que recibe los mensajes (`To`) y tiene su propia base de datos o esquema
+(catálogo, clientes y facturas), índice de catálogo, plantilla de PDF, datos del
+emisor para el CFDI y límite de mensajes por minuto.
+
+Las empresas se definen en Config.EMPRESAS_RUTA (JSON):
+
+    [
+      {"id": "acme", "numero": "whatsapp:+5215512345678", "nombre": "ACME SA DE CV",
+       "rfc": "AAA010101AAA", "regimen_fiscal": "601", "lugar_expedicion": "06000",
+       "esquema": "acme", "limite_por_minuto": 120, "clientes_cache_max": 50000,
+       "pdf": {"titulo": "ACME - FACTURA", "color": [0, 70, 140]}}
+    ]
+
+Sin archivo se usa la empresa "principal", configurada con las variables de
+entorno de siempre. Con empresas registradas, los mensajes a otros números se
+rechazan salvo Config.EMPRESA_DESCONOCIDA_PRINCIPAL.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_empresa = ContextVar("empresa", default=None)
+
+
+class LimitadorTasa:
+    """Token bucket por empresa: `por_minuto` mensajes con ráfagas del mismo tamaño"""
+    def __init__(self, por_minuto):
+        self.capacidad = float(por_minuto)
+        self.tokens = float(por_minuto)
+        self.por_segundo = por_minuto / 60.0
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        with self._lock:
+            ahora = time.monotonic()
+            self.tokens = min(self.capacidad, self.tokens + (ahora - self._ultimo) * self.por_segundo)
+            self._ultimo = ahora
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class Empresa:
+    def __init__(self, id, numero, nombre, rfc, regimen_fiscal, lugar_expedicion,
+                 serie=None, database_uri=None, database_replica_uri=None, esquema=None,
+                 limite_por_minuto=None, pdf=None, clientes_cache_max=None):
+        self.id = id
+        self.numero = numero
+        self.nombre = nombre
+        self.rfc = rfc
+        self.regimen_fiscal = regimen_fiscal
+        self.lugar_expedicion = lugar_expedicion
+        self.serie = serie or Config.CFDI_SERIE
+        # Base propia, o un esquema dentro de la base compartida (PostgreSQL)
+        self.esquema = esquema
+        if database_uri:
+            self.database_uri = database_uri
+        elif esquema:
+            self.database_uri = Config.DATABASE_URI
+        else:
+            self.database_uri = Config.EMPRESA_DATABASE_URI.format(empresa=id)
+        self.database_replica_uri = database_replica_uri or ("" if database_uri or not esquema else Config.DATABASE_REPLICA_URI)
+        self.pdf = {"titulo": "FACTURA", "color": [0, 0, 0]}
+        self.pdf.update(pdf or {})
+        limite = Config.EMPRESA_LIMITE_POR_MINUTO if limite_por_minuto is None else limite_por_minuto
+        self.limitador = LimitadorTasa(limite) if limite else None
+        # RFC en el caché de clientes de la empresa (ver cliente_service.py)
+        self.clientes_cache_max = Config.CLIENTES_CACHE_MAX if clientes_cache_max is None else clientes_cache_max
+
+    def permite_mensaje(self):
+        return self.limitador is None or self.limitador.permitir()
+
+    def __repr__(self):
+        return f"<Empresa(id='{self.id}', numero='{self.numero}')>"
+
+
+def _empresa_principal():
+    empresa = Empresa(
+        id="principal",
+        numero=Config.TWILIO_PHONE_NUMBER,
+        nombre=Config.CFDI_EMISOR_NOMBRE,
+        rfc=Config.CFDI_EMISOR_RFC,
+        regimen_fiscal=Config.CFDI_EMISOR_REGIMEN,
+        lugar_expedicion=Config.CFDI_LUGAR_EXPEDICION,
+        database_uri=Config.DATABASE_URI,
+        database_replica_uri=Config.DATABASE_REPLICA_URI,
+    )
+    return empresa
+
+
+_registro = None
+_lock_registro = threading.Lock()
+
+def obtener_empresas():
+    """Empresas registradas por número de WhatsApp (se cargan una vez por proceso)"""
+    global _registro
+    if _registro is None:
+        with _lock_registro:
+            if _registro is None:
+                principal = _empresa_principal()
+                registro = {"principal": principal, "por_numero": {}}
+                if Config.EMPRESAS_RUTA and os.path.exists(Config.EMPRESAS_RUTA):
+                    with open(Config.EMPRESAS_RUTA, encoding="utf-8") as f:
+                        for datos in json.load(f):
+                            empresa = Empresa(**datos)
+                            registro["por_numero"][empresa.numero] = empresa
+                    logger.info("Empresas registradas: %s", ", ".join(e.id for e in registro["por_numero"].values()))
+                _registro = registro
+    return _registro
+
+
+def empresa_principal():
+    return obtener_empresas()["principal"]
+
+
+def todas_las_empresas():
+    registro = obtener_empresas()
+    return [registro["principal"]] + list(registro["por_numero"].values())
+
+
+def empresa_por_numero(numero):
+    """
+    Empresa que recibe en `numero` (el `To` de Twilio). Sin `To` (página de prueba,
+    benchmarks) o sin empresas registradas es la principal.
+
+    Returns:
+        Empresa: La empresa del número, o None si hay empresas registradas y el número
+            no es de ninguna (salvo Config.EMPRESA_DESCONOCIDA_PRINCIPAL)
+    """
+    registro = obtener_empresas()
+    principal = registro["principal"]
+    empresa = registro["por_numero"].get(numero)
+    if empresa is not None:
+        return empresa
+    if not numero or not registro["por_numero"] or numero == principal.numero:
+        return principal
+    if Config.EMPRESA_DESCONOCIDA_PRINCIPAL:
+        logger.warning("Número receptor no registrado, se usa la empresa principal: %s", numero)
+        return principal
+    # Un número mal configurado escribiría facturas y clientes de otra empresa en la base principal
+    logger.warning("Número receptor no registrado, se rechaza el mensaje: %s", numero)
+    return None
+
+
+def empresa_por_id(empresa_id):
+    for empresa in todas_las_empresas():
+        if empresa.id == empresa_id:
+            return empresa
+    raise KeyError(f"Empresa desconocida: {empresa_id}")
+
+
+def usar_empresa(empresa):
+    """Asocia la ejecución actual (solicitud, trabajo en segundo plano) a `empresa`"""
+    _empresa.set(empresa)
+    return empresa
+
+
+def empresa_actual():
+    """Empresa de la ejecución actual; la principal fuera de una solicitud"""
+    return _empresa.get() or empresa_principal()
@@ -0,0 +1,240 @@
+# entrega_pdf.py
+"""
+Entrega de PDFs desde memoria.
+
+Con Config.PDF_ENTREGA_MEMORIA el PDF recién generado no se escribe en disco dentro
+de la solicitud: queda en un caché en memoria acotado (Config.PDF_MEMORIA_MAX_MB) y
+un hilo lo escribe en UPLOAD_FOLDER después. Twilio lo descarga de
+BASE_URL/pdf/<token>, un enlace firmado (HMAC) con la ruta y su vencimiento, y se le
+sirve directamente desde memoria. Si la descarga llega a otro worker o el PDF ya salió
+del caché, se sirve desde disco.
+
+Un PDF que no cabe en el caché se escribe en disco en el momento (como sin este modo).
+Si la escritura falla se reintenta unas veces; después el PDF solo vive en memoria
+hasta descargarse o vencer.
+"""
+import atexit
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Intentos de escritura de cada PDF y espera antes del siguiente (se multiplica por el intento)
+_INTENTOS_ESCRITURA = 3
+_ESPERA_REINTENTO_S = 1.0
+
+
+def ruta_publica(pdf_path):
+    """Ruta relativa a UPLOAD_FOLDER: los PDFs de cada empresa están en su subcarpeta"""
+    return os.path.relpath(pdf_path, Config.UPLOAD_FOLDER).replace(os.sep, "/")
+
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode("ascii")
+
+
+def _firma(carga):
+    if not Config.PDF_TOKEN_SECRETO:
+        # Sin clave cualquiera podría firmar enlaces a cualquier PDF de UPLOAD_FOLDER
+        raise ValueError("PDF_TOKEN_SECRETO no está configurada")
+    return _b64(hmac.new(Config.PDF_TOKEN_SECRETO.encode("utf-8"), carga.encode("utf-8"), hashlib.sha256).digest()[:16])
+
+
+def firmar(pdf_path, vigencia=None):
+    """Token con la ruta pública del PDF y su vencimiento"""
+    expira = int(time.time() + (vigencia or Config.PDF_ENLACE_VIGENCIA_S))
+    carga = f"{ruta_publica(pdf_path)}|{expira}"
+    return f"{_b64(carga.encode('utf-8'))}.{_firma(carga)}"
+
+
+def verificar(token):
+    """
+    Returns:
+        str: Ruta pública del PDF, o None si la firma no es válida o el enlace venció
+    """
+    try:
+        parte, firma = token.split(".", 1)
+        carga = base64.urlsafe_b64decode(parte + "=" * (-len(parte) % 4)).decode("utf-8")
+        ruta, expira = carga.rsplit("|", 1)
+        if not hmac.compare_digest(firma, _firma(carga)) or int(expira) < time.time():
+            return None
+    except (ValueError, UnicodeDecodeError):
+        return None
+    # La ruta viene firmada, pero nunca debe salir de UPLOAD_FOLDER
+    if ruta.startswith("/") or ".." in ruta.split("/"):
+        return None
+    return ruta
+
+
+def url_publica(pdf_path):
+    return f"{Config.BASE_URL}/pdf/{firmar(pdf_path)}"
+
+
+def _escribir(pdf_path, contenido):
+    # Escritura atómica: la lectura desde disco nunca ve un PDF a medias
+    os.makedirs(os.path.dirname(pdf_path) or ".", exist_ok=True)
+    temporal = f"{pdf_path}.{os.getpid()}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(contenido)
+    os.replace(temporal, pdf_path)
+
+
+class _PDFEnMemoria:
+    def __init__(self, pdf_path, contenido):
+        self.pdf_path = pdf_path
+        self.contenido = contenido
+        self.creado = time.monotonic()
+        self.persistido = False
+        self.entregado = False
+        self.intentos = 0
+        # Sin copia en disco tras agotar los intentos: sale al descargarse o vencer
+        self.fallido = False
+
+    @property
+    def liberable(self):
+        return self.persistido or self.fallido
+
+
+class EntregaPDF:
+    """
+    Caché de PDFs por ruta pública con un límite en bytes. Los PDFs pendientes de
+    escribir nunca se descartan; los ya escritos (o cuya escritura falló) salen al ser
+    descargados, al vencer Config.PDF_MEMORIA_VIGENCIA_S o cuando hace falta espacio
+    (los más antiguos primero).
+    """
+    def __init__(self, max_bytes=None, vigencia=None):
+        if not Config.PDF_TOKEN_SECRETO:
+            raise ValueError("PDF_ENTREGA_MEMORIA requiere PDF_TOKEN_SECRETO")
+        self.max_bytes = max_bytes or int(Config.PDF_MEMORIA_MAX_MB * 1024 * 1024)
+        self.vigencia = vigencia or Config.PDF_MEMORIA_VIGENCIA_S
+        self._pdfs = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._cola = queue.Queue()
+        self._pid = None
+        self._metricas = Counter()
+        atexit.register(self.vaciar)
+
+    def _asegurar_hilo(self):
+        # El hilo que escribe en disco se crea en el primer uso y de nuevo tras un fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._ejecutar, name="entrega-pdf", daemon=True).start()
+
+    def guardar(self, pdf_path, contenido):
+        """Deja el PDF listo para descargarse y programa su escritura en `pdf_path`"""
+        self._asegurar_hilo()
+        clave = ruta_publica(pdf_path)
+        with self._lock:
+            self._liberar(len(contenido))
+            cabe = self._bytes + len(contenido) <= self.max_bytes
+            if cabe:
+                anterior = self._pdfs.pop(clave, None)
+                if anterior:
+                    self._bytes -= len(anterior.contenido)
+                self._pdfs[clave] = _PDFEnMemoria(pdf_path, contenido)
+                self._bytes += len(contenido)
+                self._metricas["en_memoria"] += 1
+        if not cabe:
+            # Caché lleno de PDFs pendientes: se escribe ya, como sin este modo
+            self._metricas["en_disco"] += 1
+            _escribir(pdf_path, contenido)
+            return
+        self._cola.put(clave)
+
+    def obtener(self, ruta, contar_fallo=True):
+        """Contenido del PDF si está en memoria (None: servirlo desde disco)"""
+        with self._lock:
+            pdf = self._pdfs.get(ruta)
+            if pdf is None:
+                if contar_fallo:
+                    self._metricas["fallos"] += 1
+                return None
+            pdf.entregado = True
+            self._metricas["aciertos"] += 1
+            if pdf.persistido:
+                self._descartar(ruta)
+            return pdf.contenido
+
+    def _descartar(self, clave):
+        pdf = self._pdfs.pop(clave)
+        self._bytes -= len(pdf.contenido)
+
+    def _liberar(self, necesarios):
+        # Se llama con el lock tomado
+        ahora = time.monotonic()
+        for clave, pdf in list(self._pdfs.items()):
+            if not pdf.liberable:
+                continue
+            if pdf.entregado or ahora - pdf.creado > self.vigencia or self._bytes + necesarios > self.max_bytes:
+                self._descartar(clave)
+                if pdf.fallido:
+                    self._metricas["perdidos"] += 1
+
+    def _ejecutar(self):
+        while True:
+            self._persistir(self._cola.get())
+
+    def _persistir(self, clave, reintentar=True):
+        with self._lock:
+            pdf = self._pdfs.get(clave)
+            if pdf is None or pdf.liberable:
+                return
+            pdf.intentos += 1
+        try:
+            _escribir(pdf.pdf_path, pdf.contenido)
+        except OSError as e:
+            self._metricas["errores_escritura"] += 1
+            if reintentar and pdf.intentos < _INTENTOS_ESCRITURA:
+                logger.warning("Error guardando PDF %s (intento %s): %s", pdf.pdf_path, pdf.intentos, e)
+                temporizador = threading.Timer(_ESPERA_REINTENTO_S * pdf.intentos, self._cola.put, args=(clave,))
+                temporizador.daemon = True
+                temporizador.start()
+                return
+            # Solo queda en memoria: otro worker no puede servirlo desde disco
+            logger.error("No se pudo guardar el PDF %s: %s", pdf.pdf_path, e)
+            with self._lock:
+                pdf.fallido = True
+            return
+        with self._lock:
+            pdf.persistido = True
+            if pdf.entregado and self._pdfs.get(clave) is pdf:
+                self._descartar(clave)
+
+    def vaciar(self):
+        """Escribe los PDFs pendientes (al salir del proceso)"""
+        while True:
+            try:
+                self._persistir(self._cola.get_nowait(), reintentar=False)
+            except queue.Empty:
+                return
+
+    def metricas(self):
+        with self._lock:
+            return dict(self._metricas, pdfs=len(self._pdfs), bytes=self._bytes)
+
+
+_entrega = None
+_entrega_lock = threading.Lock()
+
+def obtener_entrega_pdf():
+    """Caché de entrega compartido del proceso, o None si los PDFs se escriben en disco en la solicitud"""
+    global _entrega
+    if not Config.PDF_ENTREGA_MEMORIA:
+        return None
+    if _entrega is None:
+        with _entrega_lock:
+            if _entrega is None:
+                _entrega = EntregaPDF()
+    return _entrega
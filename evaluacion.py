@@ -0,0 +1,428 @@
+# evaluacion.py
+"""
+Evaluación fuera de línea de las estrategias de clasificación y extracción.
+
+Ejecuta un corpus etiquetado (JSONL) con cada estrategia, en paralelo, y reporta por
+estrategia la matriz de confusión y precisión/recall por intención, la exactitud de
+los campos extraídos (RFC y productos), los tokens del LLM y el tiempo por mensaje.
+El resultado se guarda en JSON para comparar entre prompts, modelos o commits.
+Funciona con Ollama local o con el backend stub, sin red.
+
+Estrategias:
+    regex       MessageParser (clasificación y extracción por expresiones regulares)
+    llm         prompt de clasificación y prompt de extracción (dos llamadas)
+    combinado   prompt combinado (una llamada, LLM_MODO_COMBINADO)
+    embeddings  clasificador por embeddings con el LLM como respaldo
+    lotes       micro-batching de clasificaciones concurrentes
+    pipeline    la configuración actual, como la usa app.procesar_mensaje
+
+Formato del corpus (una línea por mensaje; rfc y productos son opcionales):
+    {"mensaje": "Facturar 2 licencias a RFC XAXX010101000", "intencion": "facturar",
+     "rfc": "XAXX010101000", "productos": [{"nombre": "licencias", "cantidad": 2}]}
+
+Uso:
+    python evaluacion.py corpus captura/webhook.jsonl corpus.jsonl    # desde una captura
+    python evaluacion.py sintetico corpus.jsonl --mensajes 500
+    python evaluacion.py evaluar corpus.jsonl --estrategias regex,llm,combinado --hilos 8
+    python evaluacion.py evaluar corpus.jsonl --backend ollama --modelo llama3:8b --comparar anterior.json
+"""
+import argparse
+import contextvars
+import json
+import logging
+import os
+import random
+import secrets
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from config import Config
+from message_parser import MessageParser
+
+logger = logging.getLogger(__name__)
+
+CATEGORIAS = ["facturar", "consultar", "ayuda", "estado", "otro"]
+
+PLANTILLAS_ESTADO = ["Estado de mi factura para RFC {rfc}", "Seguimiento de mi trámite", "¿En qué estado está mi factura?"]
+
+MAX_EJEMPLOS = 20
+
+
+# Corpus
+
+def leer_corpus(ruta):
+    with open(ruta, encoding="utf-8") as f:
+        casos = [json.loads(linea) for linea in f if linea.strip()]
+    for numero, caso in enumerate(casos, 1):
+        if caso.get("intencion") not in CATEGORIAS:
+            raise ValueError(f"línea {numero}: intención inválida {caso.get('intencion')!r}")
+    return casos
+
+
+def escribir_corpus(casos, ruta):
+    with open(ruta, "w", encoding="utf-8") as f:
+        for caso in casos:
+            f.write(json.dumps(caso, ensure_ascii=False) + "\n")
+
+
+def corpus_desde_captura(ruta_captura):
+    """
+    Mensajes únicos de una captura de tráfico (captura.py) con los RFC sustituidos por
+    seudónimos. Las etiquetas se proponen con MessageParser y quedan con "revisar": true
+    hasta que una persona las confirme.
+    """
+    from captura import anonimizar_mensaje
+    if not Config.CAPTURA_SAL:
+        # Los seudónimos solo tienen que ser estables dentro de este corpus
+        Config.CAPTURA_SAL = secrets.token_hex(16)
+    vistos, casos = set(), []
+    with open(ruta_captura, encoding="utf-8") as f:
+        for linea in f:
+            if not linea.strip():
+                continue
+            mensaje = anonimizar_mensaje(json.loads(linea).get("body", "")).strip()
+            if not mensaje or mensaje.lower() in vistos:
+                continue
+            vistos.add(mensaje.lower())
+            intencion = MessageParser.clasificar_intencion(mensaje)
+            caso = {"mensaje": mensaje, "intencion": intencion, "revisar": True}
+            datos = _extraer_regex(intencion, mensaje)
+            if intencion in ("facturar", "consultar"):
+                caso["rfc"] = datos["rfc"]
+            if intencion == "facturar":
+                caso["productos"] = datos["productos"]
+            casos.append(caso)
+    return casos
+
+
+def corpus_sintetico(cantidad, semilla=42):
+    """Mensajes etiquetados a partir de las plantillas de benchmark.py, con todas las intenciones por igual"""
+    from benchmark import PLANTILLAS, PRODUCTOS, generar_rfc
+    plantillas = dict(PLANTILLAS, estado=PLANTILLAS_ESTADO)
+    rng = random.Random(semilla)
+    rfcs = [generar_rfc(rng) for _ in range(50)]
+    casos = []
+    for _ in range(cantidad):
+        intencion = rng.choice(CATEGORIAS)
+        plantilla = rng.choice(plantillas[intencion])
+        p, q = rng.sample(PRODUCTOS, 2)
+        n, m = rng.randint(1, 20), rng.randint(1, 20)
+        rfc = rng.choice(rfcs)
+        caso = {"mensaje": plantilla.format(n=n, m=m, p=p, q=q, rfc=rfc), "intencion": intencion}
+        if intencion in ("facturar", "consultar"):
+            caso["rfc"] = rfc
+        if intencion == "facturar":
+            caso["productos"] = [{"nombre": p, "cantidad": n}]
+            if "{q}" in plantilla:
+                caso["productos"].append({"nombre": q, "cantidad": m})
+        casos.append(caso)
+    return casos
+
+
+# Estrategias: cada una devuelve una función mensaje -> {"intencion", "rfc", "productos"}
+
+def _extraer_regex(intencion, mensaje):
+    if intencion == "facturar":
+        datos = MessageParser.extraer_datos_factura(mensaje)
+        return {"rfc": datos["rfc"], "productos": datos["productos"]}
+    if intencion == "consultar":
+        return {"rfc": MessageParser.extraer_datos_consulta(mensaje)["rfc"], "productos": []}
+    return {"rfc": None, "productos": []}
+
+
+def _servicio_ia(backend, embeddings=False, lotes=False):
+    from ai_services import IAService, ClasificadorPorLotes
+    ia = IAService(backend)
+    ia.embeddings = None
+    ia.lotes = None
+    if embeddings:
+        from embedding_service import obtener_clasificador_intencion
+        ia.embeddings = obtener_clasificador_intencion()
+    if lotes:
+        ia.lotes = ClasificadorPorLotes(backend, ia._clasificar_con_llm)
+    return ia
+
+
+def _resultado(intencion, datos):
+    datos = datos or {}
+    return {"intencion": intencion, "rfc": datos.get("rfc"), "productos": datos.get("productos") or []}
+
+
+def estrategia_regex(backend):
+    def ejecutar(mensaje):
+        intencion = MessageParser.clasificar_intencion(mensaje)
+        return _resultado(intencion, _extraer_regex(intencion, mensaje))
+    return ejecutar
+
+
+def estrategia_llm(backend):
+    ia = _servicio_ia(backend)
+
+    def ejecutar(mensaje):
+        # Sin respaldo determinista: se mide el prompt tal cual
+        intencion = ia._clasificar_con_llm(mensaje)
+        if intencion == "facturar":
+            return _resultado(intencion, ia.extraer_detalles_con_llm(mensaje))
+        return _resultado(intencion, _extraer_regex(intencion, mensaje))
+    return ejecutar
+
+
+def estrategia_combinado(backend):
+    from ai_services import IAService, PROMPT_COMBINADO
+
+    def ejecutar(mensaje):
+        resultado = IAService._interpretar_combinado(
+            backend.generar(PROMPT_COMBINADO.format(mensaje=mensaje)),
+            {"intencion": "otro", "rfc": None, "productos": []}
+        )
+        if resultado["intencion"] == "consultar":
+            # Las consultas usan siempre el RFC de las expresiones regulares (ver app.py)
+            return _resultado("consultar", _extraer_regex("consultar", mensaje))
+        return resultado
+    return ejecutar
+
+
+def _con_pipeline(ia, combinado):
+    def ejecutar(mensaje):
+        # Mismo orden que app.procesar_mensaje: regex primero y el LLM solo si falla
+        if combinado:
+            resultado = ia.clasificar_y_extraer(mensaje)
+            intencion, datos_llm = resultado["intencion"], resultado
+        else:
+            intencion, datos_llm = ia.clasificar_mensaje(mensaje), None
+        datos = _extraer_regex(intencion, mensaje)
+        if intencion == "facturar" and not datos["productos"] and not datos["rfc"]:
+            datos = datos_llm if datos_llm is not None else ia.extraer_detalles_con_llm(mensaje)
+        return _resultado(intencion, datos)
+    return ejecutar
+
+
+def estrategia_embeddings(backend):
+    return _con_pipeline(_servicio_ia(backend, embeddings=True), combinado=False)
+
+
+def estrategia_lotes(backend):
+    return _con_pipeline(_servicio_ia(backend, lotes=True), combinado=False)
+
+
+def estrategia_pipeline(backend):
+    ia = _servicio_ia(backend, embeddings=Config.EMBEDDINGS_ACTIVO, lotes=Config.LLM_LOTES_ACTIVO)
+    return _con_pipeline(ia, combinado=Config.LLM_MODO_COMBINADO)
+
+
+ESTRATEGIAS = {
+    "regex": estrategia_regex,
+    "llm": estrategia_llm,
+    "combinado": estrategia_combinado,
+    "embeddings": estrategia_embeddings,
+    "lotes": estrategia_lotes,
+    "pipeline": estrategia_pipeline,
+}
+
+
+# Métricas
+
+def _normalizar_productos(productos):
+    normalizados = Counter()
+    for producto in productos or []:
+        try:
+            nombre = re.sub(r"\s+", " ", str(producto["nombre"]).lower()).strip()
+            normalizados[(nombre, int(producto.get("cantidad", 1)))] += 1
+        except (KeyError, TypeError, ValueError, AttributeError):
+            normalizados[("<inválido>", 0)] += 1
+    return normalizados
+
+
+def _evaluar_caso(ejecutar, caso):
+    from llm_backends import contar_tokens
+    from ai_services import IAService
+    tokens = contar_tokens()
+    inicio = time.perf_counter()
+    try:
+        # El mismo preprocesamiento que recibe el pipeline
+        resultado, error = ejecutar(IAService.preprocesar_mensaje(caso["mensaje"].lower())), None
+    except Exception as e:
+        resultado, error = _resultado("otro", None), str(e)
+    return {"ms": (time.perf_counter() - inicio) * 1000, "tokens": dict(tokens), "resultado": resultado, "error": error}
+
+
+def _por_intencion(confusion):
+    metricas = {}
+    for categoria in CATEGORIAS:
+        verdaderos = confusion[categoria][categoria]
+        predichos = sum(confusion[c][categoria] for c in CATEGORIAS)
+        soporte = sum(confusion[categoria].values())
+        precision = verdaderos / predichos if predichos else 0.0
+        recall = verdaderos / soporte if soporte else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        metricas[categoria] = {"precision": round(precision, 4), "recall": round(recall, 4),
+                               "f1": round(f1, 4), "soporte": soporte}
+    return metricas
+
+
+def evaluar_estrategia(nombre, corpus, backend, hilos):
+    from benchmark import percentiles
+    ejecutar = ESTRATEGIAS[nombre](backend)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        # Cada mensaje en su propio contexto: los tokens no se mezclan entre mensajes
+        resultados = list(ejecutor.map(
+            lambda caso: contextvars.copy_context().run(_evaluar_caso, ejecutar, caso), corpus
+        ))
+    duracion = time.perf_counter() - inicio
+
+    confusion = {c: Counter() for c in CATEGORIAS}
+    campos = {"rfc": [0, 0], "productos": [0, 0]}
+    tokens = Counter()
+    ejemplos = []
+    for caso, r in zip(corpus, resultados):
+        obtenido = r["resultado"]
+        predicha = obtenido["intencion"] if obtenido["intencion"] in CATEGORIAS else "otro"
+        confusion[caso["intencion"]][predicha] += 1
+        tokens.update(r["tokens"])
+
+        fallos = [] if predicha == caso["intencion"] else ["intencion"]
+        if "rfc" in caso:
+            campos["rfc"][1] += 1
+            if (obtenido["rfc"] or "").upper() == (caso["rfc"] or "").upper():
+                campos["rfc"][0] += 1
+            else:
+                fallos.append("rfc")
+        if "productos" in caso:
+            campos["productos"][1] += 1
+            if _normalizar_productos(obtenido["productos"]) == _normalizar_productos(caso["productos"]):
+                campos["productos"][0] += 1
+            else:
+                fallos.append("productos")
+        if (fallos or r["error"]) and len(ejemplos) < MAX_EJEMPLOS:
+            ejemplos.append({"mensaje": caso["mensaje"], "esperado": {k: caso.get(k) for k in ("intencion", "rfc", "productos")},
+                             "obtenido": obtenido, "fallos": fallos, "error": r["error"]})
+
+    total = len(corpus)
+    aciertos = sum(confusion[c][c] for c in CATEGORIAS)
+    return {
+        "exactitud": round(aciertos / total, 4) if total else 0.0,
+        "por_intencion": _por_intencion(confusion),
+        "confusion": {c: {p: confusion[c][p] for p in CATEGORIAS} for c in CATEGORIAS},
+        "campos": {campo: {"aciertos": a, "total": t, "exactitud": round(a / t, 4) if t else None}
+                   for campo, (a, t) in campos.items()},
+        "tokens": {
+            "llamadas": tokens["llamadas"], "entrada": tokens["entrada"], "salida": tokens["salida"],
+            "por_mensaje": round((tokens["entrada"] + tokens["salida"]) / total, 1) if total else 0.0,
+        },
+        "latencia": percentiles([r["ms"] for r in resultados]),
+        "duracion_s": round(duracion, 3),
+        "msgs_por_seg": round(total / duracion, 1) if duracion else None,
+        "errores": sum(1 for r in resultados if r["error"]),
+        "ejemplos_fallidos": ejemplos,
+    }
+
+
+def _resumen(nombre, r):
+    rfc, productos = r["campos"]["rfc"]["exactitud"], r["campos"]["productos"]["exactitud"]
+    return (f"{nombre:<11} exactitud {r['exactitud']:.3f}  rfc {rfc if rfc is not None else '-':<6}  "
+            f"productos {productos if productos is not None else '-':<6}  p50 {r['latencia'].get('p50_ms', 0):>8.2f} ms  "
+            f"p95 {r['latencia'].get('p95_ms', 0):>8.2f} ms  tokens/msg {r['tokens']['por_mensaje']:>7}  "
+            f"errores {r['errores']}")
+
+
+def comparar(actual, anterior):
+    """Líneas con la diferencia de exactitud, p95 y tokens por estrategia común a las dos ejecuciones"""
+    lineas = []
+    for nombre, r in actual["estrategias"].items():
+        previo = anterior.get("estrategias", {}).get(nombre)
+        if not previo:
+            continue
+        lineas.append(
+            f"{nombre:<11} exactitud {previo['exactitud']:.3f} -> {r['exactitud']:.3f}  "
+            f"p95 {previo['latencia'].get('p95_ms', 0):.2f} -> {r['latencia'].get('p95_ms', 0):.2f} ms  "
+            f"tokens/msg {previo['tokens']['por_mensaje']} -> {r['tokens']['por_mensaje']}"
+        )
+    return lineas
+
+
+def evaluar(args):
+    from benchmark import commit_actual
+    from llm_backends import crear_backend
+
+    if args.backend:
+        Config.LLM_BACKEND = args.backend
+    if args.modelo:
+        Config.LLM_MODEL = args.modelo
+    corpus = leer_corpus(args.corpus)
+    backend = crear_backend()
+
+    registro = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit_actual(),
+        "corpus": args.corpus,
+        "mensajes": len(corpus),
+        "sin_revisar": sum(1 for caso in corpus if caso.get("revisar")),
+        "backend": Config.LLM_BACKEND,
+        "modelo": Config.LLM_MODEL,
+        "hilos": args.hilos,
+        "estrategias": {},
+    }
+    for nombre in [e.strip() for e in args.estrategias.split(",") if e.strip()]:
+        registro["estrategias"][nombre] = evaluar_estrategia(nombre, corpus, backend, args.hilos)
+        print(_resumen(nombre, registro["estrategias"][nombre]))
+
+    salida = args.salida or os.path.join("evaluacion", f"evaluacion_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(salida) or ".", exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(registro, f, indent=2, ensure_ascii=False)
+    print(f"Resultados: {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            for linea in comparar(registro, json.load(f)):
+                print(linea)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluación de clasificación y extracción")
+    acciones = parser.add_subparsers(dest="accion", required=True)
+
+    p = acciones.add_parser("corpus", help="corpus anonimizado a partir de una captura de tráfico")
+    p.add_argument("captura")
+    p.add_argument("salida")
+
+    p = acciones.add_parser("sintetico", help="corpus etiquetado generado con las plantillas del benchmark")
+    p.add_argument("salida")
+    p.add_argument("--mensajes", type=int, default=500)
+    p.add_argument("--semilla", type=int, default=42)
+
+    p = acciones.add_parser("evaluar", help="evalúa las estrategias con un corpus etiquetado")
+    p.add_argument("corpus")
+    p.add_argument("--estrategias", default="regex,llm,combinado,pipeline",
+                   help=f"separadas por coma: {', '.join(ESTRATEGIAS)}")
+    p.add_argument("--hilos", type=int, default=8, help="mensajes evaluados en paralelo")
+    p.add_argument("--backend", choices=["ollama", "stub"], help=f"por defecto LLM_BACKEND ({Config.LLM_BACKEND})")
+    p.add_argument("--modelo", help=f"por defecto LLM_MODEL ({Config.LLM_MODEL})")
+    p.add_argument("--salida", help="archivo JSON de resultados (por defecto evaluacion/evaluacion_<fecha>.json)")
+    p.add_argument("--comparar", help="resultados JSON de una ejecución anterior")
+    p.add_argument("--logs", action="store_true", help="no silenciar el logging de la aplicación")
+    args = parser.parse_args(argv)
+
+    if args.accion == "corpus":
+        casos = corpus_desde_captura(args.captura)
+        escribir_corpus(casos, args.salida)
+        print(json.dumps({"mensajes": len(casos), "salida": args.salida}))
+        return 0
+    if args.accion == "sintetico":
+        escribir_corpus(corpus_sintetico(args.mensajes, args.semilla), args.salida)
+        print(json.dumps({"mensajes": args.mensajes, "salida": args.salida}))
+        return 0
+    if not args.logs:
+        logging.disable(logging.WARNING)
+    return evaluar(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
@@ -0,0 +1,12 @@
+# gunicorn.conf.py
+# Uso: gunicorn -c gunicorn.conf.py app:app
+import os
+from startup import post_fork
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+# La aplicación se importa una vez en el proceso maestro (importaciones diferidas,
+# sin conexiones abiertas) y cada worker reinicia sus conexiones en post_fork
+preload_app = True
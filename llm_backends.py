@@ -0,0 +1,287 @@
+# llm_backends.py
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+import ollama
+from config import Config
+from message_parser import MessageParser
+from trazas import span, CLIENTE
+
+logger = logging.getLogger(__name__)
+
+# Tokens de las llamadas al LLM del contexto actual; None si no se están contando
+_tokens = ContextVar("tokens_llm", default=None)
+
+
+def contar_tokens():
+    """
+    Empieza a acumular los tokens de las llamadas al LLM del contexto actual
+    (p. ej. un mensaje en evaluacion.py) y devuelve el contador.
+    """
+    contador = {"llamadas": 0, "entrada": 0, "salida": 0}
+    _tokens.set(contador)
+    return contador
+
+
+def _registrar_tokens(entrada, salida):
+    contador = _tokens.get()
+    if contador is not None:
+        contador["llamadas"] += 1
+        contador["entrada"] += entrada or 0
+        contador["salida"] += salida or 0
+
+
+class LLMNoDisponible(Exception):
+    """El backend no pudo atender la solicitud (circuito abierto, saturado o sin hosts)"""
+
+
+class CircuitBreaker:
+    """
+    Circuito simple por endpoint: tras `umbral_fallos` errores consecutivos se abre
+    durante `tiempo_reposo` segundos; después deja pasar una sola solicitud de prueba
+    y las demás siguen rechazándose hasta que esa termina.
+    """
+    def __init__(self, umbral_fallos, tiempo_reposo):
+        self.umbral_fallos = umbral_fallos
+        self.tiempo_reposo = tiempo_reposo
+        self.fallos = 0
+        self.abierto_desde = None
+        # Medio abierto con la solicitud de prueba en curso
+        self.sondeando = False
+        self._lock = threading.Lock()
+
+    def permite(self):
+        with self._lock:
+            if self.abierto_desde is None:
+                return True
+            if time.monotonic() - self.abierto_desde < self.tiempo_reposo:
+                return False
+            # Medio abierto: un solo intento; su éxito cierra el circuito y su fallo lo reabre.
+            # El reposo vuelve a contar desde aquí, así que mientras la prueba no termine
+            # nadie más pasa (y una prueba abandonada, p. ej. cancelada, no lo deja trabado)
+            self.abierto_desde = time.monotonic()
+            self.sondeando = True
+            return True
+
+    def registrar_exito(self):
+        with self._lock:
+            self.fallos = 0
+            self.abierto_desde = None
+            self.sondeando = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self.fallos += 1
+            if self.sondeando or self.fallos >= self.umbral_fallos:
+                self.abierto_desde = time.monotonic()
+            self.sondeando = False
+
+
+class LLMBackend:
+    """Interfaz común para los backends de generación"""
+    nombre = "base"
+
+    def generar(self, prompt):
+        """Devuelve el texto generado para el prompt"""
+        raise NotImplementedError
+
+    async def generar_async(self, prompt):
+        """Versión asíncrona (modo ASGI); por defecto ejecuta generar en el pool de hilos"""
+        from startup import en_hilo
+        return await en_hilo(self.generar, prompt)
+
+
+class OllamaBackend(LLMBackend):
+    """
+    Backend para un host de Ollama. Reutiliza el cliente HTTP (y sus conexiones)
+    entre llamadas y aplica un timeout por solicitud.
+    """
+    nombre = "ollama"
+
+    def __init__(self, host, model=None, temperature=None, timeout=None):
+        self.host = host
+        self.model = model or Config.LLM_MODEL
+        self.temperature = Config.LLM_TEMPERATURE if temperature is None else temperature
+        self.timeout = timeout or Config.LLM_TIMEOUT
+        self.client = ollama.Client(host=host, timeout=self.timeout)
+        # Cliente asíncrono del modo ASGI, uno por event loop (sus conexiones no se comparten entre loops)
+        self._clientes_async = {}
+
+    def generar(self, prompt):
+        with span("llm.generate", CLIENTE, {"server.address": self.host, "gen_ai.request.model": self.model}):
+            respuesta = self.client.generate(
+                model=self.model,
+                prompt=prompt,
+                options={"temperature": self.temperature}
+            )
+        _registrar_tokens(respuesta.get("prompt_eval_count"), respuesta.get("eval_count"))
+        return respuesta["response"]
+
+    async def generar_async(self, prompt):
+        loop = asyncio.get_running_loop()
+        cliente = self._clientes_async.get(loop)
+        if cliente is None:
+            cliente = self._clientes_async[loop] = ollama.AsyncClient(host=self.host, timeout=self.timeout)
+        with span("llm.generate", CLIENTE, {"server.address": self.host, "gen_ai.request.model": self.model}):
+            respuesta = await cliente.generate(
+                model=self.model,
+                prompt=prompt,
+                options={"temperature": self.temperature}
+            )
+        _registrar_tokens(respuesta.get("prompt_eval_count"), respuesta.get("eval_count"))
+        return respuesta["response"]
+
+    def __repr__(self):
+        return f"<OllamaBackend(host='{self.host}', model='{self.model}')>"
+
+
+class StubBackend(LLMBackend):
+    """
+    Backend local determinista para pruebas y benchmarks.
+    Responde usando el clasificador por reglas y el MessageParser, con una
+    latencia artificial configurable.
+    """
+    nombre = "stub"
+
+    def __init__(self, latencia=None):
+        self.latencia = Config.LLM_STUB_LATENCIA if latencia is None else latencia
+
+    def generar(self, prompt):
+        if self.latencia:
+            time.sleep(self.latencia)
+        return self._contar(prompt, self._responder(prompt))
+
+    async def generar_async(self, prompt):
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        return self._contar(prompt, self._responder(prompt))
+
+    @staticmethod
+    def _contar(prompt, respuesta):
+        # Sin tokenizador: aproximación de ~4 caracteres por token
+        _registrar_tokens(len(prompt) // 4, len(respuesta) // 4)
+        return respuesta
+
+    @staticmethod
+    def _responder(prompt):
+        # Prompt de lote: una línea "n. mensaje" por cada mensaje
+        if prompt.rstrip().endswith("Respuestas:"):
+            bloque = prompt.rsplit("Mensajes:", 1)[-1].rsplit("Respuestas:", 1)[0]
+            lineas = []
+            for linea in bloque.strip().splitlines():
+                numero, _, mensaje = linea.partition(". ")
+                lineas.append(f"{numero.strip()}. {MessageParser.clasificar_intencion(mensaje)}")
+            return "\n".join(lineas)
+
+        # El mensaje siempre va en la última línea "Mensaje: ..." del prompt
+        partes = prompt.rsplit("Mensaje:", 1)
+        mensaje = partes[1].strip().split("\n", 1)[0] if len(partes) == 2 else ""
+        intencion = MessageParser.clasificar_intencion(mensaje)
+
+        if prompt.rstrip().endswith("JSON:"):
+            datos = MessageParser.extraer_datos_factura(mensaje)
+            return json.dumps({
+                "intencion": intencion,
+                "rfc": datos["rfc"],
+                "productos": datos["productos"]
+            }, ensure_ascii=False)
+        return intencion
+
+
+class BackendPool(LLMBackend):
+    """
+    Reparte las solicitudes en round-robin entre varios backends, limita las
+    solicitudes concurrentes con un semáforo y omite los endpoints con el circuito abierto.
+    """
+    nombre = "pool"
+
+    def __init__(self, backends, max_concurrencia=None, timeout=None,
+                 umbral_fallos=None, tiempo_reposo=None):
+        if not backends:
+            raise ValueError("Se requiere al menos un backend")
+        self.backends = list(backends)
+        self.circuitos = [
+            CircuitBreaker(
+                umbral_fallos or Config.LLM_CIRCUITO_FALLOS,
+                Config.LLM_CIRCUITO_REPOSO if tiempo_reposo is None else tiempo_reposo
+            )
+            for _ in self.backends
+        ]
+        self.timeout = timeout or Config.LLM_TIMEOUT
+        self.max_concurrencia = max_concurrencia or Config.LLM_MAX_CONCURRENCIA
+        self._semaforo = threading.BoundedSemaphore(self.max_concurrencia)
+        self._semaforos_async = {}
+        self._turno = itertools.count()
+
+    def generar(self, prompt):
+        # Esperar como máximo el timeout de la solicitud por un lugar libre
+        if not self._semaforo.acquire(timeout=self.timeout):
+            raise LLMNoDisponible("Demasiadas solicitudes concurrentes al LLM")
+        try:
+            inicio = next(self._turno)
+            ultimo_error = None
+            for i in range(len(self.backends)):
+                idx = (inicio + i) % len(self.backends)
+                backend, circuito = self.backends[idx], self.circuitos[idx]
+                if not circuito.permite():
+                    continue
+                try:
+                    respuesta = backend.generar(prompt)
+                    circuito.registrar_exito()
+                    return respuesta
+                except Exception as e:
+                    circuito.registrar_fallo()
+                    ultimo_error = e
+                    logger.warning("Fallo en backend %r: %s", backend, e)
+            raise LLMNoDisponible(f"Ningún backend LLM disponible (último error: {ultimo_error})")
+        finally:
+            self._semaforo.release()
+
+    async def generar_async(self, prompt):
+        # Mismo límite de concurrencia, con un semáforo del event loop (las esperas no ocupan hilos)
+        loop = asyncio.get_running_loop()
+        semaforo = self._semaforos_async.get(loop)
+        if semaforo is None:
+            semaforo = self._semaforos_async[loop] = asyncio.Semaphore(self.max_concurrencia)
+        try:
+            await asyncio.wait_for(semaforo.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise LLMNoDisponible("Demasiadas solicitudes concurrentes al LLM")
+        try:
+            inicio = next(self._turno)
+            ultimo_error = None
+            for i in range(len(self.backends)):
+                idx = (inicio + i) % len(self.backends)
+                backend, circuito = self.backends[idx], self.circuitos[idx]
+                if not circuito.permite():
+                    continue
+                try:
+                    respuesta = await asyncio.wait_for(backend.generar_async(prompt), self.timeout)
+                    circuito.registrar_exito()
+                    return respuesta
+                except Exception as e:
+                    circuito.registrar_fallo()
+                    ultimo_error = e
+                    logger.warning("Fallo en backend %r: %s", backend, e)
+            raise LLMNoDisponible(f"Ningún backend LLM disponible (último error: {ultimo_error})")
+        finally:
+            semaforo.release()
+
+
+def crear_backend():
+    """
+    Construye el backend configurado en Config.LLM_BACKEND:
+    - "stub": backend local determinista
+    - "ollama": pool round-robin sobre Config.OLLAMA_HOSTS
+    """
+    if Config.LLM_BACKEND == "stub":
+        logger.info("Usando backend LLM stub (determinista)")
+        return BackendPool([StubBackend()])
+
+    backends = [OllamaBackend(host) for host in Config.OLLAMA_HOSTS]
+    logger.info("Backends Ollama configurados: %s", backends)
+    return BackendPool(backends)
@@ -0,0 +1,389 @@
+# mantenimiento.py
+"""
+Mantenimiento en segundo plano, fuera del camino de las solicitudes.
+
+Cada tarea se ejecuta por empresa cada `intervalo` segundos. Las tareas exclusivas
+(PDFs antiguos, estadísticas y compactación de la base, resúmenes por cliente) las
+ejecuta un solo worker: el que logra tomar la fila de la tarea en `tareas_programadas`
+con un UPDATE condicional (sin bloqueo vigente y con el intervalo cumplido). Si ese
+worker muere a media tarea, el bloqueo vence a los Config.MANTENIMIENTO_BLOQUEO_S
+segundos. Las no exclusivas (recargar la copia en memoria del catálogo) se ejecutan
+en cada proceso, porque cada uno tiene la suya.
+
+Con Config.MANTENIMIENTO_ACTIVO cada worker inicia el planificador en un hilo
+(ver startup.iniciar). Las tareas que bloquean la base mientras corren (VACUUM de
+SQLite) solo se ejecutan en el proceso aparte:
+
+    python mantenimiento.py                            # ciclo continuo
+    python mantenimiento.py --una-vez                  # las tareas pendientes, una vez
+    python mantenimiento.py --tarea pdfs --empresa acme  # una tarea ahora
+"""
+import argparse
+import contextvars
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from config import Config
+from empresas import empresa_actual, empresa_por_id, todas_las_empresas, usar_empresa
+from trazas import configurar_logging
+
+logger = logging.getLogger(__name__)
+
+HORA = 3600
+
+
+class Tarea:
+    """
+    Args:
+        nombre (str): Identificador de la tarea (y de su fila de bloqueo)
+        intervalo (float): Segundos entre ejecuciones
+        funcion (callable): Se llama con la empresa ya fijada y devuelve un dict con el resultado
+        exclusiva (bool): Un solo worker por empresa; False para cachés de cada proceso
+        aparte (bool): Solo en el proceso aparte (python mantenimiento.py), nunca en el
+            hilo de un worker: la tarea detiene las escrituras del webhook mientras corre
+    """
+    def __init__(self, nombre, intervalo, funcion, exclusiva=True, aparte=False):
+        self.nombre = nombre
+        self.intervalo = intervalo
+        self.funcion = funcion
+        self.exclusiva = exclusiva
+        self.aparte = aparte
+
+
+def refrescar_catalogo():
+    """Recarga la copia en memoria del catálogo (y su índice de embeddings) si cambió la versión"""
+    from producto_service import ProductoService
+    catalogo = ProductoService.obtener_catalogo(verificar=True)
+    if Config.EMBEDDINGS_ACTIVO:
+        from embedding_service import obtener_indice_productos
+        obtener_indice_productos().sincronizar(catalogo.productos, catalogo.version)
+    return {"version": catalogo.version, "productos": len(catalogo.productos)}
+
+
+def borrar_pdfs_antiguos():
+    """Borra los PDF de factura de la empresa con más de Config.MANTENIMIENTO_PDF_DIAS días"""
+    if Config.MANTENIMIENTO_PDF_DIAS <= 0:
+        return {"borrados": 0}
+    empresa = empresa_actual()
+    carpeta = Config.UPLOAD_FOLDER if empresa.id == "principal" else f"{Config.UPLOAD_FOLDER}/{empresa.id}"
+    limite = time.time() - Config.MANTENIMIENTO_PDF_DIAS * 24 * HORA
+    borrados = 0
+    try:
+        entradas = os.scandir(carpeta)
+    except FileNotFoundError:
+        return {"borrados": 0}
+    with entradas:
+        for entrada in entradas:
+            # Solo PDFs de factura: las carpetas de otras empresas y los demás archivos no se tocan
+            if not (entrada.name.startswith("factura_") and entrada.name.endswith(".pdf") and entrada.is_file()):
+                continue
+            try:
+                if entrada.stat().st_mtime < limite:
+                    os.remove(entrada.path)
+                    borrados += 1
+            except FileNotFoundError:
+                pass
+    return {"borrados": borrados}
+
+
+def _tablas_con_esquema():
+    from models import Base
+    esquema = empresa_actual().esquema
+    prefijo = f'"{esquema}".' if esquema else ""
+    return [f"{prefijo}{tabla.name}" for tabla in Base.metadata.sorted_tables]
+
+
+def _ejecutar_sql(sentencias):
+    """Ejecuta sentencias fuera de transacción (VACUUM y ANALYZE no admiten una abierta)"""
+    from models import init_db
+    with init_db().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for sentencia in sentencias:
+            conn.exec_driver_sql(sentencia)
+
+
+def analizar_base():
+    """Actualiza las estadísticas del planificador de consultas"""
+    from models import init_db
+    if init_db().dialect.name == "sqlite":
+        _ejecutar_sql(["ANALYZE", "PRAGMA optimize"])
+    else:
+        # Solo las tablas de la empresa (su esquema, si comparte la base)
+        _ejecutar_sql([f"ANALYZE {tabla}" for tabla in _tablas_con_esquema()])
+    return {}
+
+
+def vaciar_wal():
+    """
+    SQLite: copia el WAL a la base sin esperar a lectores ni escritores (PASSIVE), así
+    que puede correr junto al webhook. PostgreSQL lo hace solo.
+    """
+    from models import init_db
+    if init_db().dialect.name != "sqlite":
+        return {"omitida": "postgresql"}
+    _ejecutar_sql(["PRAGMA wal_checkpoint(PASSIVE)"])
+    return {}
+
+
+def compactar_base():
+    """
+    SQLite: recupera el espacio libre y vacía el WAL. VACUUM toma la base en exclusiva
+    mientras la reescribe, por eso solo corre en el proceso aparte. PostgreSQL lo hace
+    con autovacuum.
+    """
+    from models import init_db
+    if init_db().dialect.name != "sqlite":
+        return {"omitida": "autovacuum"}
+    _ejecutar_sql(["VACUUM", "PRAGMA wal_checkpoint(TRUNCATE)"])
+    return {}
+
+
+def resumir_clientes():
+    """Recalcula ResumenCliente (facturas, total y fechas por cliente) en una transacción"""
+    from sqlalchemy import func
+    from models import get_db_session, Factura, ResumenCliente
+
+    db_lectura = get_db_session(lectura=True)
+    try:
+        filas = db_lectura.query(
+            Factura.cliente_id, func.count(Factura.id), func.sum(Factura.total),
+            func.min(Factura.fecha_emision), func.max(Factura.fecha_emision)
+        ).filter(Factura.cliente_id.isnot(None)).group_by(Factura.cliente_id).all()
+    finally:
+        db_lectura.close()
+
+    ahora = datetime.now()
+    resumenes = [
+        {"cliente_id": cliente_id, "facturas": facturas, "total": total or 0,
+         "primera_factura": primera, "ultima_factura": ultima, "actualizado": ahora}
+        for cliente_id, facturas, total, primera, ultima in filas
+    ]
+    db_session = get_db_session()
+    try:
+        db_session.query(ResumenCliente).delete(synchronize_session=False)
+        db_session.bulk_insert_mappings(ResumenCliente, resumenes)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+    return {"clientes": len(resumenes)}
+
+
+TAREAS = [
+    # La mitad del intervalo de verificación: las solicitudes casi nunca consultan la versión
+    Tarea("catalogo", Config.CATALOGO_VERIFICAR_S / 2, refrescar_catalogo, exclusiva=False),
+    Tarea("pdfs", HORA, borrar_pdfs_antiguos),
+    Tarea("resumenes", HORA, resumir_clientes),
+    Tarea("analizar", 24 * HORA, analizar_base),
+    Tarea("wal", HORA, vaciar_wal),
+    Tarea("compactar", 7 * 24 * HORA, compactar_base, aparte=True),
+]
+
+
+def registrar_tarea(tarea):
+    """Agrega (o reemplaza por nombre) una tarea periódica"""
+    TAREAS[:] = [t for t in TAREAS if t.nombre != tarea.nombre] + [tarea]
+
+
+def _propietario():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def tomar_tarea(tarea, propietario, intervalo=None):
+    """
+    Intenta tomar la tarea en la base de la empresa actual.
+
+    Returns:
+        bool: True si este worker debe ejecutarla ahora
+    """
+    from sqlalchemy import or_
+    from sqlalchemy.exc import IntegrityError
+    from models import get_db_session, TareaProgramada
+
+    ahora = datetime.now()
+    intervalo = tarea.intervalo if intervalo is None else intervalo
+    db_session = get_db_session()
+    try:
+        tomadas = db_session.query(TareaProgramada).filter(
+            TareaProgramada.nombre == tarea.nombre,
+            or_(TareaProgramada.bloqueado_hasta.is_(None), TareaProgramada.bloqueado_hasta < ahora),
+            or_(TareaProgramada.ultima_ejecucion.is_(None),
+                TareaProgramada.ultima_ejecucion <= ahora - timedelta(seconds=intervalo))
+        ).update({
+            TareaProgramada.propietario: propietario,
+            TareaProgramada.bloqueado_hasta: ahora + timedelta(seconds=Config.MANTENIMIENTO_BLOQUEO_S),
+        }, synchronize_session=False)
+        if not tomadas:
+            if db_session.get(TareaProgramada, tarea.nombre) is not None:
+                db_session.rollback()
+                return False
+            # Primera ejecución: gana el worker que inserta la fila
+            db_session.add(TareaProgramada(
+                nombre=tarea.nombre, propietario=propietario,
+                bloqueado_hasta=ahora + timedelta(seconds=Config.MANTENIMIENTO_BLOQUEO_S)
+            ))
+        db_session.commit()
+        return True
+    except IntegrityError:
+        db_session.rollback()
+        return False
+    finally:
+        db_session.close()
+
+
+def liberar_tarea(tarea, propietario, resultado):
+    """Registra la ejecución y libera el bloqueo (solo si sigue siendo de este worker)"""
+    from models import get_db_session, TareaProgramada
+
+    db_session = get_db_session()
+    try:
+        db_session.query(TareaProgramada).filter_by(nombre=tarea.nombre, propietario=propietario).update({
+            TareaProgramada.propietario: None,
+            TareaProgramada.bloqueado_hasta: None,
+            TareaProgramada.ultima_ejecucion: datetime.now(),
+            TareaProgramada.ultimo_resultado: json.dumps(resultado, ensure_ascii=False, default=str)[:500],
+        }, synchronize_session=False)
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def _ejecutar_en_empresa(tarea, empresa, propietario, forzar=False):
+    """
+    Ejecuta la tarea para una empresa si le toca a este worker.
+
+    Returns:
+        dict: Resultado, o None si la tomó otro worker o aún no le toca
+    """
+    usar_empresa(empresa)
+    if tarea.exclusiva and not tomar_tarea(tarea, propietario, 0 if forzar else None):
+        return None
+    inicio = time.perf_counter()
+    try:
+        resultado = tarea.funcion() or {}
+    except Exception as e:
+        logger.error("Error en la tarea de mantenimiento %s (empresa %s): %s", tarea.nombre, empresa.id, e)
+        resultado = {"error": str(e)}
+    resultado["duracion_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    if tarea.exclusiva:
+        liberar_tarea(tarea, propietario, resultado)
+        logger.info("Mantenimiento %s (empresa %s): %s", tarea.nombre, empresa.id, resultado)
+    return resultado
+
+
+def ejecutar_tarea(tarea, empresa, propietario=None, forzar=False):
+    """Ejecuta la tarea en un contexto propio (la empresa no se filtra al llamador)"""
+    try:
+        return contextvars.copy_context().run(
+            _ejecutar_en_empresa, tarea, empresa, propietario or _propietario(), forzar
+        )
+    except Exception as e:
+        # Base no disponible: se reintenta en la siguiente revisión
+        logger.error("No se pudo ejecutar la tarea %s (empresa %s): %s", tarea.nombre, empresa.id, e)
+        return None
+
+
+class Planificador:
+    """
+    Ejecuta TAREAS en un hilo propio. Las no exclusivas se programan en memoria; las
+    exclusivas se intentan tomar cada Config.MANTENIMIENTO_REVISION_S (o su intervalo,
+    si es menor) y, ejecutadas, no se vuelven a intentar hasta cumplir el intervalo.
+    
+    Args:
+        proceso_aparte (bool): Proceso sin solicitudes (python mantenimiento.py): omite
+            las cachés de proceso y ejecuta también las tareas `aparte`
+    """
+    def __init__(self, proceso_aparte=False):
+        self.proceso_aparte = proceso_aparte
+        self._lock = threading.Lock()
+        self._pid = None
+        self._detener = threading.Event()
+        self._siguiente = {}
+
+    def iniciar(self):
+        # Un hilo por proceso: se crea de nuevo en cada worker después del fork
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._siguiente = {}
+            self._detener.clear()
+            threading.Thread(target=self._ejecutar, name="mantenimiento", daemon=True).start()
+
+    def detener(self):
+        self._detener.set()
+
+    def ejecutar_pendientes(self):
+        """
+        Ejecuta las tareas que toca revisar ahora.
+
+        Returns:
+            float: Segundos hasta la próxima revisión
+        """
+        propietario = _propietario()
+        for tarea in list(TAREAS):
+            if self.proceso_aparte and not tarea.exclusiva:
+                continue
+            if tarea.aparte and not self.proceso_aparte:
+                # Detendría las escrituras del webhook de este worker
+                continue
+            for empresa in todas_las_empresas():
+                clave = (tarea.nombre, empresa.id)
+                if time.monotonic() < self._siguiente.get(clave, 0):
+                    continue
+                resultado = ejecutar_tarea(tarea, empresa, propietario)
+                espera = tarea.intervalo
+                if resultado is None and tarea.exclusiva:
+                    espera = min(tarea.intervalo, Config.MANTENIMIENTO_REVISION_S)
+                self._siguiente[clave] = time.monotonic() + espera
+        return max(0.1, min(self._siguiente.values(), default=time.monotonic()) - time.monotonic())
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            espera = self.ejecutar_pendientes()
+            self._detener.wait(espera)
+
+
+_planificador = None
+
+def obtener_planificador():
+    """Planificador compartido del proceso, o None si el mantenimiento está desactivado"""
+    global _planificador
+    if not Config.MANTENIMIENTO_ACTIVO:
+        return None
+    if _planificador is None:
+        _planificador = Planificador()
+    return _planificador
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tareas de mantenimiento del agente de facturación")
+    parser.add_argument("--tarea", choices=[t.nombre for t in TAREAS], help="ejecutar solo esta tarea, ya")
+    parser.add_argument("--empresa", help="id de la empresa para --tarea (por defecto todas)")
+    parser.add_argument("--una-vez", action="store_true", help="ejecutar las tareas pendientes y salir")
+    args = parser.parse_args(argv)
+    empresas = [empresa_por_id(args.empresa)] if args.empresa else todas_las_empresas()
+
+    if args.tarea:
+        tarea = next(t for t in TAREAS if t.nombre == args.tarea)
+        resultados = {e.id: ejecutar_tarea(tarea, e, forzar=True) for e in empresas}
+        print(json.dumps(resultados, indent=2, ensure_ascii=False, default=str))
+        return 0
+
+    planificador = Planificador(proceso_aparte=True)
+    if args.una_vez:
+        planificador.ejecutar_pendientes()
+        return 0
+    while True:
+        time.sleep(planificador.ejecutar_pendientes())
+
+
+if __name__ == "__main__":
+    configurar_logging()
+    sys.exit(main())
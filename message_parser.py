@@ -4,7 +4,48 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Reglas para el clasificador determinista (en orden de prioridad)
+_PATRONES_INTENCION = [
+    ("ayuda", re.compile(r'\b(?:ayuda|como funciona|cómo funciona|opciones|instrucciones)\b', re.IGNORECASE)),
+    ("facturar", re.compile(r'\bfacturar\b|\b(?:generar|emitir|necesito|quiero)\s+(?:una\s+|un\s+)?factura\b', re.IGNORECASE)),
+    ("consultar", re.compile(r'\b(?:consultar|mostrar|ver|listar)\b.*\bfacturas\b|\bfacturas\s+emitidas\b', re.IGNORECASE)),
+    ("estado", re.compile(r'\b(?:estado|seguimiento|trámite|tramite)\b', re.IGNORECASE)),
+]
+
+# Token de continuación de un listado (ver respuestas.py), ya sin mayúsculas ni signos
+_PATRON_CONTINUACION = re.compile(r'\bver\s+m[aá]s\s+([a-zñ]{3,4}\d{6}[a-z\d]{3})\s+(\d+)n(\d+)\b', re.IGNORECASE)
+
+# RFC: 3 (moral) o 4 (física) letras, fecha AAMMDD y homoclave (dos caracteres y el dígito verificador)
+_PATRON_RFC = re.compile(r'[A-Z&Ñ]{3,4}\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])[A-Z\d]{2}[\dA]')
+# Valor de cada carácter en el cálculo del dígito verificador del SAT
+_VALORES_RFC = {c: i for i, c in enumerate("0123456789ABCDEFGHIJKLMN&OPQRSTUVWXYZ Ñ")}
+# RFC genéricos del SAT (público en general y extranjeros)
+_RFC_GENERICOS = frozenset({"XAXX010101000", "XEXX010101000"})
+
+
+def digito_verificador_rfc(rfc_sin_digito):
+    """Dígito verificador del SAT para los primeros 11 (moral) o 12 (física) caracteres de un RFC"""
+    # Las personas morales se completan con un espacio al inicio
+    suma = sum(_VALORES_RFC[c] * (13 - i) for i, c in enumerate(rfc_sin_digito.rjust(12)))
+    residuo = suma % 11
+    if residuo == 0:
+        return "0"
+    return "A" if residuo == 1 else str(11 - residuo)
+
 class MessageParser:
+    @staticmethod
+    def clasificar_intencion(mensaje):
+        """
+        Clasificador determinista por palabras clave.
+        Se usa como respaldo cuando el LLM no está disponible y en el backend stub.
+        """
+        if not mensaje:
+            return "otro"
+        for intencion, patron in _PATRONES_INTENCION:
+            if patron.search(mensaje):
+                return intencion
+        return "otro"
+    
     @staticmethod
     def extraer_datos_factura(mensaje):
         """
@@ -40,10 +81,10 @@ class MessageParser:
                     }
             
             # Si no se encontró coincidencia con ningún patrón
-            logger.warning(f"No se pudo extraer datos de: '{mensaje}'")
+            logger.warning("No se pudo extraer datos de factura del mensaje")
             return {"productos": [], "rfc": None}
         except Exception as e:
-            logger.error(f"Error extrayendo datos: {e}")
+            logger.error("Error extrayendo datos: %s", e)
             return {"productos": [], "rfc": None}
     
     @staticmethod
@@ -81,7 +122,7 @@ class MessageParser:
                 "rfc": rfc
             }
         except Exception as e:
-            logger.error(f"Error extrayendo múltiples productos: {e}")
+            logger.error("Error extrayendo múltiples productos: %s", e)
             return {"productos": [], "rfc": None}
     
     @staticmethod
@@ -114,28 +155,33 @@ class MessageParser:
                 if rfc_match:
                     return {"rfc": rfc_match.group(1).strip().upper()}
             
-            logger.warning(f"No se pudo extraer RFC para consulta: '{mensaje}'")
+            logger.warning("No se pudo extraer RFC para consulta del mensaje")
             return {"rfc": None}
         except Exception as e:
-            logger.error(f"Error extrayendo datos de consulta: {e}")
+            logger.error("Error extrayendo datos de consulta: %s", e)
             return {"rfc": None}
     
+    @staticmethod
+    def extraer_continuacion(mensaje):
+        """
+        Reconoce "ver más <RFC> <id>n<número>" para continuar un listado de facturas
+        
+        Returns:
+            dict: {"rfc", "despues_de", "numero"} o None si el mensaje no es una continuación
+        """
+        match = _PATRON_CONTINUACION.search(mensaje or "")
+        if not match:
+            return None
+        return {"rfc": match.group(1).upper(), "despues_de": int(match.group(2)), "numero": int(match.group(3))}
+    
     @staticmethod
     def validar_rfc(rfc):
         """
-        Valida el formato de un RFC mexicano
+        Valida el formato de un RFC mexicano y su dígito verificador
         
         RFC Persona Física: 13 caracteres
         RFC Persona Moral: 12 caracteres
         """
-        if not rfc:
+        if not rfc or not _PATRON_RFC.fullmatch(rfc):
             return False
-        
-        # Patrón completo para RFC (permite 12 o 13 caracteres)
-        patron_rfc = r'^[A-Z&Ñ]{3,4}\d{6}[A-Z\d]{3}$'
-        
-        # Verificar longitud y formato
-        if not re.match(patron_rfc, rfc):
-            return False
-            
-        return True
\ No newline at end of file
+        return rfc in _RFC_GENERICOS or rfc[-1] == digito_verificador_rfc(rfc[:-1])
\ No newline at end of file
@@ -0,0 +1,41 @@
+# metricas.py
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from trazas import iniciar_traza, span
+
+# Tiempos por etapa (ms) de la solicitud en curso; None si no se están registrando
+_etapas = ContextVar("etapas", default=None)
+
+
+def iniciar_solicitud(correlacion=None):
+    """
+    Comienza el registro de etapas (y la traza) de la solicitud actual y devuelve el diccionario.
+    `correlacion` es el MessageSid de Twilio cuando está disponible.
+    """
+    iniciar_traza(correlacion)
+    etapas = {}
+    _etapas.set(etapas)
+    return etapas
+
+
+def etapas_actuales():
+    """Tiempos por etapa de la solicitud actual (o None)"""
+    return _etapas.get()
+
+
+@contextmanager
+def etapa(nombre):
+    """
+    Mide la duración de un bloque del pipeline, la acumula en la solicitud actual
+    y la registra como span si las trazas están activas.
+    Fuera de una solicitud registrada solo cuesta dos lecturas del reloj.
+    """
+    inicio = time.perf_counter()
+    try:
+        with span(f"etapa.{nombre}"):
+            yield
+    finally:
+        etapas = _etapas.get()
+        if etapas is not None:
+            etapas[nombre] = etapas.get(nombre, 0.0) + (time.perf_counter() - inicio) * 1000
@@ -1,12 +1,17 @@
 # models.py
-from sqlalchemy import Column, String, Integer, Float, DateTime, create_engine
+from sqlalchemy import Column, String, Integer, Numeric, DateTime, create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+import threading
 from config import Config
+from empresas import empresa_actual
 
 Base = declarative_base()
 
+# Importes en pesos con dos decimales; se leen como Decimal (ver totales.py)
+Dinero = Numeric(12, 2)
+
 class Cliente(Base):
     __tablename__ = "clientes"
     id = Column(Integer, primary_key=True)
@@ -14,6 +19,10 @@ class Cliente(Base):
     nombre = Column(String(100), nullable=False)
     email = Column(String(100))
     telefono = Column(String(20))
+    # Datos fiscales del receptor para el CFDI
+    codigo_postal = Column(String(5))
+    regimen_fiscal = Column(String(3))
+    uso_cfdi = Column(String(4))
     fecha_registro = Column(DateTime, default=datetime.now)
     
     def __repr__(self):
@@ -25,10 +34,15 @@ class Factura(Base):
     cliente_id = Column(Integer)
     producto = Column(String(100), nullable=False)
     cantidad = Column(Integer, nullable=False)
-    precio_unitario = Column(Float, default=0.0)
-    total = Column(Float, default=0.0)
+    precio_unitario = Column(Dinero, default=0)
+    subtotal = Column(Dinero, default=0)
+    iva = Column(Dinero, default=0)
+    total = Column(Dinero, default=0)
     fecha_emision = Column(DateTime, default=datetime.now)
     ruta_pdf = Column(String(200))
+    # Folio fiscal y XML timbrado
+    uuid = Column(String(36))
+    ruta_xml = Column(String(200))
     
     def __repr__(self):
         return f"<Factura(id={self.id}, cliente_id={self.cliente_id}, producto='{self.producto}')>"
@@ -40,33 +54,207 @@ class Producto(Base):
     codigo = Column(String(50), unique=True, nullable=False)
     nombre = Column(String(100), nullable=False)
     descripcion = Column(String(200))
-    precio = Column(Float, default=0.0)
+    precio = Column(Dinero, default=0)
+    # Claves del catálogo del SAT para el CFDI
+    clave_prod_serv = Column(String(8))
+    clave_unidad = Column(String(3))
+    # Sincronización con el catálogo de origen (ver catalogo.py)
+    checksum = Column(String(40))
+    actualizado = Column(DateTime)
     
     def __repr__(self):
         return f"<Producto(codigo='{self.codigo}', nombre='{self.nombre}', precio={self.precio})>"
 
+class VersionCatalogo(Base):
+    """Fila única con la versión del catálogo (se crea en init_db); cambia con cada importación"""
+    __tablename__ = "catalogo_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    actualizado = Column(DateTime, default=datetime.now)
+
+class TareaProgramada(Base):
+    """
+    Bloqueo y última ejecución de una tarea de mantenimiento (ver mantenimiento.py):
+    el worker que logra actualizar la fila es el único que ejecuta la tarea
+    """
+    __tablename__ = "tareas_programadas"
+    nombre = Column(String(50), primary_key=True)
+    propietario = Column(String(100))
+    bloqueado_hasta = Column(DateTime)
+    ultima_ejecucion = Column(DateTime)
+    ultimo_resultado = Column(String(500))
+
+class ResumenCliente(Base):
+    """Totales por cliente, recalculados periódicamente por la tarea "resumenes" """
+    __tablename__ = "resumen_clientes"
+    cliente_id = Column(Integer, primary_key=True)
+    facturas = Column(Integer, nullable=False, default=0)
+    total = Column(Dinero, default=0)
+    primera_factura = Column(DateTime)
+    ultima_factura = Column(DateTime)
+    actualizado = Column(DateTime, default=datetime.now)
+
 # Modificar la clase Factura para soportar múltiples productos
 
 class DetalleFactura(Base):
     __tablename__ = "detalles_factura"
     id = Column(Integer, primary_key=True)
     factura_id = Column(Integer, nullable=False)
-    producto_id = Column(Integer, nullable=False)
+    # Sin producto si el texto del mensaje no coincidió con ninguno del catálogo:
+    # los conceptos libres se guardan solo en la factura, nunca en el catálogo
+    producto_id = Column(Integer)
+    descripcion = Column(String(100))
     cantidad = Column(Integer, nullable=False)
-    precio_unitario = Column(Float, default=0.0)
-    subtotal = Column(Float, default=0.0)
+    precio_unitario = Column(Dinero, default=0)
+    subtotal = Column(Dinero, default=0)
+    iva = Column(Dinero, default=0)
     
     def __repr__(self):
         return f"<DetalleFactura(factura_id={self.factura_id}, producto_id={self.producto_id}, cantidad={self.cantidad})>"
 
+# Motores compartidos por el proceso, uno por URI (las empresas con esquema propio
+# comparten el motor de la base común), y fábricas de sesiones por empresa: la base
+# primaria recibe las escrituras y la réplica (opcional) las lecturas
+_engines = {}
+_bases = {}
+_lock_bases = threading.Lock()
+
+def _crear_engine(uri):
+    if uri.startswith("sqlite"):
+        engine = create_engine(uri, connect_args={"timeout": Config.SQLITE_BUSY_TIMEOUT_MS / 1000})
+        event.listen(engine, "connect", _configurar_sqlite)
+    else:
+        # PostgreSQL u otra base de servidor para despliegues con varios nodos
+        engine = create_engine(
+            uri,
+            pool_size=Config.DB_POOL_SIZE,
+            max_overflow=Config.DB_MAX_OVERFLOW,
+            pool_pre_ping=True
+        )
+    if Config.TRAZAS_ACTIVAS:
+        # Un span por sentencia SQL; sin trazas no se registran los eventos
+        from trazas import instrumentar_engine
+        instrumentar_engine(engine)
+    return engine
+
+def _configurar_sqlite(conexion, registro):
+    """
+    Pragmas por conexión para SQLite: con WAL los lectores no bloquean al escritor
+    y busy_timeout hace esperar (en lugar de fallar) cuando otro worker está escribiendo.
+    """
+    cursor = conexion.cursor()
+    if Config.SQLITE_JOURNAL_MODE:
+        cursor.execute(f"PRAGMA journal_mode={Config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={Config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(Config.SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.close()
+
+def _obtener_engine(uri):
+    engine = _engines.get(uri)
+    if engine is None:
+        engine = _engines[uri] = _crear_engine(uri)
+    return engine
+
+def _con_esquema(engine, esquema):
+    # Los modelos no declaran esquema; cada empresa los traduce al suyo
+    return engine.execution_options(schema_translate_map={None: esquema}) if esquema else engine
+
 # Inicialización de la base de datos
-def init_db():
-    engine = create_engine(Config.DATABASE_URI)
+def init_db(empresa=None):
+    """Crea las tablas y las sesiones de `empresa` (por defecto la de la solicitud actual), una vez por proceso"""
+    empresa = empresa or empresa_actual()
+    base = _bases.get(empresa.id)
+    if base is None:
+        with _lock_bases:
+            base = _bases.get(empresa.id)
+            if base is None:
+                base = _bases[empresa.id] = _iniciar_empresa(empresa)
+    return base[0]
+
+def _iniciar_empresa(empresa):
+    engine = _con_esquema(_obtener_engine(empresa.database_uri), empresa.esquema)
+    if empresa.esquema:
+        with engine.begin() as conn:
+            conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{empresa.esquema}"'))
     Base.metadata.create_all(engine)
-    return engine
+    _agregar_columnas_faltantes(engine, empresa.esquema)
+    _permitir_detalles_sin_producto(engine, empresa.esquema)
+    _crear_version_catalogo(engine)
+    Session = sessionmaker(bind=engine)
+    replica = empresa.database_replica_uri
+    if replica and replica != empresa.database_uri:
+        # El esquema de la réplica lo mantiene la replicación, no la aplicación
+        engine_lectura = _con_esquema(_obtener_engine(replica), empresa.esquema)
+        SessionLectura = sessionmaker(bind=engine_lectura)
+    else:
+        engine_lectura, SessionLectura = engine, Session
+    return engine, Session, engine_lectura, SessionLectura
 
-# Crear sesión de base de datos
-def get_db_session():
-    engine = init_db()
+def _agregar_columnas_faltantes(engine, esquema=None):
+    """
+    create_all no modifica tablas existentes: agrega las columnas nuevas de los
+    modelos a las bases creadas con versiones anteriores (sin valores por defecto).
+    """
+    inspector = inspect(engine)
+    prefijo = f'"{esquema}".' if esquema else ""
+    with engine.begin() as conn:
+        for tabla in Base.metadata.sorted_tables:
+            existentes = {c["name"] for c in inspector.get_columns(tabla.name, schema=esquema)}
+            for columna in tabla.columns:
+                if columna.name not in existentes:
+                    tipo = columna.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {prefijo}{tabla.name} ADD COLUMN {columna.name} {tipo}"))
+
+def _permitir_detalles_sin_producto(engine, esquema=None):
+    """Las bases anteriores declaran detalles_factura.producto_id NOT NULL"""
+    columnas = inspect(engine).get_columns(DetalleFactura.__tablename__, schema=esquema)
+    if next(c["nullable"] for c in columnas if c["name"] == "producto_id"):
+        return
+    tabla = DetalleFactura.__tablename__
+    with engine.begin() as conn:
+        if engine.dialect.name != "sqlite":
+            prefijo = f'"{esquema}".' if esquema else ""
+            conn.execute(text(f"ALTER TABLE {prefijo}{tabla} ALTER COLUMN producto_id DROP NOT NULL"))
+            return
+        # SQLite no modifica restricciones: se copia la tabla a una nueva con la definición actual
+        nombres = ", ".join(c.name for c in DetalleFactura.__table__.columns)
+        conn.execute(text(f"ALTER TABLE {tabla} RENAME TO {tabla}_anterior"))
+        DetalleFactura.__table__.create(conn)
+        conn.execute(text(f"INSERT INTO {tabla} ({nombres}) SELECT {nombres} FROM {tabla}_anterior"))
+        conn.execute(text(f"DROP TABLE {tabla}_anterior"))
+
+def _crear_version_catalogo(engine):
+    """La fila de la versión existe desde el inicio: publicar_version solo la incrementa"""
+    from sqlalchemy.exc import IntegrityError
     Session = sessionmaker(bind=engine)
-    return Session()
\ No newline at end of file
+    db_session = Session()
+    try:
+        if db_session.get(VersionCatalogo, 1) is None:
+            db_session.add(VersionCatalogo(id=1, version=0, actualizado=datetime.now()))
+            db_session.commit()
+    except IntegrityError:
+        # Otro proceso la creó al mismo tiempo
+        db_session.rollback()
+    finally:
+        db_session.close()
+
+# Crear sesión de base de datos
+def get_db_session(lectura=False, empresa=None):
+    """
+    Args:
+        lectura (bool): Usar la réplica de lectura (consultas y catálogo). Las lecturas
+            que deben ver una escritura recién hecha usan la primaria.
+        empresa (Empresa, optional): Base de otra empresa; por defecto la de la solicitud actual
+    """
+    empresa = empresa or empresa_actual()
+    init_db(empresa)
+    _, Session, _, SessionLectura = _bases[empresa.id]
+    return SessionLectura() if lectura else Session()
+
+def reiniciar_conexiones():
+    """
+    Descarta los pools de conexiones heredados del proceso padre después de un fork,
+    sin cerrar las conexiones que el padre sigue usando.
+    """
+    for engine in list(_engines.values()):
+        engine.dispose(close=False)
@@ -0,0 +1,117 @@
+# perfilador.py
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def plegar_pila(frame, profundidad_max=128):
+    """Convierte una pila en el formato plegado de flamegraph: "raiz;...;hoja" """
+    partes = []
+    while frame is not None and len(partes) < profundidad_max:
+        codigo = frame.f_code
+        partes.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(partes))
+
+
+class PerfiladorMuestreo:
+    """
+    Perfilador por muestreo para solicitudes lentas.
+    Mientras haya solicitudes en curso, un hilo toma la pila de cada hilo de solicitud
+    cada Config.PERFILADO_INTERVALO_MS. Al terminar, la solicitud se conserva solo si
+    superó Config.PERFILADO_UMBRAL_MS; las demás muestras se descartan.
+    """
+    def __init__(self, intervalo_ms=None, umbral_ms=None, max_registros=None):
+        self.intervalo = (intervalo_ms or Config.PERFILADO_INTERVALO_MS) / 1000.0
+        self.umbral_ms = Config.PERFILADO_UMBRAL_MS if umbral_ms is None else umbral_ms
+        self.registros = deque(maxlen=max_registros or Config.PERFILADO_MAX_REGISTROS)
+        self._activos = {}
+        self._hay_activos = threading.Event()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pid = None
+
+    def _asegurar_hilo(self):
+        # El hilo de muestreo se crea en el primer uso y de nuevo tras un fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._muestrear, name="perfilador", daemon=True).start()
+
+    def iniciar(self):
+        """Comienza a muestrear el hilo actual"""
+        with self._lock:
+            self._asegurar_hilo()
+            self._activos[threading.get_ident()] = Counter()
+            self._hay_activos.set()
+
+    def finalizar(self, duracion_ms, **contexto):
+        """
+        Deja de muestrear el hilo actual y conserva las pilas si la solicitud fue lenta.
+        `contexto` se guarda con el registro (intención, tiempos por etapa, ...).
+        """
+        with self._lock:
+            pilas = self._activos.pop(threading.get_ident(), None)
+            if not self._activos:
+                self._hay_activos.clear()
+        if pilas is None or duracion_ms < self.umbral_ms:
+            return
+        registro = {
+            "id": next(self._ids),
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "duracion_ms": round(duracion_ms, 1),
+            "muestras": sum(pilas.values()),
+            "pilas": dict(pilas),
+        }
+        registro.update(contexto)
+        self.registros.append(registro)
+        logger.warning("Solicitud lenta (%.0f ms) registrada en el perfilador: id=%s", duracion_ms, registro['id'])
+
+    def _muestrear(self):
+        propio = threading.get_ident()
+        while True:
+            self._hay_activos.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                activos = list(self._activos)
+            muestras = [(tid, plegar_pila(frames[tid])) for tid in activos if tid in frames and tid != propio]
+            del frames
+            with self._lock:
+                for tid, pila in muestras:
+                    if tid in self._activos:
+                        self._activos[tid][pila] += 1
+            time.sleep(self.intervalo)
+
+    def resumen(self):
+        """Solicitudes lentas registradas, sin las pilas"""
+        return [{k: v for k, v in r.items() if k != "pilas"} for r in list(self.registros)]
+
+    def plegado(self, registro_id=None):
+        """
+        Pilas en formato plegado ("pila conteo" por línea), compatible con
+        flamegraph.pl y speedscope. Sin id se agregan todas las solicitudes lentas.
+        """
+        total = Counter()
+        for registro in list(self.registros):
+            if registro_id is None or registro["id"] == registro_id:
+                total.update(registro["pilas"])
+        return "\n".join(f"{pila} {conteo}" for pila, conteo in total.most_common()) + "\n"
+
+
+_perfilador = None
+
+def obtener_perfilador():
+    """Perfilador compartido del proceso, o None si el perfilado está desactivado"""
+    global _perfilador
+    if not Config.PERFILADO_ACTIVO:
+        return None
+    if _perfilador is None:
+        _perfilador = PerfiladorMuestreo()
+    return _perfilador
@@ -1,12 +1,76 @@
 # producto_service.py
 import logging
+import threading
+import time
 from models import get_db_session, Producto
+from config import Config
+from catalogo import version_catalogo
+from empresas import empresa_actual
+from totales import PRECIO_POR_DEFECTO
 from difflib import get_close_matches
 import re
 
 logger = logging.getLogger(__name__)
 
+
+def _normalizar_nombre(nombre):
+    return re.sub(r'[^\w\s]', '', nombre.lower())
+
+
+class CatalogoEnMemoria:
+    """Productos de una versión del catálogo con sus nombres ya normalizados"""
+    def __init__(self, version, productos):
+        self.version = version
+        self.productos = productos
+        self.nombres = [_normalizar_nombre(p.nombre) for p in productos]
+        self.verificado = time.monotonic()
+
+
+# Una copia del catálogo por empresa: recargar el de una nunca descarta el de otra
+_catalogos = {}
+_lock_catalogos = threading.Lock()
+
+
 class ProductoService:
+    @staticmethod
+    def obtener_catalogo(verificar=False):
+        """
+        Catálogo de la empresa actual, compartido por las solicitudes del proceso. Cada
+        Config.CATALOGO_VERIFICAR_S segundos se consulta la versión publicada y solo si
+        cambió (una importación del catálogo) se vuelven a leer los productos.
+        
+        Args:
+            verificar (bool): Consultar la versión ya, sin esperar al intervalo
+                (lo usa el mantenimiento para que ninguna solicitud pague la recarga)
+        """
+        empresa = empresa_actual()
+        catalogo = _catalogos.get(empresa.id)
+        if not verificar and catalogo and time.monotonic() - catalogo.verificado < Config.CATALOGO_VERIFICAR_S:
+            return catalogo
+        with _lock_catalogos:
+            catalogo = _catalogos.get(empresa.id)
+            if not verificar and catalogo and time.monotonic() - catalogo.verificado < Config.CATALOGO_VERIFICAR_S:
+                return catalogo
+            # El catálogo se lee de la réplica
+            db_session = get_db_session(lectura=True)
+            try:
+                version = version_catalogo(db_session)
+                if catalogo and catalogo.version == version:
+                    catalogo.verificado = time.monotonic()
+                else:
+                    catalogo = CatalogoEnMemoria(version, db_session.query(Producto).all())
+                    _catalogos[empresa.id] = catalogo
+                    logger.info("Catálogo cargado: versión %s, %s productos", version, len(catalogo.productos))
+            finally:
+                db_session.close()
+        return catalogo
+    
+    @staticmethod
+    def invalidar_catalogo():
+        """Fuerza la recarga del catálogo de la empresa actual en este proceso"""
+        with _lock_catalogos:
+            _catalogos.pop(empresa_actual().id, None)
+    
     @staticmethod
     def buscar_producto(nombre):
         """
@@ -20,26 +84,24 @@ class ProductoService:
             tuple: (Producto, precio) o (None, None) si no se encuentra
         """
         try:
-            db_session = get_db_session()
-            
             # Normalizar el nombre del producto (quitar caracteres especiales, minúsculas)
-            nombre_normalizado = re.sub(r'[^\w\s]', '', nombre.lower())
+            nombre_normalizado = _normalizar_nombre(nombre)
             palabras_clave = nombre_normalizado.split()
             
-            # Buscar productos en la base de datos
-            productos = db_session.query(Producto).all()
+            # Productos y nombres normalizados desde la copia en memoria del catálogo
+            catalogo = ProductoService.obtener_catalogo()
+            productos = catalogo.productos
             
             if not productos:
                 logger.warning("No hay productos en la base de datos")
                 return None, None
             
-            # Obtener nombres normalizados de productos en la BD
-            nombres_productos = [re.sub(r'[^\w\s]', '', p.nombre.lower()) for p in productos]
+            nombres_productos = catalogo.nombres
             
             # Buscar coincidencia exacta
             for idx, nombre_prod in enumerate(nombres_productos):
                 if nombre_normalizado == nombre_prod:
-                    logger.info(f"Coincidencia exacta encontrada: {productos[idx].nombre}")
+                    logger.info("Coincidencia exacta encontrada: %s", productos[idx].nombre)
                     return productos[idx], productos[idx].precio
             
             # Buscar por palabras clave
@@ -49,47 +111,85 @@ class ProductoService:
                     
                 for idx, nombre_prod in enumerate(nombres_productos):
                     if palabra in nombre_prod:
-                        logger.info(f"Coincidencia por palabra clave encontrada: {productos[idx].nombre}")
+                        logger.info("Coincidencia por palabra clave encontrada: %s", productos[idx].nombre)
                         return productos[idx], productos[idx].precio
             
+            # Buscar por similitud semántica (sinónimos como "laptop" / "computadora portátil")
+            if Config.EMBEDDINGS_ACTIVO:
+                producto = ProductoService._buscar_por_embeddings(nombre_normalizado, catalogo)
+                if producto:
+                    return producto, producto.precio
+            
             # Buscar coincidencia aproximada
             coincidencias = get_close_matches(nombre_normalizado, nombres_productos, n=1, cutoff=0.6)
             if coincidencias:
                 idx = nombres_productos.index(coincidencias[0])
-                logger.info(f"Coincidencia aproximada encontrada: {productos[idx].nombre}")
+                logger.info("Coincidencia aproximada encontrada: %s", productos[idx].nombre)
                 return productos[idx], productos[idx].precio
             
-            logger.warning(f"No se encontró producto similar a: {nombre}")
+            logger.warning("No se encontró producto similar a: %s", nombre)
             return None, None
         except Exception as e:
-            logger.error(f"Error buscando producto: {e}")
+            logger.error("Error buscando producto: %s", e)
             return None, None
     
     @staticmethod
-    def obtener_precios_productos(productos):
+    def _buscar_por_embeddings(nombre, catalogo):
         """
-        Obtiene los precios para una lista de productos
+        Busca el producto más cercano en el índice vectorial del catálogo
+        
+        Returns:
+            Producto o None si no supera el umbral de similitud
+        """
+        try:
+            from embedding_service import obtener_indice_productos
+            indice = obtener_indice_productos()
+            indice.sincronizar(catalogo.productos, catalogo.version)
+            producto_id, similitud = indice.buscar(nombre)
+            if producto_id is None:
+                return None
+            producto = next((p for p in catalogo.productos if p.id == producto_id), None)
+            if producto:
+                logger.info("Coincidencia por embeddings encontrada: %s (similitud %.2f)", producto.nombre, similitud)
+            return producto
+        except Exception as e:
+            logger.error("Error buscando producto por embeddings: %s", e)
+            return None
+    
+    @staticmethod
+    def obtener_productos(productos):
+        """
+        Busca en el catálogo los productos de una factura
         
         Args:
             productos (list): Lista de diccionarios con nombres de productos
             
         Returns:
-            dict: Diccionario con los precios {nombre_producto: precio}
+            dict: {nombre en minúsculas: Producto o None si no hay uno similar}
         """
-        precios = {}
-        
+        encontrados = {}
         for producto in productos:
             nombre = producto.get("nombre", "").lower()
-            if not nombre:
-                continue
-                
-            # Buscar producto en la BD
-            producto_db, precio = ProductoService.buscar_producto(nombre)
+            if nombre and nombre not in encontrados:
+                encontrados[nombre] = ProductoService.buscar_producto(nombre)[0]
+        return encontrados
+    
+    @staticmethod
+    def obtener_precios_productos(productos, encontrados=None):
+        """
+        Obtiene los precios para una lista de productos
+        
+        Args:
+            productos (list): Lista de diccionarios con nombres de productos
+            encontrados (dict, optional): Resultado de obtener_productos, si ya se buscaron
             
-            if producto_db:
-                precios[nombre] = precio
-            else:
-                # Si no se encuentra, usar precio por defecto
-                precios[nombre] = 100.0
-                
-        return precios
\ No newline at end of file
+        Returns:
+            dict: Diccionario con los precios {nombre_producto: precio}
+        """
+        if encontrados is None:
+            encontrados = ProductoService.obtener_productos(productos)
+        # Los productos que no están en el catálogo usan el precio por defecto
+        return {
+            nombre: producto.precio if producto else PRECIO_POR_DEFECTO
+            for nombre, producto in encontrados.items()
+        }
\ No newline at end of file
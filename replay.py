@@ -0,0 +1,117 @@
+# replay.py
+"""
+Reproduce una captura de tráfico de /webhook (ver captura.py) contra una instancia local.
+
+Uso:
+    python replay.py captura/webhook.jsonl --url http://localhost:5000/webhook
+    python replay.py captura/webhook.jsonl --velocidad 10 --concurrencia 16
+    python replay.py captura/webhook.jsonl --velocidad max --concurrencia 32
+
+--velocidad 1 respeta los intervalos originales entre mensajes, N los divide
+entre N y "max" envía tan rápido como lo permita la concurrencia.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmark import percentiles
+
+
+def cargar_captura(ruta, limite=None):
+    registros = []
+    with open(ruta, encoding="utf-8") as f:
+        for linea in f:
+            linea = linea.strip()
+            if not linea:
+                continue
+            registros.append(json.loads(linea))
+            if limite and len(registros) >= limite:
+                break
+    registros.sort(key=lambda r: r["t"])
+    return registros
+
+
+def reproducir(registros, url, velocidad, concurrencia, timeout):
+    """
+    Envía los registros respetando (o acelerando) sus intervalos originales.
+
+    Returns:
+        dict: Latencias, tasa de error y códigos de estado
+    """
+    local = threading.local()
+    latencias = []
+    estados = Counter()
+    lock = threading.Lock()
+
+    def sesion():
+        # Una sesión HTTP (con keep-alive) por hilo
+        if not hasattr(local, "sesion"):
+            local.sesion = requests.Session()
+        return local.sesion
+
+    def enviar(registro):
+        inicio = time.perf_counter()
+        try:
+            datos = {"Body": registro["body"], "From": registro["from"], "To": registro.get("to", "")}
+            r = sesion().post(url, data=datos, timeout=timeout)
+            estado = r.status_code
+        except requests.RequestException as e:
+            estado = type(e).__name__
+        duracion = (time.perf_counter() - inicio) * 1000
+        with lock:
+            latencias.append(duracion)
+            estados[str(estado)] += 1
+
+    t_origen = registros[0]["t"] if registros else 0
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        for registro in registros:
+            if velocidad:
+                # Esperar hasta el instante programado para este mensaje
+                espera = (registro["t"] - t_origen) / velocidad - (time.perf_counter() - inicio)
+                if espera > 0:
+                    time.sleep(espera)
+            ejecutor.submit(enviar, registro)
+    duracion = time.perf_counter() - inicio
+
+    errores = sum(n for estado, n in estados.items() if not estado.startswith("2"))
+    return {
+        "mensajes": len(latencias),
+        "duracion_s": round(duracion, 2),
+        "msgs_por_seg": round(len(latencias) / duracion, 1) if duracion else None,
+        "latencia": percentiles(latencias),
+        "tasa_error": round(errores / len(latencias), 4) if latencias else 0.0,
+        "estados": dict(estados),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reproduce una captura de tráfico de /webhook")
+    parser.add_argument("captura", help="archivo JSONL generado con CAPTURA_ACTIVA=True")
+    parser.add_argument("--url", default="http://localhost:5000/webhook")
+    parser.add_argument("--velocidad", default="1", help='multiplicador de velocidad (1, 10, ...) o "max"')
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--limite", type=int, default=None, help="máximo de mensajes a reproducir")
+    args = parser.parse_args(argv)
+
+    velocidad = None if args.velocidad == "max" else float(args.velocidad)
+    if velocidad is not None and velocidad <= 0:
+        parser.error("--velocidad debe ser mayor que 0 o \"max\"")
+
+    registros = cargar_captura(args.captura, args.limite)
+    if not registros:
+        print("La captura está vacía", file=sys.stderr)
+        return 1
+
+    resultado = reproducir(registros, args.url, velocidad, args.concurrencia, args.timeout)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
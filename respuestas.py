@@ -0,0 +1,101 @@
+# respuestas.py
+"""
+Textos de respuesta al usuario.
+
+Las respuestas fijas se construyen una sola vez al importar el módulo y las
+plantillas son métodos `format` ya ligados. Los listados largos se arman con
+`join` y se dividen en mensajes de WhatsApp de hasta Config.RESPUESTA_MAX_CARACTERES;
+si no caben en Config.RESPUESTA_MAX_MENSAJES mensajes, el último termina con un
+token "ver más" que continúa el listado desde la última factura mostrada.
+"""
+from config import Config
+from totales import formatear_moneda
+
+AYUDA = (
+    "🔍 *Asistente de Facturación* 🔍\n\n"
+    "Puedes realizar las siguientes acciones:\n\n"
+    "📝 *Generar una factura*\n"
+    "Ejemplo: \"Facturar 2 licencias a RFC EKU9003173C9\"\n"
+    "También puedes facturar varios productos: \"Facturar 2 licencias y 3 servicios a RFC EKU9003173C9\"\n\n"
+    "📊 *Consultar facturas*\n"
+    "Ejemplo: \"Consultar facturas de RFC EKU9003173C9\"\n\n"
+    "❓ *Ayuda*\n"
+    "Escribe \"ayuda\" para ver este mensaje\n\n"
+    "📱 *Estado de facturas*\n"
+    "Ejemplo: \"Estado de mi factura para RFC EKU9003173C9\""
+)
+ESTADO_EN_DESARROLLO = ("🔍 El sistema de consulta de estado de facturas está en desarrollo. "
+                        "Próximamente podrás consultar el estado de tus trámites.")
+NO_ENTENDIDO = "🤖 No he entendido tu mensaje. Puedes escribir *ayuda* para ver las opciones disponibles."
+
+_ENCABEZADO = "📊 *Facturas encontradas para RFC {}*\n".format
+_ENCABEZADO_CONTINUACION = "📊 *Facturas para RFC {} (continuación)*\n".format
+_FILA_FACTURA = "*{}.* {} ({}) - {} - {}".format
+_VER_MAS = "➡️ Escribe *ver más {} {}n{}* para ver las siguientes.".format
+
+# Una fila ocupa al menos esto ("*1.* x (1) - $0.00 - 01/01/2026"): acota las filas por página
+_LARGO_MINIMO_FILA = 30
+
+
+def filas_por_pagina():
+    """Máximo de facturas que pueden caber en una respuesta (límite de la consulta)"""
+    return Config.RESPUESTA_MAX_MENSAJES * Config.RESPUESTA_MAX_CARACTERES // _LARGO_MINIMO_FILA + 1
+
+
+def sin_mas_facturas(rfc):
+    return f"📝 No hay más facturas para el RFC {rfc}."
+
+
+def listado_facturas(rfc, filas, numero=0):
+    """
+    Arma el listado de facturas en mensajes de WhatsApp.
+
+    Args:
+        rfc (str): RFC consultado
+        filas (iterable): (id, producto, cantidad, total, fecha_emision) en orden de id;
+            solo se consume lo que cabe en la respuesta
+        numero (int): Facturas ya mostradas en páginas anteriores (0 en la primera)
+
+    Returns:
+        list: Textos de los mensajes (vacía si no hay filas)
+    """
+    limite = Config.RESPUESTA_MAX_CARACTERES
+    max_mensajes = Config.RESPUESTA_MAX_MENSAJES
+    # Espacio reservado en el último mensaje para el token "ver más"
+    reserva = len(_VER_MAS(rfc, 10 ** 12, 10 ** 9)) + 1
+    encabezado = _ENCABEZADO_CONTINUACION(rfc) if numero else _ENCABEZADO(rfc)
+
+    mensajes = []
+    lineas, largo = [encabezado], len(encabezado)
+    fechas = {}
+    ultimo_id = None
+    for factura_id, producto, cantidad, total, fecha_emision in filas:
+        dia = fecha_emision.date()
+        fecha = fechas.get(dia)
+        if fecha is None:
+            fecha = fechas[dia] = dia.strftime("%d/%m/%Y")
+        linea = _FILA_FACTURA(numero + 1, producto, cantidad, formatear_moneda(total), fecha)[:limite - reserva]
+
+        disponible = limite - reserva if len(mensajes) == max_mensajes - 1 else limite
+        if largo + len(linea) + 1 > disponible:
+            if ultimo_id is None:
+                # Ni la primera fila cabe junto al encabezado: se recorta, porque el
+                # token "ver más" necesita al menos una factura listada para avanzar
+                linea = linea[:max(disponible - largo - 1, 0)]
+            elif len(mensajes) == max_mensajes - 1:
+                # No cabe en esta respuesta: el resto se pide con "ver más"
+                lineas.append(_VER_MAS(rfc, ultimo_id, numero))
+                mensajes.append("\n".join(lineas))
+                return mensajes
+            else:
+                mensajes.append("\n".join(lineas))
+                lineas, largo = [], 0
+        lineas.append(linea)
+        largo += len(linea) + 1
+        numero += 1
+        ultimo_id = factura_id
+
+    if ultimo_id is None:
+        return []
+    mensajes.append("\n".join(lineas))
+    return mensajes
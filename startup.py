@@ -0,0 +1,229 @@
+# startup.py
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class Servicios:
+    """
+    Servicios compartidos del proceso. Cada servicio (y sus dependencias pesadas:
+    twilio, ollama, fpdf, numpy) se importa y construye en el primer uso.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instancias = {}
+
+    def _obtener(self, nombre, fabrica):
+        instancia = self._instancias.get(nombre)
+        if instancia is None:
+            with self._lock:
+                instancia = self._instancias.get(nombre)
+                if instancia is None:
+                    instancia = fabrica()
+                    self._instancias[nombre] = instancia
+        return instancia
+
+    @property
+    def twilio(self):
+        def crear():
+            from twilio_service import TwilioService
+            return TwilioService()
+        return self._obtener("twilio", crear)
+
+    @property
+    def ia(self):
+        def crear():
+            from ai_services import IAService
+            return IAService()
+        return self._obtener("ia", crear)
+
+    @property
+    def documentos(self):
+        def crear():
+            from document_generator import DocumentGenerator
+            return DocumentGenerator()
+        return self._obtener("documentos", crear)
+
+    def registrar(self, nombre, instancia):
+        """Reemplaza un servicio (p. ej. por un stub en benchmarks o pruebas)"""
+        with self._lock:
+            self._instancias[nombre] = instancia
+
+    def reiniciar(self):
+        """
+        Descarta los servicios y conexiones heredados del proceso padre.
+        Se llama en cada worker después del fork (gunicorn --preload).
+        """
+        with self._lock:
+            self._instancias.clear()
+        # Solo si el padre llegó a importar los modelos
+        if "models" in sys.modules:
+            sys.modules["models"].reiniciar_conexiones()
+
+
+servicios = Servicios()
+
+
+class EstadoArranque:
+    """Estado de preparación del worker expuesto en /health"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.pid = None
+        self.listo = False
+        self.etapas = {}
+        self.errores = {}
+
+    def registrar(self, etapa, duracion_ms, error=None):
+        with self._lock:
+            self.etapas[etapa] = round(duracion_ms, 1)
+            if error:
+                self.errores[etapa] = str(error)
+
+    def como_dict(self):
+        with self._lock:
+            estado = {"ready": self.listo, "warmup_ms": dict(self.etapas)}
+            if self.errores:
+                estado["warmup_errores"] = dict(self.errores)
+            return estado
+
+
+estado = EstadoArranque()
+
+
+_ejecutor = None
+_ejecutor_pid = None
+_ejecutor_lock = threading.Lock()
+
+def obtener_ejecutor():
+    """
+    Pool de hilos acotado (Config.ASYNC_HILOS) del modo ASGI para el trabajo
+    bloqueante: base de datos, PDF, CFDI y rutas WSGI. Uno por proceso.
+    """
+    global _ejecutor, _ejecutor_pid
+    if _ejecutor_pid != os.getpid():
+        with _ejecutor_lock:
+            if _ejecutor_pid != os.getpid():
+                _ejecutor = ThreadPoolExecutor(max_workers=Config.ASYNC_HILOS, thread_name_prefix="bloqueante")
+                _ejecutor_pid = os.getpid()
+    return _ejecutor
+
+
+async def en_hilo(funcion, *args):
+    """Ejecuta `funcion` en el pool acotado con la traza, la empresa y las etapas de la solicitud"""
+    from trazas import propagar
+    return await asyncio.get_running_loop().run_in_executor(obtener_ejecutor(), propagar(funcion), *args)
+
+
+def _calentar_llm():
+    # Fuerza la carga del modelo en Ollama antes del primer mensaje real
+    servicios.ia.clasificar_mensaje("hola")
+
+
+def _calentar_catalogo():
+    from empresas import todas_las_empresas
+    # Cada empresa tiene su propia base e índice: se calientan todas
+    for empresa in todas_las_empresas():
+        contextvars.copy_context().run(_calentar_catalogo_empresa, empresa)
+
+
+def _calentar_catalogo_empresa(empresa):
+    from producto_service import ProductoService
+    from empresas import usar_empresa
+    usar_empresa(empresa)
+    # Carga la copia en memoria del catálogo
+    catalogo = ProductoService.obtener_catalogo()
+    if Config.EMBEDDINGS_ACTIVO:
+        # Cargar (o construir) el índice vectorial de productos
+        from embedding_service import obtener_indice_productos
+        obtener_indice_productos().sincronizar(catalogo.productos, catalogo.version)
+
+
+def _calentar_pdf():
+    # Importa fpdf y carga las fuentes generando una factura en memoria
+    from fpdf import FPDF
+    servicios.documentos
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", "B", size=16)
+    pdf.cell(200, 10, txt="FACTURA", ln=1, align="C")
+    pdf.output(dest="S")
+
+
+def _calentar_cfdi():
+    # Compila el XSD del CFDI una vez por worker
+    if Config.CFDI_ACTIVO:
+        from cfdi import obtener_esquema
+        obtener_esquema()
+
+
+ETAPAS_CALENTAMIENTO = [
+    ("llm", _calentar_llm),
+    ("catalogo", _calentar_catalogo),
+    ("pdf", _calentar_pdf),
+    ("cfdi", _calentar_cfdi),
+]
+
+
+def calentar():
+    """Ejecuta las etapas de calentamiento; un error en una etapa no impide arrancar"""
+    for nombre, etapa in ETAPAS_CALENTAMIENTO:
+        inicio = time.perf_counter()
+        try:
+            etapa()
+            estado.registrar(nombre, (time.perf_counter() - inicio) * 1000)
+        except Exception as e:
+            logger.error("Error en calentamiento (%s): %s", nombre, e)
+            estado.registrar(nombre, (time.perf_counter() - inicio) * 1000, error=e)
+    estado.listo = True
+    logger.info("Worker listo, calentamiento: %s", estado.etapas)
+
+
+def _validar_configuracion():
+    # Una opción activada sin su secreto detiene el worker al arrancar, no en la primera solicitud
+    from captura import obtener_grabador
+    from entrega_pdf import obtener_entrega_pdf
+    obtener_grabador()
+    obtener_entrega_pdf()
+
+
+def iniciar(en_segundo_plano=True):
+    """
+    Prepara el worker una sola vez por proceso. Con Config.WARMUP_ACTIVO el
+    calentamiento se ejecuta (en un hilo, por defecto) y /health responde 503
+    hasta que termina.
+    """
+    _validar_configuracion()
+    with estado._lock:
+        if estado.pid == os.getpid():
+            return
+        estado.reiniciar()
+        estado.pid = os.getpid()
+    # Mantenimiento en segundo plano (un hilo por worker, ver mantenimiento.py)
+    from mantenimiento import obtener_planificador
+    planificador = obtener_planificador()
+    if planificador:
+        planificador.iniciar()
+    if not Config.WARMUP_ACTIVO:
+        estado.listo = True
+        return
+    if en_segundo_plano:
+        threading.Thread(target=calentar, name="calentamiento", daemon=True).start()
+    else:
+        calentar()
+
+
+def post_fork(server, worker):
+    """Hook de gunicorn: reinicia las conexiones heredadas y calienta el worker"""
+    servicios.reiniciar()
+    iniciar()
@@ -0,0 +1,46 @@
+# tests/conftest.py
+"""
+Configuración común de las pruebas: Config lee el entorno al importarse, así que la
+base, las carpetas y los backends locales se fijan aquí antes de importar la aplicación.
+"""
+import itertools
+import os
+import sys
+import tempfile
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="facturacion-tests-")
+os.environ.update({
+    "DATABASE_URI": f"sqlite:///{_TMP}/facturas.db",
+    "DATABASE_REPLICA_URI": "",
+    "EMPRESAS_RUTA": os.path.join(_TMP, "empresas.json"),
+    "UPLOAD_FOLDER": os.path.join(_TMP, "static"),
+    "LLM_BACKEND": "stub",
+    "EMBEDDING_BACKEND": "hash",
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+_empresas = itertools.count()
+
+
+@pytest.fixture
+def crear_empresa(tmp_path):
+    """Crea empresas de prueba, cada una con su propia base (vacía si no se da `database_uri`)"""
+    from empresas import Empresa
+
+    def crear(database_uri=None):
+        numero = next(_empresas)
+        return Empresa(id=f"prueba{numero}", numero="", nombre="PRUEBA", rfc="EKU9003173C9",
+                       regimen_fiscal="601", lugar_expedicion="06000",
+                       database_uri=database_uri or f"sqlite:///{tmp_path}/empresa{numero}.db")
+    return crear
+
+
+@pytest.fixture
+def empresa(crear_empresa):
+    """Empresa con su propia base vacía, fijada como la actual durante la prueba"""
+    from empresas import usar_empresa
+    yield usar_empresa(crear_empresa())
+    usar_empresa(None)
@@ -0,0 +1,90 @@
+# tests/test_catalogo.py
+import json
+from datetime import datetime
+from decimal import Decimal
+import pytest
+import catalogo
+
+
+def _importar(tmp_path, filas, nombre="productos.jsonl"):
+    ruta = tmp_path / nombre
+    ruta.write_text("".join(json.dumps(f) + "\n" for f in filas), encoding="utf-8")
+    return catalogo.importar(str(ruta))
+
+
+def _producto(codigo):
+    from models import get_db_session, Producto
+    db_session = get_db_session()
+    try:
+        return db_session.query(Producto).filter_by(codigo=codigo).one()
+    finally:
+        db_session.close()
+
+
+def test_reimportar_sin_cambios_no_escribe(empresa, tmp_path):
+    filas = [{"codigo": "A1", "nombre": "Tornillo", "precio": "1.50"}]
+    assert _importar(tmp_path, filas)["nuevos"] == 1
+    resumen = _importar(tmp_path, filas)
+    assert (resumen["nuevos"], resumen["actualizados"], resumen["sin_cambios"]) == (0, 0, 1)
+
+
+def test_fila_mas_reciente_actualiza_y_mas_antigua_no(empresa, tmp_path):
+    _importar(tmp_path, [{"codigo": "A1", "precio": "1.50", "actualizado": "2026-10-01T12:00:00"}])
+    resumen = _importar(tmp_path, [{"codigo": "A1", "precio": "2.00", "actualizado": "2026-10-02T12:00:00"}])
+    assert resumen["actualizados"] == 1
+    resumen = _importar(tmp_path, [{"codigo": "A1", "precio": "9.00", "actualizado": "2026-09-30T12:00:00"}])
+    assert resumen["sin_cambios"] == 1
+    assert _producto("A1").precio == Decimal("2.00")
+
+
+@pytest.mark.parametrize("actualizado", ["2026-10-02T12:00:00Z", "2026-10-02T12:00:00+00:00", "2026-10-02T06:00:00-06:00"])
+def test_fechas_con_zona_se_comparan_en_utc(empresa, tmp_path, actualizado):
+    _importar(tmp_path, [{"codigo": "A1", "precio": "1.50", "actualizado": "2026-10-01T12:00:00"}])
+    resumen = _importar(tmp_path, [{"codigo": "A1", "precio": "2.00", "actualizado": actualizado}])
+    assert resumen["actualizados"] == 1
+    assert _producto("A1").actualizado == datetime(2026, 10, 2, 12, 0)
+
+
+def test_fila_invalida_no_detiene_la_importacion(empresa, tmp_path):
+    resumen = _importar(tmp_path, [
+        {"codigo": "A1", "precio": "1.50"},
+        {"codigo": "A2", "precio": "1.50", "actualizado": "ayer"},
+        {"codigo": "A3", "precio": "caro"},
+        {"nombre": "sin código"},
+        {"codigo": "A4", "precio": "3"},
+    ])
+    assert (resumen["filas"], resumen["nuevos"], resumen["invalidos"]) == (5, 2, 3)
+    assert [e["linea"] for e in resumen["errores"]] == [2, 3, 4]
+
+
+def test_la_base_nueva_tiene_version_de_catalogo(empresa):
+    from models import get_db_session
+    db_session = get_db_session()
+    try:
+        assert catalogo.version_catalogo(db_session) == 0
+    finally:
+        db_session.close()
+
+
+def test_facturar_no_modifica_el_catalogo(empresa, tmp_path):
+    import app
+    from models import get_db_session, DetalleFactura, Producto
+    from producto_service import ProductoService
+    from totales import calcular_totales
+
+    _importar(tmp_path, [{"codigo": "L1", "nombre": "Licencia", "precio": "50"}])
+    productos = [{"nombre": "licencia", "cantidad": 2}, {"nombre": "Zapato de cristal", "cantidad": 1}]
+    encontrados = ProductoService.obtener_productos(productos)
+    totales = calcular_totales(productos, ProductoService.obtener_precios_productos(productos, encontrados))
+    assert app.guardar_factura("EKU9003173C9", totales, "factura.pdf", encontrados)
+
+    db_session = get_db_session()
+    try:
+        assert catalogo.version_catalogo(db_session) == 1
+        assert [p.codigo for p in db_session.query(Producto)] == ["L1"]
+        detalles = db_session.query(DetalleFactura).order_by(DetalleFactura.id).all()
+    finally:
+        db_session.close()
+    assert [(d.producto_id is not None, d.descripcion, d.precio_unitario) for d in detalles] == [
+        (True, "licencia", Decimal("50.00")), (False, "Zapato de cristal", Decimal("100.00")),
+    ]
@@ -0,0 +1,62 @@
+# tests/test_cfdi.py
+import threading
+
+import pytest
+
+import cfdi
+from config import Config
+
+pytest.importorskip("lxml")
+
+XSD = """<?xml version="1.0"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="Comprobante">
+    <xs:complexType><xs:attribute name="Total" type="xs:decimal" use="required"/></xs:complexType>
+  </xs:element>
+</xs:schema>"""
+
+
+@pytest.fixture
+def esquema(tmp_path, monkeypatch):
+    ruta = tmp_path / "cfdi.xsd"
+    ruta.write_text(XSD)
+    monkeypatch.setattr(Config, "CFDI_XSD_RUTA", str(ruta))
+    monkeypatch.setattr(cfdi, "_documento_xsd", None)
+    monkeypatch.setattr(cfdi, "_esquema_cargado", False)
+    monkeypatch.setattr(cfdi, "_esquemas", threading.local())
+
+
+def test_un_validador_por_hilo(esquema):
+    propios = []
+    hilo = threading.Thread(target=lambda: propios.append(cfdi.obtener_esquema()))
+    hilo.start()
+    hilo.join()
+    assert cfdi.obtener_esquema() is cfdi.obtener_esquema()
+    assert propios[0] is not None and propios[0] is not cfdi.obtener_esquema()
+
+
+def test_validaciones_concurrentes_no_mezclan_errores(esquema):
+    valido, invalido = b'<Comprobante Total="1.00"/>', b'<Comprobante Total="x"/>'
+    resultados, inicio = [], threading.Barrier(8)
+
+    def validar(xml):
+        inicio.wait()
+        for _ in range(50):
+            resultados.append((xml is valido, cfdi.validar(xml)))
+
+    hilos = [threading.Thread(target=validar, args=(valido if i % 2 else invalido,)) for i in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert len(resultados) == 400
+    for es_valido, errores in resultados:
+        assert (errores == []) == es_valido
+
+
+def test_sin_xsd_no_valida(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "CFDI_XSD_RUTA", str(tmp_path / "no-existe.xsd"))
+    monkeypatch.setattr(cfdi, "_documento_xsd", None)
+    monkeypatch.setattr(cfdi, "_esquema_cargado", False)
+    monkeypatch.setattr(cfdi, "_esquemas", threading.local())
+    assert cfdi.validar(b"<Comprobante/>") is None
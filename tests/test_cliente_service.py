@@ -0,0 +1,74 @@
+# tests/test_cliente_service.py
+import pytest
+import cliente_service
+from cliente_service import ClienteService
+from empresas import usar_empresa
+
+
+@pytest.fixture(autouse=True)
+def cache_vacio(monkeypatch):
+    monkeypatch.setattr(cliente_service, "_ids", {})
+    yield
+    usar_empresa(None)
+
+
+class _SesionFalsa:
+    """Cuenta las consultas a la base: cada RFC 'XX...n' es el cliente n"""
+    def __init__(self):
+        self.consultas = 0
+        self._rfc = None
+
+    def query(self, *args):
+        self.consultas += 1
+        return self
+
+    def filter_by(self, rfc):
+        self._rfc = rfc
+        return self
+
+    def scalar(self):
+        return int(self._rfc[-3:])
+
+
+def _rfc(n):
+    return f"XAXX010101{n:03d}"
+
+
+def test_una_empresa_no_desaloja_los_clientes_de_otra(crear_empresa):
+    grande, pequena = crear_empresa(), crear_empresa()
+    grande.clientes_cache_max = pequena.clientes_cache_max = 10
+    sesion = _SesionFalsa()
+
+    usar_empresa(pequena)
+    for n in range(5):
+        assert ClienteService.obtener_id(sesion, _rfc(n)) == n
+    # La otra empresa llena (y rebasa) su propio caché
+    usar_empresa(grande)
+    for n in range(100):
+        ClienteService.obtener_id(sesion, _rfc(n))
+    assert len(cliente_service._ids[grande.id]) == 10
+
+    usar_empresa(pequena)
+    consultas = sesion.consultas
+    assert [ClienteService.obtener_id(sesion, _rfc(n)) for n in range(5)] == list(range(5))
+    assert sesion.consultas == consultas
+
+
+def test_lru_por_empresa(crear_empresa):
+    empresa = usar_empresa(crear_empresa())
+    empresa.clientes_cache_max = 2
+    sesion = _SesionFalsa()
+    ClienteService.obtener_id(sesion, _rfc(1))
+    ClienteService.obtener_id(sesion, _rfc(2))
+    ClienteService.obtener_id(sesion, _rfc(1))     # 1 pasa a ser el más reciente
+    ClienteService.obtener_id(sesion, _rfc(3))     # desaloja a 2
+    assert list(cliente_service._ids[empresa.id]) == [_rfc(1), _rfc(3)]
+
+
+def test_sin_cache(crear_empresa):
+    empresa = usar_empresa(crear_empresa())
+    empresa.clientes_cache_max = 0
+    sesion = _SesionFalsa()
+    ClienteService.obtener_id(sesion, _rfc(1))
+    ClienteService.obtener_id(sesion, _rfc(1))
+    assert sesion.consultas == 2 and empresa.id not in cliente_service._ids
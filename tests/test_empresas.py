@@ -0,0 +1,51 @@
+# tests/test_empresas.py
+import json
+import pytest
+import empresas
+from config import Config
+
+PRINCIPAL = "whatsapp:+14155238886"
+ACME = "whatsapp:+5215512345678"
+
+
+@pytest.fixture
+def registro(monkeypatch, tmp_path):
+    """Registro con la empresa principal y `acme`"""
+    ruta = tmp_path / "empresas.json"
+    ruta.write_text(json.dumps([{
+        "id": "acme", "numero": ACME, "nombre": "ACME SA DE CV", "rfc": "EKU9003173C9",
+        "regimen_fiscal": "601", "lugar_expedicion": "06000",
+    }]), encoding="utf-8")
+    monkeypatch.setattr(Config, "EMPRESAS_RUTA", str(ruta))
+    monkeypatch.setattr(Config, "TWILIO_PHONE_NUMBER", PRINCIPAL)
+    monkeypatch.setattr(empresas, "_registro", None)
+    yield empresas.obtener_empresas()
+    empresas._registro = None
+
+
+def test_numero_registrado(registro):
+    assert empresas.empresa_por_numero(ACME).id == "acme"
+
+
+def test_sin_to_y_numero_principal_van_a_la_principal(registro):
+    assert empresas.empresa_por_numero("") is registro["principal"]
+    assert empresas.empresa_por_numero(PRINCIPAL) is registro["principal"]
+
+
+def test_numero_desconocido_se_rechaza(registro):
+    assert empresas.empresa_por_numero("whatsapp:+5210000000000") is None
+
+
+def test_numero_desconocido_con_respaldo_explicito(registro, monkeypatch):
+    monkeypatch.setattr(Config, "EMPRESA_DESCONOCIDA_PRINCIPAL", True)
+    assert empresas.empresa_por_numero("whatsapp:+5210000000000") is registro["principal"]
+
+
+def test_sin_empresas_registradas_todo_va_a_la_principal(monkeypatch, tmp_path):
+    monkeypatch.setattr(Config, "EMPRESAS_RUTA", str(tmp_path / "no-existe.json"))
+    monkeypatch.setattr(empresas, "_registro", None)
+    try:
+        principal = empresas.obtener_empresas()["principal"]
+        assert empresas.empresa_por_numero("whatsapp:+5210000000000") is principal
+    finally:
+        empresas._registro = None
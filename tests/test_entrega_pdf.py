@@ -0,0 +1,115 @@
+# tests/test_entrega_pdf.py
+import os
+import time
+
+import pytest
+
+import entrega_pdf
+from config import Config
+
+
+@pytest.fixture(autouse=True)
+def secreto(monkeypatch):
+    monkeypatch.setattr(Config, "PDF_TOKEN_SECRETO", "clave-de-prueba")
+
+
+def _ruta(*partes):
+    return os.path.join(Config.UPLOAD_FOLDER, *partes)
+
+
+def test_firmar_y_verificar():
+    token = entrega_pdf.firmar(_ruta("acme", "factura_X_1.pdf"))
+    assert entrega_pdf.verificar(token) == "acme/factura_X_1.pdf"
+
+
+def test_enlace_vencido():
+    assert entrega_pdf.verificar(entrega_pdf.firmar(_ruta("f.pdf"), vigencia=-1)) is None
+
+
+def test_firma_alterada():
+    carga, firma = entrega_pdf.firmar(_ruta("f.pdf")).split(".")
+    otra = "A" if firma[0] != "A" else "B"
+    assert entrega_pdf.verificar(f"{carga}.{otra}{firma[1:]}") is None
+
+
+def test_ruta_alterada():
+    _, firma = entrega_pdf.firmar(_ruta("f.pdf")).split(".")
+    carga = entrega_pdf._b64(f"otra_empresa/f.pdf|{int(time.time()) + 60}".encode())
+    assert entrega_pdf.verificar(f"{carga}.{firma}") is None
+
+
+def test_clave_distinta(monkeypatch):
+    token = entrega_pdf.firmar(_ruta("f.pdf"))
+    monkeypatch.setattr(Config, "PDF_TOKEN_SECRETO", "otra-clave")
+    assert entrega_pdf.verificar(token) is None
+
+
+@pytest.mark.parametrize("token", ["", "sin-punto", "no base64!.x", "a.b.c"])
+def test_token_invalido(token):
+    assert entrega_pdf.verificar(token) is None
+
+
+def test_ruta_fuera_de_upload_folder():
+    carga = f"../secreto.pdf|{int(time.time()) + 60}"
+    token = f"{entrega_pdf._b64(carga.encode())}.{entrega_pdf._firma(carga)}"
+    assert entrega_pdf.verificar(token) is None
+
+
+def test_sin_clave_no_verifica_ni_arranca(monkeypatch):
+    token = entrega_pdf.firmar(_ruta("f.pdf"))
+    monkeypatch.setattr(Config, "PDF_TOKEN_SECRETO", "")
+    assert entrega_pdf.verificar(token) is None
+    with pytest.raises(ValueError):
+        entrega_pdf.EntregaPDF()
+
+
+def _esperar(condicion, limite=5.0):
+    fin = time.monotonic() + limite
+    while not condicion() and time.monotonic() < fin:
+        time.sleep(0.01)
+    return condicion()
+
+
+def test_entrega_desde_memoria_y_escritura(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "UPLOAD_FOLDER", str(tmp_path))
+    entrega = entrega_pdf.EntregaPDF(max_bytes=1024)
+    ruta = str(tmp_path / "factura_A_1.pdf")
+    entrega.guardar(ruta, b"%PDF-1")
+    assert entrega.obtener("factura_A_1.pdf") == b"%PDF-1"
+    assert _esperar(lambda: entrega.metricas()["pdfs"] == 0)
+    with open(ruta, "rb") as f:
+        assert f.read() == b"%PDF-1"
+    # Ya escrito y descargado: se sirve desde disco
+    assert entrega.obtener("factura_A_1.pdf") is None
+
+
+def test_sin_espacio_se_escribe_en_la_solicitud(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "UPLOAD_FOLDER", str(tmp_path))
+    entrega = entrega_pdf.EntregaPDF(max_bytes=4)
+    ruta = str(tmp_path / "grande.pdf")
+    entrega.guardar(ruta, b"%PDF-grande")
+    assert os.path.exists(ruta)
+    assert entrega.metricas()["en_disco"] == 1
+
+
+def test_escritura_fallida_se_reintenta_y_libera(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(entrega_pdf, "_ESPERA_REINTENTO_S", 0.01)
+    intentos = []
+
+    def fallar(pdf_path, contenido):
+        intentos.append(pdf_path)
+        raise OSError("disco lleno")
+
+    monkeypatch.setattr(entrega_pdf, "_escribir", fallar)
+    entrega = entrega_pdf.EntregaPDF(max_bytes=10, vigencia=60)
+    entrega.guardar(str(tmp_path / "a.pdf"), b"12345678")
+    assert _esperar(lambda: entrega._pdfs["a.pdf"].fallido)
+    assert len(intentos) == entrega_pdf._INTENTOS_ESCRITURA
+    assert entrega.metricas()["errores_escritura"] == entrega_pdf._INTENTOS_ESCRITURA
+    # Sigue disponible en memoria, pero no bloquea el caché para el siguiente PDF
+    assert entrega.obtener("a.pdf") == b"12345678"
+    monkeypatch.setattr(entrega_pdf, "_escribir", lambda pdf_path, contenido: None)
+    entrega.guardar(str(tmp_path / "b.pdf"), b"87654321")
+    metricas = entrega.metricas()
+    assert metricas["perdidos"] == 1 and metricas["en_memoria"] == 2 and "en_disco" not in metricas
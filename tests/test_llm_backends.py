@@ -0,0 +1,58 @@
+# tests/test_llm_backends.py
+import threading
+import time
+from llm_backends import CircuitBreaker
+
+
+def _abierto(reposo=0.05):
+    circuito = CircuitBreaker(umbral_fallos=2, tiempo_reposo=reposo)
+    circuito.registrar_fallo()
+    circuito.registrar_fallo()
+    assert not circuito.permite()
+    return circuito
+
+
+def test_se_abre_tras_el_umbral():
+    circuito = CircuitBreaker(umbral_fallos=2, tiempo_reposo=60)
+    circuito.registrar_fallo()
+    assert circuito.permite()
+    circuito.registrar_fallo()
+    assert not circuito.permite()
+
+
+def test_medio_abierto_deja_pasar_una_sola_prueba():
+    circuito = _abierto()
+    time.sleep(0.06)
+    barrera = threading.Barrier(2)
+    resultados = []
+
+    def llamar():
+        barrera.wait()
+        resultados.append(circuito.permite())
+
+    hilos = [threading.Thread(target=llamar) for _ in range(2)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert sorted(resultados) == [False, True]
+    # Mientras la prueba no termina, nadie más pasa
+    assert not circuito.permite()
+
+
+def test_prueba_exitosa_cierra_el_circuito():
+    circuito = _abierto()
+    time.sleep(0.06)
+    assert circuito.permite()
+    circuito.registrar_exito()
+    assert circuito.permite() and circuito.permite()
+
+
+def test_prueba_fallida_lo_reabre():
+    circuito = _abierto()
+    time.sleep(0.06)
+    assert circuito.permite()
+    circuito.registrar_fallo()
+    assert not circuito.permite()
+    time.sleep(0.06)
+    assert circuito.permite()
@@ -0,0 +1,99 @@
+# tests/test_mantenimiento.py
+from datetime import datetime, timedelta
+import pytest
+import mantenimiento
+
+
+@pytest.fixture
+def tarea():
+    ejecuciones = []
+    tarea = mantenimiento.Tarea("prueba", 3600, lambda: ejecuciones.append(1) or {"n": len(ejecuciones)})
+    tarea.ejecuciones = ejecuciones
+    return tarea
+
+
+def _fila(nombre):
+    from models import get_db_session, TareaProgramada
+    db_session = get_db_session()
+    try:
+        return db_session.get(TareaProgramada, nombre)
+    finally:
+        db_session.close()
+
+
+def _vencer_bloqueo(nombre):
+    from models import get_db_session, TareaProgramada
+    db_session = get_db_session()
+    try:
+        db_session.query(TareaProgramada).filter_by(nombre=nombre).update(
+            {TareaProgramada.bloqueado_hasta: datetime.now() - timedelta(seconds=1)})
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def test_primera_toma_inserta_la_fila(empresa, tarea):
+    assert mantenimiento.tomar_tarea(tarea, "w1")
+    fila = _fila("prueba")
+    assert fila.propietario == "w1" and fila.bloqueado_hasta > datetime.now()
+
+
+def test_tarea_bloqueada_no_se_toma_dos_veces(empresa, tarea):
+    assert mantenimiento.tomar_tarea(tarea, "w1")
+    assert not mantenimiento.tomar_tarea(tarea, "w2")
+    # Ni forzando el intervalo: el bloqueo sigue vigente
+    assert not mantenimiento.tomar_tarea(tarea, "w2", intervalo=0)
+
+
+def test_bloqueo_vencido_lo_toma_otro_worker(empresa, tarea):
+    assert mantenimiento.tomar_tarea(tarea, "w1")
+    _vencer_bloqueo("prueba")
+    assert mantenimiento.tomar_tarea(tarea, "w2")
+    assert _fila("prueba").propietario == "w2"
+    # El worker original ya no puede liberar un bloqueo que no es suyo
+    mantenimiento.liberar_tarea(tarea, "w1", {})
+    assert _fila("prueba").propietario == "w2"
+
+
+def test_tras_liberar_se_respeta_el_intervalo(empresa, tarea):
+    assert mantenimiento.tomar_tarea(tarea, "w1")
+    mantenimiento.liberar_tarea(tarea, "w1", {"ok": True})
+    fila = _fila("prueba")
+    assert fila.propietario is None and fila.bloqueado_hasta is None and fila.ultima_ejecucion
+    assert not mantenimiento.tomar_tarea(tarea, "w2")
+    assert mantenimiento.tomar_tarea(tarea, "w2", intervalo=0)
+
+
+def test_ejecutar_tarea_una_vez_por_intervalo(empresa, tarea):
+    assert mantenimiento.ejecutar_tarea(tarea, empresa, "w1")["n"] == 1
+    assert mantenimiento.ejecutar_tarea(tarea, empresa, "w2") is None
+    assert mantenimiento.ejecutar_tarea(tarea, empresa, "w2", forzar=True)["n"] == 2
+    assert len(tarea.ejecuciones) == 2
+
+
+def test_las_tareas_aparte_no_corren_en_los_workers(empresa, monkeypatch):
+    ejecutadas = []
+    tareas = [
+        mantenimiento.Tarea("cache", 3600, lambda: ejecutadas.append("cache"), exclusiva=False),
+        mantenimiento.Tarea("normal", 3600, lambda: ejecutadas.append("normal")),
+        mantenimiento.Tarea("vacuum", 3600, lambda: ejecutadas.append("vacuum"), aparte=True),
+    ]
+    monkeypatch.setattr(mantenimiento, "TAREAS", tareas)
+    monkeypatch.setattr(mantenimiento, "todas_las_empresas", lambda: [empresa])
+
+    mantenimiento.Planificador().ejecutar_pendientes()
+    assert ejecutadas == ["cache", "normal"]
+    ejecutadas.clear()
+    mantenimiento.Planificador(proceso_aparte=True).ejecutar_pendientes()
+    # "normal" ya la ejecutó un worker y no le toca todavía
+    assert ejecutadas == ["vacuum"]
+
+
+def test_compactar_solo_en_el_proceso_aparte():
+    compactar = next(t for t in mantenimiento.TAREAS if t.nombre == "compactar")
+    wal = next(t for t in mantenimiento.TAREAS if t.nombre == "wal")
+    assert compactar.aparte and not wal.aparte
+
+
+def test_vaciar_wal_en_sqlite(empresa):
+    assert mantenimiento.vaciar_wal() == {}
@@ -0,0 +1,72 @@
+# tests/test_message_parser.py
+import re
+import pytest
+import ai_services
+import captura
+import embedding_service
+import respuestas
+from config import Config
+from message_parser import MessageParser, digito_verificador_rfc
+
+# Cualquier palabra con forma de RFC (3-4 letras, 6 dígitos y 3 caracteres)
+_CANDIDATO_RFC = re.compile(r'\b[A-Z&Ñ]{3,4}\d{6}[A-Z\d]{3}\b')
+
+
+@pytest.mark.parametrize("rfc", [
+    "GODE561231GR8", "EKU9003173C9", "IIA040805DZ4", "H&E951128469", "MAS0810247C0",
+    "XAXX010101000", "XEXX010101000",
+])
+def test_rfc_validos(rfc):
+    assert MessageParser.validar_rfc(rfc)
+
+
+@pytest.mark.parametrize("rfc", [
+    "EKU9003173C8",     # dígito verificador
+    "EKU9013173C9",     # mes 13
+    "EKU9002323C9",     # día 32
+    "eku9003173c9",     # minúsculas (el parser normaliza antes de validar)
+    "EKU9003173C",      # corto
+    "GODE561231GR8X",   # largo
+    "ABC123456XYZ",
+    "",
+    None,
+])
+def test_rfc_invalidos(rfc):
+    assert not MessageParser.validar_rfc(rfc)
+
+
+def test_digito_verificador():
+    assert digito_verificador_rfc("GODE561231GR") == "8"
+    # Persona moral: se completa con un espacio al inicio
+    assert digito_verificador_rfc("EKU9003173C") == "9"
+    assert digito_verificador_rfc("MAS0810247C") == "0"
+
+
+# Textos de ayuda y prompts del LLM con RFC de ejemplo
+_TEXTOS = [v for modulo in (respuestas, ai_services) for v in vars(modulo).values() if isinstance(v, str)]
+
+
+@pytest.mark.parametrize("texto", _TEXTOS)
+def test_los_ejemplos_usan_rfc_validos(texto):
+    for rfc in _CANDIDATO_RFC.findall(texto):
+        assert MessageParser.validar_rfc(rfc), rfc
+
+
+def test_los_ejemplos_de_intencion_usan_rfc_validos():
+    rfcs = [rfc for texto, _ in embedding_service.EJEMPLOS_INTENCION
+            for rfc in _CANDIDATO_RFC.findall(texto.upper())]
+    assert rfcs
+    assert all(MessageParser.validar_rfc(rfc) for rfc in rfcs), rfcs
+
+
+def test_ayuda_tiene_ejemplos_de_rfc():
+    assert _CANDIDATO_RFC.findall(respuestas.AYUDA)
+
+
+def test_seudonimos_de_captura_son_validos(monkeypatch):
+    monkeypatch.setattr(Config, "CAPTURA_SAL", "sal-de-prueba")
+    for rfc in ["GODE561231GR8", "EKU9003173C9", "XAXX010101000"]:
+        seudonimo = captura.anonimizar_mensaje(f"Facturar 1 licencia a RFC {rfc}").rsplit(" ", 1)[1]
+        assert seudonimo != rfc
+        assert len(seudonimo) == len(rfc)
+        assert MessageParser.validar_rfc(seudonimo), seudonimo
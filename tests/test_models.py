@@ -0,0 +1,25 @@
+# tests/test_models.py
+import sqlite3
+from models import init_db, get_db_session, DetalleFactura
+
+
+def test_detalles_sin_producto_en_una_base_anterior(tmp_path, crear_empresa):
+    ruta = tmp_path / "anterior.db"
+    conexion = sqlite3.connect(ruta)
+    conexion.execute("CREATE TABLE detalles_factura (id INTEGER PRIMARY KEY, factura_id INTEGER NOT NULL, "
+                     "producto_id INTEGER NOT NULL, cantidad INTEGER NOT NULL, precio_unitario NUMERIC(12, 2), "
+                     "subtotal NUMERIC(12, 2))")
+    conexion.execute("INSERT INTO detalles_factura VALUES (1, 1, 7, 2, 10, 20)")
+    conexion.commit()
+    conexion.close()
+
+    empresa = crear_empresa(f"sqlite:///{ruta}")
+    init_db(empresa)
+    db_session = get_db_session(empresa=empresa)
+    try:
+        db_session.add(DetalleFactura(factura_id=2, producto_id=None, descripcion="Libre", cantidad=1))
+        db_session.commit()
+        filas = [(d.id, d.producto_id, d.descripcion) for d in db_session.query(DetalleFactura).order_by(DetalleFactura.id)]
+    finally:
+        db_session.close()
+    assert filas == [(1, 7, None), (2, None, "Libre")]
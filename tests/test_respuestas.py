@@ -0,0 +1,37 @@
+# tests/test_respuestas.py
+from datetime import datetime
+from decimal import Decimal
+import respuestas
+from config import Config
+
+RFC = "EKU9003173C9"
+
+
+def _filas(n, producto="Licencia"):
+    return [(i, producto, 1, Decimal("116.00"), datetime(2026, 10, 1)) for i in range(1, n + 1)]
+
+
+def test_listado_en_varios_mensajes_con_ver_mas(monkeypatch):
+    monkeypatch.setattr(Config, "RESPUESTA_MAX_CARACTERES", 200)
+    monkeypatch.setattr(Config, "RESPUESTA_MAX_MENSAJES", 2)
+    mensajes = respuestas.listado_facturas(RFC, _filas(50))
+    assert len(mensajes) == 2
+    assert all(len(m) <= 200 for m in mensajes)
+    listadas = sum(1 for m in mensajes for linea in m.splitlines() if linea.startswith("*"))
+    assert mensajes[-1].endswith(f"ver más {RFC} {listadas}n{listadas}* para ver las siguientes.")
+
+
+def test_primera_fila_que_no_cabe_se_recorta(monkeypatch):
+    monkeypatch.setattr(Config, "RESPUESTA_MAX_CARACTERES", 140)
+    monkeypatch.setattr(Config, "RESPUESTA_MAX_MENSAJES", 1)
+    mensajes = respuestas.listado_facturas(RFC, _filas(3, producto="X" * 200))
+    assert len(mensajes) == 1
+    assert "None" not in mensajes[0]
+    assert len(mensajes[0]) <= 140
+    assert mensajes[0].splitlines()[2].startswith("*1.* XXX")
+    # El token continúa después de la fila recortada
+    assert mensajes[0].endswith(f"ver más {RFC} 1n1* para ver las siguientes.")
+
+
+def test_sin_filas():
+    assert respuestas.listado_facturas(RFC, []) == []
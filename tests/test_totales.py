@@ -0,0 +1,94 @@
+# tests/test_totales.py
+import os
+import random
+import subprocess
+import sys
+from decimal import Decimal
+
+import pytest
+
+from totales import (PRECIO_POR_DEFECTO, TotalesFactura, calcular_totales, calcular_totales_lote,
+                     formatear_moneda, redondear)
+
+
+def test_redondeo_mitad_hacia_arriba():
+    # Con ROUND_HALF_EVEN (el de Decimal por omisión) daría 10.00 y 0.12
+    assert redondear("10.005") == Decimal("10.01")
+    assert redondear("0.125") == Decimal("0.13")
+    # Los float se convierten por su repr, sin el error binario de 2.675
+    assert redondear(2.675) == Decimal("2.68")
+
+
+def test_importe_e_iva_por_concepto():
+    totales = calcular_totales([{"nombre": "Licencia", "cantidad": 3}], {"licencia": "33.333"}, Decimal("0.16"))
+    linea = totales.lineas[0]
+    assert linea.precio_unitario == Decimal("33.33")
+    assert linea.importe == Decimal("99.99")
+    assert linea.iva == Decimal("16.00")  # 15.9984
+    assert (totales.subtotal, totales.iva, totales.total) == (Decimal("99.99"), Decimal("16.00"), Decimal("115.99"))
+
+
+def test_iva_de_la_factura_es_la_suma_de_los_conceptos_redondeados():
+    # Cada concepto lleva 0.0048 de IVA -> 0.00; redondear el total daría 0.01
+    productos = [{"nombre": f"p{i}", "cantidad": 1} for i in range(3)]
+    totales = calcular_totales(productos, {f"p{i}": "0.03" for i in range(3)}, Decimal("0.16"))
+    assert totales.subtotal == Decimal("0.09")
+    assert totales.iva == Decimal("0.00")
+    assert totales.total == Decimal("0.09")
+
+
+def test_precio_por_defecto_y_nombres_sin_mayusculas():
+    totales = calcular_totales(
+        [{"nombre": "Servicio", "cantidad": 2}, {"nombre": "Desconocido", "cantidad": 1}],
+        {"servicio": 50}, Decimal("0"),
+    )
+    assert [l.importe for l in totales.lineas] == [Decimal("100.00"), PRECIO_POR_DEFECTO]
+    assert totales.iva == Decimal("0.00")
+    assert totales.cantidad_total == 3
+
+
+@pytest.mark.parametrize("tasa, texto", [
+    ("0.16", "16"), ("0.08", "8"), ("0", "0"), ("0.00", "0"), ("1", "100"), ("0.105", "10.5"),
+])
+def test_porcentaje_iva(tasa, texto):
+    assert TotalesFactura([], Decimal(tasa)).porcentaje_iva == texto
+
+
+def test_formatear_moneda():
+    assert formatear_moneda(Decimal("1234567.5")) == "$1,234,567.50"
+
+
+def _facturas_aleatorias(n, semilla=7):
+    rng = random.Random(semilla)
+    nombres = [f"producto{i}" for i in range(20)]
+    precios = {nombre: f"{rng.uniform(0.01, 5000):.3f}" for nombre in nombres}
+    facturas = [
+        [{"nombre": rng.choice(nombres + ["Sin precio"]), "cantidad": rng.randint(1, 50)}
+         for _ in range(rng.randint(0, 8))]
+        for _ in range(n)
+    ]
+    return facturas, precios
+
+
+@pytest.mark.parametrize("tasa", ["0.16", "0.08", "0", "0.105"])
+def test_lote_coincide_con_calcular_totales(tasa):
+    pytest.importorskip("numpy")
+    facturas, precios = _facturas_aleatorias(500)
+    # Precio ya pactado en algunas líneas, y un precio que cae en medio centavo
+    facturas[0] = [{"nombre": "Licencia", "cantidad": 3, "precio_unitario": Decimal("33.335")}]
+    for lote, productos in zip(calcular_totales_lote(facturas, precios, Decimal(tasa)), facturas):
+        esperado = calcular_totales(productos, precios, Decimal(tasa))
+        assert (lote.subtotal, lote.iva, lote.total) == (esperado.subtotal, esperado.iva, esperado.total)
+        assert [(l.precio_unitario, l.importe, l.iva) for l in lote.lineas] == \
+            [(l.precio_unitario, l.importe, l.iva) for l in esperado.lineas]
+
+
+def test_lote_con_cantidades_fraccionarias_usa_la_ruta_decimal():
+    facturas = [[{"nombre": "kilo", "cantidad": Decimal("1.5")}]]
+    assert calcular_totales_lote(facturas, {"kilo": "10.01"})[0].subtotal == Decimal("15.02")
+
+
+def test_el_webhook_no_importa_numpy():
+    codigo = "import sys, app; sys.exit('numpy' in sys.modules)"
+    raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", codigo], cwd=raiz).returncode == 0
@@ -0,0 +1,167 @@
+# totales.py
+"""
+Cálculo de importes de facturas con aritmética decimal exacta.
+
+Reglas de redondeo (CFDI 4.0, moneda MXN con dos decimales):
+- El valor unitario se redondea a centavos.
+- Importe de cada concepto = cantidad × valor unitario, redondeado a centavos.
+- IVA trasladado de cada concepto = importe × tasa, redondeado a centavos (mitad hacia arriba).
+- Subtotal e IVA de la factura son la suma de los valores ya redondeados de cada concepto;
+  total = subtotal + IVA.
+
+Los totales se calculan una sola vez por factura y los reutilizan el PDF, la base de
+datos y el mensaje de respuesta.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from config import Config
+
+CENTAVOS = Decimal("0.01")
+PRECIO_POR_DEFECTO = Decimal(Config.PRECIO_POR_DEFECTO).quantize(CENTAVOS, rounding=ROUND_HALF_UP)
+TASA_IVA = Decimal(Config.IVA_TASA)
+
+
+def a_decimal(valor):
+    """Convierte precios y cantidades (float, int, str o Decimal) a Decimal sin arrastrar errores binarios"""
+    if isinstance(valor, Decimal):
+        return valor
+    if isinstance(valor, float):
+        return Decimal(repr(valor))
+    return Decimal(valor)
+
+
+def redondear(valor):
+    """Redondea a centavos, con la mitad hacia arriba"""
+    return a_decimal(valor).quantize(CENTAVOS, rounding=ROUND_HALF_UP)
+
+
+def formatear_moneda(valor):
+    return f"${valor:,.2f}"
+
+
+class LineaFactura:
+    def __init__(self, nombre, cantidad, precio_unitario, importe, iva):
+        self.nombre = nombre
+        self.cantidad = cantidad
+        self.precio_unitario = precio_unitario
+        self.importe = importe
+        self.iva = iva
+
+    def __repr__(self):
+        return f"<LineaFactura(nombre='{self.nombre}', cantidad={self.cantidad}, importe={self.importe})>"
+
+
+class TotalesFactura:
+    def __init__(self, lineas, tasa_iva, subtotal=None, iva=None):
+        self.lineas = lineas
+        self.tasa_iva = tasa_iva
+        self.subtotal = sum((l.importe for l in lineas), Decimal("0.00")) if subtotal is None else subtotal
+        self.iva = sum((l.iva for l in lineas), Decimal("0.00")) if iva is None else iva
+        self.total = self.subtotal + self.iva
+
+    @property
+    def cantidad_total(self):
+        return sum(l.cantidad for l in self.lineas)
+
+    @property
+    def porcentaje_iva(self):
+        """Tasa como porcentaje para mostrar: Decimal("0.16") -> "16", Decimal("0") -> "0" """
+        porcentaje = self.tasa_iva * 100
+        if porcentaje == 0:
+            # Tasa 0 % (exportaciones, alimentos): se muestra "IVA (0%)", nunca "IVA (%)"
+            return "0"
+        return f"{porcentaje.normalize():f}"
+
+    def __repr__(self):
+        return f"<TotalesFactura(lineas={len(self.lineas)}, subtotal={self.subtotal}, iva={self.iva}, total={self.total})>"
+
+
+def calcular_totales(productos, precios, tasa_iva=None):
+    """
+    Calcula las líneas y los totales de una factura.
+
+    Args:
+        productos (list): [{"nombre": "licencia", "cantidad": 2}, ...]; un producto con
+            "precio_unitario" (el ya pactado en la factura) no lo busca en `precios`
+        precios (dict): {nombre en minúsculas: precio}; los productos sin precio usan PRECIO_POR_DEFECTO
+        tasa_iva (Decimal, optional): Tasa de IVA; por defecto Config.IVA_TASA
+
+    Returns:
+        TotalesFactura
+    """
+    tasa = TASA_IVA if tasa_iva is None else a_decimal(tasa_iva)
+    lineas = []
+    for producto in productos:
+        nombre = producto.get("nombre", "Producto")
+        cantidad = producto.get("cantidad", 1)
+        precio = producto.get("precio_unitario")
+        precio = redondear(precios.get(nombre.lower(), PRECIO_POR_DEFECTO) if precio is None else precio)
+        importe = redondear(a_decimal(cantidad) * precio)
+        lineas.append(LineaFactura(nombre, cantidad, precio, importe, redondear(importe * tasa)))
+    return TotalesFactura(lineas, tasa)
+
+
+
+def _centavos_a_decimal(centavos):
+    return Decimal(centavos).scaleb(-2)
+
+
+def calcular_totales_lote(facturas, precios, tasa_iva=None):
+    """
+    Calcula los totales de muchas facturas a la vez (p. ej. el cierre de mes).
+    Los importes se calculan en centavos enteros con NumPy, con el mismo redondeo
+    que calcular_totales, y cada precio del catálogo se convierte una sola vez.
+    NumPy se importa aquí y no al cargar el módulo, que también usa el webhook.
+
+    Args:
+        facturas (list): Lista de listas de productos (como en calcular_totales), una por factura
+        precios (dict): Precios compartidos por todas las facturas
+        tasa_iva (Decimal, optional): Tasa de IVA; por defecto Config.IVA_TASA
+
+    Returns:
+        list: Un TotalesFactura por factura, en el mismo orden
+    """
+    tasa = TASA_IVA if tasa_iva is None else a_decimal(tasa_iva)
+    nombres, cantidades, precios_linea, factura_idx = [], [], [], []
+    for i, productos in enumerate(facturas):
+        for producto in productos:
+            nombres.append(producto.get("nombre", "Producto"))
+            cantidades.append(producto.get("cantidad", 1))
+            precios_linea.append(producto.get("precio_unitario"))
+            factura_idx.append(i)
+
+    # La ruta vectorizada requiere cantidades enteras y una tasa con a lo sumo 6 decimales (TasaOCuota)
+    if not all(isinstance(c, int) for c in cantidades) or tasa != tasa.quantize(Decimal("0.000001")):
+        return [calcular_totales(productos, precios, tasa) for productos in facturas]
+    import numpy as np
+
+    centavos = {}
+    precio_c = np.empty(len(nombres), dtype=np.int64)
+    for j, (nombre, precio) in enumerate(zip(nombres, precios_linea)):
+        if precio is not None:
+            precio_c[j] = int(redondear(precio) * 100)
+            continue
+        clave = nombre.lower()
+        if clave not in centavos:
+            centavos[clave] = int(redondear(precios.get(clave, PRECIO_POR_DEFECTO)) * 100)
+        precio_c[j] = centavos[clave]
+
+    importe_c = np.asarray(cantidades, dtype=np.int64) * precio_c
+    # IVA en centavos con redondeo mitad hacia arriba, en aritmética entera (tasa en millonésimas)
+    tasa_m = int(tasa * 1_000_000)
+    iva_c = (importe_c * tasa_m + 500_000) // 1_000_000
+    idx = np.asarray(factura_idx, dtype=np.int64)
+    subtotal_c = np.zeros(len(facturas), dtype=np.int64)
+    total_iva_c = np.zeros(len(facturas), dtype=np.int64)
+    np.add.at(subtotal_c, idx, importe_c)
+    np.add.at(total_iva_c, idx, iva_c)
+
+    lineas_por_factura = [[] for _ in facturas]
+    for i, nombre, cantidad, precio, importe, iva in zip(
+            factura_idx, nombres, cantidades, precio_c.tolist(), importe_c.tolist(), iva_c.tolist()):
+        lineas_por_factura[i].append(LineaFactura(
+            nombre, cantidad, _centavos_a_decimal(precio), _centavos_a_decimal(importe), _centavos_a_decimal(iva)
+        ))
+    return [
+        TotalesFactura(lineas, tasa, _centavos_a_decimal(subtotal), _centavos_a_decimal(iva))
+        for lineas, subtotal, iva in zip(lineas_por_factura, subtotal_c.tolist(), total_iva_c.tolist())
+    ]
@@ -0,0 +1,366 @@
+# trazas.py
+"""
+Trazas por solicitud compatibles con OpenTelemetry.
+
+Cada mensaje entrante recibe un id de correlación (el MessageSid de Twilio, o uno
+aleatorio) del que se deriva el trace_id. Las etapas del pipeline, las llamadas al
+LLM y a Twilio y cada sentencia SQL se registran como spans y se exportan en formato
+OTLP/JSON a un archivo (una solicitud de exportación por línea, legible por el
+receptor otlpjsonfile del collector) o directamente a un collector por HTTP.
+"""
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Tipos de span (SpanKind de OTLP)
+INTERNO = 1
+SERVIDOR = 2
+CLIENTE = 3
+
+# (trace_id, id de correlación) de la solicitud actual
+_traza = contextvars.ContextVar("traza", default=None)
+_span_actual = contextvars.ContextVar("span_actual", default=None)
+
+_PATRON_MESSAGE_SID = re.compile(r'^[A-Z]{2}([0-9a-f]{32})$')
+
+
+def iniciar_traza(correlacion=None):
+    """
+    Asocia la ejecución actual a una nueva traza.
+
+    Args:
+        correlacion (str, optional): MessageSid u otro id externo; si falta se genera uno
+
+    Returns:
+        str: Id de correlación de la solicitud
+    """
+    correlacion = correlacion or secrets.token_hex(16)
+    match = _PATRON_MESSAGE_SID.match(correlacion)
+    # El MessageSid ya contiene 32 dígitos hexadecimales: se usan como trace_id
+    trace_id = match.group(1) if match else hashlib.sha256(correlacion.encode()).hexdigest()[:32]
+    _traza.set((trace_id, correlacion))
+    _span_actual.set(None)
+    return correlacion
+
+
+def correlacion_actual():
+    """Id de correlación de la solicitud actual (o None)"""
+    traza = _traza.get()
+    return traza[1] if traza else None
+
+
+def propagar(funcion):
+    """
+    Envuelve `funcion` para que se ejecute con la traza actual en otro hilo
+    (ThreadPoolExecutor, threading.Thread, trabajos en segundo plano).
+    """
+    contexto = contextvars.copy_context()
+    return lambda *args, **kwargs: contexto.run(funcion, *args, **kwargs)
+
+
+def _valor_otlp(valor):
+    if isinstance(valor, bool):
+        return {"boolValue": valor}
+    if isinstance(valor, int):
+        return {"intValue": str(valor)}
+    if isinstance(valor, float):
+        return {"doubleValue": valor}
+    return {"stringValue": str(valor)}
+
+
+class Span:
+    __slots__ = ("nombre", "tipo", "trace_id", "span_id", "padre_id",
+                 "inicio_ns", "fin_ns", "atributos", "estado", "error")
+
+    def __init__(self, nombre, trace_id, padre_id=None, tipo=INTERNO, atributos=None):
+        self.nombre = nombre
+        self.tipo = tipo
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.padre_id = padre_id
+        self.inicio_ns = time.time_ns()
+        self.fin_ns = None
+        self.atributos = dict(atributos or {})
+        self.estado = 0
+        self.error = None
+
+    def atributo(self, clave, valor):
+        if valor is not None:
+            self.atributos[clave] = valor
+
+    def registrar_error(self, error):
+        self.estado = 2
+        self.error = f"{type(error).__name__}: {error}"
+
+    def terminar(self):
+        self.fin_ns = time.time_ns()
+
+    def como_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.nombre,
+            "kind": self.tipo,
+            "startTimeUnixNano": str(self.inicio_ns),
+            "endTimeUnixNano": str(self.fin_ns or time.time_ns()),
+            "attributes": [{"key": k, "value": _valor_otlp(v)} for k, v in self.atributos.items()],
+            "status": {"code": self.estado},
+        }
+        if self.padre_id:
+            span["parentSpanId"] = self.padre_id
+        if self.error:
+            span["status"]["message"] = self.error
+        return span
+
+
+class _SpanNulo:
+    """Span sin efecto que se entrega cuando las trazas están desactivadas"""
+    span_id = None
+
+    def atributo(self, clave, valor):
+        pass
+
+    def registrar_error(self, error):
+        pass
+
+
+SPAN_NULO = _SpanNulo()
+
+
+@contextmanager
+def span(nombre, tipo=INTERNO, atributos=None):
+    """
+    Registra un bloque como span hijo del span actual. Sin trazas activas
+    (o fuera de una solicitud) entrega SPAN_NULO y no registra nada.
+    """
+    exportador = obtener_exportador()
+    traza = _traza.get()
+    if exportador is None or traza is None:
+        yield SPAN_NULO
+        return
+    padre = _span_actual.get()
+    actual = Span(nombre, traza[0], padre.span_id if padre else None, tipo, atributos)
+    token = _span_actual.set(actual)
+    try:
+        yield actual
+    except BaseException as e:
+        actual.registrar_error(e)
+        raise
+    finally:
+        _span_actual.reset(token)
+        actual.terminar()
+        exportador.exportar(actual)
+
+
+def instrumentar_engine(engine):
+    """Registra un span por cada sentencia SQL ejecutada por `engine`"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        traza = _traza.get()
+        if traza is None:
+            return
+        padre = _span_actual.get()
+        operacion = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+        # Solo la sentencia parametrizada; los valores no se registran
+        conn.info.setdefault("trazas_sql", []).append(Span(
+            f"db.{operacion}", traza[0], padre.span_id if padre else None, CLIENTE,
+            {"db.system": engine.dialect.name, "db.statement": statement, "db.operation": operacion}
+        ))
+
+    def _terminar(conn, error=None):
+        pendientes = conn.info.get("trazas_sql")
+        if not pendientes:
+            return
+        actual = pendientes.pop()
+        if error is not None:
+            actual.registrar_error(error)
+        actual.terminar()
+        exportador = obtener_exportador()
+        if exportador:
+            exportador.exportar(actual)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _despues(conn, cursor, statement, parameters, context, executemany):
+        _terminar(conn)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(contexto):
+        if contexto.connection is not None:
+            _terminar(contexto.connection, contexto.original_exception)
+
+
+class ExportadorSpans:
+    """
+    Acumula los spans terminados en una cola y los envía en lotes desde un hilo
+    propio, de modo que la solicitud nunca espera por la exportación. Si la cola
+    se llena los spans se descartan.
+    """
+    def __init__(self, tamano_lote=256, intervalo=1.0, max_cola=10000):
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self.descartados = 0
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.vaciar)
+
+    def _asegurar_hilo(self):
+        # El hilo exportador se crea en el primer uso y de nuevo tras un fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._ejecutar, name="trazas", daemon=True).start()
+
+    def exportar(self, span_terminado):
+        self._asegurar_hilo()
+        try:
+            self._cola.put_nowait(span_terminado)
+        except queue.Full:
+            self.descartados += 1
+
+    def _ejecutar(self):
+        while True:
+            lote = [self._cola.get()]
+            limite = time.monotonic() + self.intervalo
+            while len(lote) < self.tamano_lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self._cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+            self._enviar(lote)
+
+    def vaciar(self):
+        """Envía los spans pendientes (al salir del proceso)"""
+        lote = []
+        while True:
+            try:
+                lote.append(self._cola.get_nowait())
+            except queue.Empty:
+                break
+        if lote:
+            self._enviar(lote)
+
+    def _enviar(self, lote):
+        solicitud = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": Config.SERVICIO_NOMBRE}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "trazas"},
+                    "spans": [s.como_otlp() for s in lote],
+                }],
+            }]
+        }
+        try:
+            self._escribir(solicitud)
+        except Exception as e:
+            logger.error("Error exportando %d spans: %s", len(lote), e)
+
+    def _escribir(self, solicitud):
+        raise NotImplementedError
+
+
+class ExportadorArchivo(ExportadorSpans):
+    """Una solicitud de exportación OTLP/JSON por línea"""
+    def __init__(self, ruta=None, **kwargs):
+        super().__init__(**kwargs)
+        self.ruta = ruta or Config.TRAZAS_RUTA
+        os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+
+    def _escribir(self, solicitud):
+        with open(self.ruta, "a", encoding="utf-8") as f:
+            f.write(json.dumps(solicitud, ensure_ascii=False) + "\n")
+
+
+class ExportadorOTLP(ExportadorSpans):
+    """Envía los spans a un collector por OTLP/HTTP con codificación JSON"""
+    def __init__(self, url=None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url or Config.TRAZAS_OTLP_URL
+        self.sesion = requests.Session()
+
+    def _escribir(self, solicitud):
+        respuesta = self.sesion.post(self.url, json=solicitud, timeout=5)
+        respuesta.raise_for_status()
+
+
+_exportador = None
+
+def obtener_exportador():
+    """Exportador compartido del proceso, o None si las trazas están desactivadas"""
+    global _exportador
+    if not Config.TRAZAS_ACTIVAS:
+        return None
+    if _exportador is None:
+        if Config.TRAZAS_EXPORTADOR == "otlp":
+            _exportador = ExportadorOTLP()
+        else:
+            _exportador = ExportadorArchivo()
+    return _exportador
+
+
+class FiltroCorrelacion(logging.Filter):
+    """Agrega el id de correlación y los ids de traza/span a cada registro de log"""
+    def filter(self, record):
+        traza = _traza.get()
+        actual = _span_actual.get()
+        record.correlacion = traza[1] if traza else "-"
+        record.trace_id = traza[0] if traza else None
+        record.span_id = actual.span_id if actual else None
+        return True
+
+
+class FormateadorJSON(logging.Formatter):
+    """Una línea JSON por registro, con los nombres de campo del modelo de logs de OpenTelemetry"""
+    def format(self, record):
+        registro = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "severity_text": record.levelname,
+            "logger": record.name,
+            "body": record.getMessage(),
+            "correlacion": getattr(record, "correlacion", None),
+            "trace_id": getattr(record, "trace_id", None),
+            "span_id": getattr(record, "span_id", None),
+        }
+        if record.exc_info:
+            registro["exception"] = self.formatException(record.exc_info)
+        return json.dumps(registro, ensure_ascii=False)
+
+
+def configurar_logging():
+    """
+    Configura el logging raíz según Config.LOG_NIVEL y Config.LOG_FORMATO ("texto" o "json").
+    El filtro de correlación está en el handler, así que solo corre para los
+    registros que superan el nivel configurado.
+    """
+    handler = logging.StreamHandler()
+    handler.addFilter(FiltroCorrelacion())
+    if Config.LOG_FORMATO == "json":
+        handler.setFormatter(FormateadorJSON())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(correlacion)s] %(message)s'
+        ))
+    logging.basicConfig(level=Config.LOG_NIVEL, handlers=[handler])
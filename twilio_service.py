@@ -2,15 +2,19 @@
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.base.exceptions import TwilioRestException
-import os
+import asyncio
 import logging
+from trazas import span, CLIENTE
+from empresas import empresa_actual
 from config import Config
+import entrega_pdf
 
 logger = logging.getLogger(__name__)
 
 class TwilioService:
     def __init__(self):
         self.test_mode = Config.TEST_MODE
+        self._clientes_async = {}
         if self.test_mode:
             logger.info("Iniciando Twilio en MODO PRUEBA (no se enviarán mensajes reales)")
             self.client = None
@@ -19,7 +23,7 @@ class TwilioService:
                 self.client = Client(Config.TWILIO_ACCOUNT_SID, Config.TWILIO_AUTH_TOKEN)
                 logger.info("Cliente Twilio inicializado")
             except Exception as e:
-                logger.error(f"Error inicializando Twilio: {e}")
+                logger.error("Error inicializando Twilio: %s", e)
                 self.client = None
     
     def enviar_factura(self, pdf_path, to):
@@ -27,41 +31,89 @@ class TwilioService:
         Envía un PDF por WhatsApp usando Twilio
         """
         if self.test_mode:
-            # En modo prueba, solo registra la acción pero no envía realmente
-            logger.info(f"[MODO PRUEBA] Simulando envío de factura a {to}")
-            logger.info(f"[MODO PRUEBA] Ruta del PDF: {pdf_path}")
-            pdf_filename = os.path.basename(pdf_path)
-            logger.info(f"[MODO PRUEBA] URL simulada: {Config.BASE_URL}/static/{pdf_filename}")
-            return "TEST-MESSAGE-SID-12345"
+            return self._simular_envio(pdf_path, to)
         
         if not self.client:
             logger.error("Cliente Twilio no inicializado")
             return None
             
         try:
-            # Construir URL pública del archivo
-            # Asegúrate de que la URL incluya /static/ para coincidir con la ruta de tu aplicación
-            pdf_filename = os.path.basename(pdf_path)
-            pdf_url = f"{Config.BASE_URL}/static/{pdf_filename}"
-            
             # Enviar mensaje
-            message = self.client.messages.create(
-                media_url=[pdf_url],
-                from_=Config.TWILIO_PHONE_NUMBER,
-                to=to
-            )
-            logger.info(f"Factura enviada a {to}, SID: {message.sid}")
+            with span("twilio.messages.create", CLIENTE, {"messaging.system": "twilio"}) as s:
+                message = self.client.messages.create(**self._parametros_envio(pdf_path, to))
+                s.atributo("messaging.message.id", message.sid)
+            logger.info("Factura enviada a %s, SID: %s", to, message.sid)
+            return message.sid
+        except Exception as e:
+            return self._manejar_error(e)
+    
+    async def enviar_factura_async(self, pdf_path, to):
+        """Versión asíncrona de enviar_factura para el modo ASGI (la espera no ocupa un hilo)"""
+        if self.test_mode:
+            return self._simular_envio(pdf_path, to)
+        
+        cliente = self._cliente_async()
+        if not cliente:
+            logger.error("Cliente Twilio no inicializado")
+            return None
+            
+        try:
+            with span("twilio.messages.create", CLIENTE, {"messaging.system": "twilio"}) as s:
+                message = await cliente.messages.create_async(**self._parametros_envio(pdf_path, to))
+                s.atributo("messaging.message.id", message.sid)
+            logger.info("Factura enviada a %s, SID: %s", to, message.sid)
             return message.sid
-        except TwilioRestException as e:
+        except Exception as e:
+            return self._manejar_error(e)
+    
+    def _cliente_async(self):
+        # Un cliente con sesión aiohttp por event loop
+        loop = asyncio.get_running_loop()
+        cliente = self._clientes_async.get(loop)
+        if cliente is None:
+            try:
+                from twilio.http.async_http_client import AsyncTwilioHttpClient
+                cliente = Client(Config.TWILIO_ACCOUNT_SID, Config.TWILIO_AUTH_TOKEN,
+                                 http_client=AsyncTwilioHttpClient())
+                self._clientes_async[loop] = cliente
+            except Exception as e:
+                logger.error("Error inicializando Twilio asíncrono: %s", e)
+        return cliente
+    
+    def _simular_envio(self, pdf_path, to):
+        # En modo prueba, solo registra la acción pero no envía realmente
+        logger.info("[MODO PRUEBA] Simulando envío de factura a %s", to)
+        logger.info("[MODO PRUEBA] Ruta del PDF: %s", pdf_path)
+        logger.info("[MODO PRUEBA] URL simulada: %s", self._url_pdf(pdf_path))
+        return "TEST-MESSAGE-SID-12345"
+    
+    def _parametros_envio(self, pdf_path, to):
+        return {
+            "media_url": [self._url_pdf(pdf_path)],
+            # Se responde desde el número de la empresa que recibió el mensaje
+            "from_": empresa_actual().numero,
+            "to": to,
+        }
+    
+    @staticmethod
+    def _manejar_error(e):
+        if isinstance(e, TwilioRestException):
             if e.code == 63038:  # Código para límite diario excedido
-                logger.warning(f"Límite diario de mensajes Twilio excedido: {e}")
+                logger.warning("Límite diario de mensajes Twilio excedido: %s", e)
                 return "LIMIT_EXCEEDED"
-            else:
-                logger.error(f"Error de Twilio al enviar factura: {e}")
-                return None
-        except Exception as e:
-            logger.error(f"Error enviando factura: {e}")
+            logger.error("Error de Twilio al enviar factura: %s", e)
             return None
+        logger.error("Error enviando factura: %s", e)
+        return None
+    
+    @staticmethod
+    def _url_pdf(pdf_path):
+        # Construir URL pública del archivo
+        if Config.PDF_ENTREGA_MEMORIA:
+            # Enlace firmado: se sirve desde memoria aunque el PDF aún no esté en disco
+            return entrega_pdf.url_publica(pdf_path)
+        # Asegúrate de que la URL incluya /static/ para coincidir con la ruta de tu aplicación
+        return f"{Config.BASE_URL}/static/{entrega_pdf.ruta_publica(pdf_path)}"
     
     def crear_respuesta(self):
         """Crea un objeto de respuesta TwiML"""